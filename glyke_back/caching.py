@@ -0,0 +1,52 @@
+import time
+from django.core.cache import cache
+
+
+def get_version(name):
+    """Returns the current version of a cache namespace (e.g. 'category_tree'), initializing it if there is none yet"""
+    version = cache.get(f'{name}_version')
+    if version is None:
+        version = bump_version(name)
+    return version
+
+def get_versions(names):
+    """Returns a list of the current versions of cache namespaces, read with a single cache multi-get"""
+    versions = cache.get_many([f'{name}_version' for name in names])
+    return [versions.get(f'{name}_version') or bump_version(name) for name in names]
+
+def bump_version(name):
+    """Switches a cache namespace to a new version, so the entries cached under the previous one are never read again.
+    Versions are microsecond timestamps, so a version is never reused even if the cache has been cleared"""
+    version = time.time_ns() // 1000
+    cache.set(f'{name}_version', version, None)
+    return version
+
+def bump_versions(names):
+    """Bumps versions of cache namespaces with a single cache multi-set, see bump_version"""
+    version = time.time_ns() // 1000
+    cache.set_many({f'{name}_version': version for name in names}, None)
+
+def get_versioned_key(name, *key_parts):
+    """Returns a cache key of given namespace's current version, e.g. 'category_tree:1634567890123456:descendants:5'"""
+    return ':'.join(str(part) for part in (name, get_version(name), *key_parts))
+
+_local_cache = dict() # process-local tier: {namespace: (version, {key: value})}
+
+def get_or_set_two_tier(name, key, default):
+    """Returns a value cached under the current version of a namespace.
+    Looks it up in the process-local tier first, then in the shared django cache, and calls default() if there is none.
+    On a local hit only the namespace version is read from the django cache, so a worker doesn't serve a value bumped by another one
+    as long as the django cache is shared by the workers (see CACHES setting, the local-memory backend is per process)"""
+    version = get_version(name)
+    local_version, local_entries = _local_cache.get(name, (None, None))
+    if local_version != version: # drop all the entries of the previous version
+        local_entries = dict()
+        _local_cache[name] = (version, local_entries)
+    if key not in local_entries:
+        shared_key = get_versioned_key(name, key)
+        value = cache.get(shared_key)
+        if value is None:
+            value = default()
+            cache.set(shared_key, value, None)
+        local_entries[key] = value
+    return local_entries[key]
@@ -0,0 +1,224 @@
+import csv
+import json
+from collections import Counter
+from itertools import islice
+from django.db import transaction
+from django.db.models import Q
+from django.core.exceptions import ValidationError
+from django.core.serializers.json import DjangoJSONEncoder
+from django.contrib.contenttypes.models import ContentType
+from django.utils.text import slugify
+from django.utils.translation import gettext as _
+from taggit.models import Tag, TaggedItem
+from photologue.models import Gallery
+
+from .models import Category, Product, ProductCard
+from .forms import ImportProductForm
+from .caching import bump_version
+from .signals import sync_products
+
+
+# columns of an exported catalogue, in the order they are written
+EXPORT_FIELDS = ('id', 'name', 'description', 'category', 'tags', 'attributes', 'cost_price', 'selling_price', 'discount_percent',
+                 'end_user_price', 'profit', 'stock', 'is_active', 'main_photo_url', 'photo_urls', 'created')
+EXPORT_FORMATS = {'csv': 'text/csv', 'jsonl': 'application/x-ndjson'}
+LIST_SEPARATOR = '|' # separates tags and photo urls in a CSV cell
+
+def iter_catalogue_records(*, batch_size=500, url_prefix=''):
+    """Yields a dict per product (see EXPORT_FIELDS), ordered by id.
+    Products are read from their cards with a chunked iterator, attributes are fetched per batch of cards,
+    so memory depends on the batch size only. url_prefix makes photos' urls absolute, e.g. 'https://example.com'"""
+    cards = ProductCard.objects.order_by('id').iterator(chunk_size=batch_size)
+    while True:
+        batch = list(islice(cards, batch_size))
+        if not batch: return
+        attributes = dict(Product.objects.filter(id__in=[card.id for card in batch]).values_list('id', 'attributes'))
+        for card in batch:
+            yield {'id': card.id,
+                   'name': card.name,
+                   'description': card.description,
+                   'category': card.category_name,
+                   'tags': card.tags,
+                   'attributes': attributes.get(card.id) or dict(),
+                   'cost_price': card.cost_price,
+                   'selling_price': card.selling_price,
+                   'discount_percent': card.discount_percent,
+                   'end_user_price': card.end_user_price,
+                   'profit': card.profit,
+                   'stock': card.stock,
+                   'is_active': card.is_active,
+                   'main_photo_url': url_prefix + card.main_photo_url if card.main_photo_url else '',
+                   'photo_urls': [url_prefix + photo['url'] for photo in card.photos],
+                   'created': card.created}
+
+class Echo:
+    """A file-like object which returns what's written to it, so csv.writer can feed a stream"""
+    def write(self, value):
+        return value
+
+def iter_csv(records):
+    """Yields CSV lines of records, a header first. Lists are joined with LIST_SEPARATOR, attributes are a JSON object"""
+    writer = csv.writer(Echo())
+    yield writer.writerow(EXPORT_FIELDS)
+    for record in records:
+        record = dict(record, tags=LIST_SEPARATOR.join(record['tags']),
+                              photo_urls=LIST_SEPARATOR.join(record['photo_urls']),
+                              attributes=json.dumps(record['attributes'], ensure_ascii=False))
+        yield writer.writerow([record[field] for field in EXPORT_FIELDS])
+
+def iter_jsonl(records):
+    """Yields a JSON line per record"""
+    for record in records:
+        yield json.dumps(record, cls=DjangoJSONEncoder, ensure_ascii=False) + '\n'
+
+def export_catalogue(export_format, *, batch_size=500, url_prefix=''):
+    """Returns an iterator of the catalogue's lines in given format ('csv' or 'jsonl')"""
+    iter_lines = {'csv': iter_csv, 'jsonl': iter_jsonl}[export_format]
+    return iter_lines(iter_catalogue_records(batch_size=batch_size, url_prefix=url_prefix))
+
+# defaults of an imported row's missing or empty fields
+IMPORT_DEFAULTS = {'description': '', 'stock': 0, 'cost_price': 0, 'selling_price': 0, 'discount_percent': 0, 'is_active': True}
+
+def iter_rows(lines, import_format):
+    """Yields (row number, a dict of the row's fields or an error message) of CSV (with a header) or JSONL lines"""
+    if import_format == 'csv':
+        for row_number, row in enumerate(csv.DictReader(lines), start=2):
+            yield row_number, row
+        return
+    for row_number, line in enumerate(lines, start=1):
+        if not line.strip(): continue
+        try:
+            row = json.loads(line)
+        except ValueError as error:
+            yield row_number, _('Invalid JSON: %s') % error
+            continue
+        yield row_number, row if isinstance(row, dict) else _('A row has to be a JSON object')
+
+def clean_row(row, *, categories):
+    """Returns (product's fields, tags' names, errors) of a row, categories are {name: id}.
+    Tags may be a list or a LIST_SEPARATOR-joined string, attributes an object or a JSON string, as they are exported"""
+    errors = dict()
+    data = {field: row.get(field) for field in ImportProductForm.Meta.fields}
+    for field, default in IMPORT_DEFAULTS.items():
+        if data[field] in (None, ''): data[field] = default
+    fields = dict()
+    for field_name, field in ImportProductForm.base_fields.items(): # the form's and the model's validation, w/o instances per row
+        try:
+            fields[field_name] = field.clean(data[field_name])
+            Product._meta.get_field(field_name).run_validators(fields[field_name])
+        except ValidationError as error:
+            errors[field_name] = error.messages
+    category = row.get('category') or None
+    if category is not None and category not in categories:
+        errors['category'] = [_('Unknown category "%s"') % category]
+    fields['category_id'] = categories.get(category)
+    attributes = row.get('attributes') or dict()
+    if isinstance(attributes, str):
+        try:
+            attributes = json.loads(attributes)
+        except ValueError:
+            attributes = None
+    if not isinstance(attributes, dict):
+        errors['attributes'] = [_('Attributes have to be a JSON object')]
+    fields['attributes'] = attributes
+    tags = row.get('tags') or []
+    if isinstance(tags, str): tags = tags.split(LIST_SEPARATOR)
+    tags = list(dict.fromkeys(str(tag).strip() for tag in tags if str(tag).strip())) # unique, in order
+    if any(len(tag) > 100 for tag in tags):
+        errors['tags'] = [_('A tag can have at most 100 characters')]
+    return fields, tags, errors
+
+def import_catalogue(lines, import_format, *, created_by=None, batch_size=500):
+    """Imports products from CSV or JSONL lines (see EXPORT_FIELDS, extra columns are ignored), validating and inserting them by batches.
+    Each batch takes a fixed number of queries: products and their galleries are bulk_created, tags are assigned in bulk
+    via the taggit's through table, prices are computed in Python as Price.save() does. Invalid rows are skipped.
+    Returns {'created': number of products created, 'errors': [{'row': row number, 'errors': {field: messages}}]}"""
+    report = {'created': 0, 'errors': []}
+    seen_names = set() # names are unique in the whole file
+    rows = iter_rows(lines, import_format)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            report['errors'].sort(key=lambda error: error['row'])
+            return report
+        with transaction.atomic():
+            product_ids, has_tags = import_batch(batch, report=report, seen_names=seen_names, created_by=created_by)
+        if product_ids:
+            sync_products(product_ids)
+            if has_tags: bump_version('product_tags')
+        report['created'] += len(product_ids)
+
+def import_batch(batch, *, report, seen_names, created_by):
+    """Imports a batch of (row number, row) and returns (ids of products created, whether any of them has tags), see import_catalogue"""
+    categories = dict(Category.objects.filter(name__in={row.get('category') for row_number, row in batch if isinstance(row, dict)} - {None, ''})
+                                      .values_list('name', 'id'))
+    cleaned_rows = []
+    for row_number, row in batch:
+        if not isinstance(row, dict):
+            report['errors'].append({'row': row_number, 'errors': {'__all__': [row]}})
+            continue
+        fields, tags, errors = clean_row(row, categories=categories)
+        if errors:
+            report['errors'].append({'row': row_number, 'errors': errors})
+            continue
+        cleaned_rows.append((row_number, fields, tags))
+    # names' (and their galleries') uniqueness, a query per model
+    names = [fields['name'] for row_number, fields, tags in cleaned_rows]
+    gallery_titles = {name: name + _('_gallery') for name in names}
+    taken_names = set(Product.objects.filter(name__in=names).values_list('name', flat=True))
+    taken_gallery_titles = set() # titles and slugs
+    for title, slug in Gallery.objects.filter(Q(title__in=gallery_titles.values()) | Q(slug__in=[slugify(title) for title in gallery_titles.values()])) \
+                                      .values_list('title', 'slug'):
+        taken_gallery_titles.update((title, slug))
+    products, product_tags, galleries = [], dict(), []
+    for row_number, fields, tags in cleaned_rows:
+        name, gallery_title = fields['name'], gallery_titles[fields['name']]
+        if name in seen_names or name in taken_names or gallery_title in taken_gallery_titles or slugify(gallery_title) in taken_gallery_titles:
+            report['errors'].append({'row': row_number, 'errors': {'name': [_('Product with this Name already exists.')]}})
+            continue
+        seen_names.add(name)
+        taken_gallery_titles.update((gallery_title, slugify(gallery_title)))
+        end_user_price = Product.get_end_user_price(fields['selling_price'], fields['discount_percent'])
+        fields['is_active'] = fields['is_active'] and fields['selling_price'] > 0 # as Product.save() does
+        products.append(Product(**fields,
+                                end_user_price=end_user_price,
+                                profit=end_user_price - fields['cost_price'],
+                                created_by=created_by))
+        galleries.append(Gallery(title=gallery_title, slug=slugify(gallery_title)))
+        product_tags[name] = tags
+    if not products: return [], False
+    # ids aren't returned by bulk_create on every backend, so they are read back by the unique names and slugs
+    Gallery.objects.bulk_create(galleries)
+    gallery_ids = dict(Gallery.objects.filter(slug__in=[gallery.slug for gallery in galleries]).values_list('slug', 'id'))
+    for product, gallery in zip(products, galleries): product.photos_id = gallery_ids[gallery.slug]
+    Product.objects.bulk_create(products)
+    product_ids = dict(Product.objects.filter(name__in=[product.name for product in products]).values_list('name', 'id'))
+    tagged_items_count = add_tags_in_bulk({product_ids[name]: tags for name, tags in product_tags.items()})
+    # active products' counters, a query per category
+    for category_id, count in Counter(product.category_id for product in products if product.is_active).items():
+        Category.objects.update_active_products_count(category_id, count)
+    return list(product_ids.values()), bool(tagged_items_count)
+
+def add_tags_in_bulk(product_tags):
+    """Tags products, product_tags is {product id: tags' names}. Missing tags are created, tagged items are bulk_created.
+    Returns the number of tagged items created"""
+    names = {name for tags in product_tags.values() for name in tags}
+    if not names: return 0
+    tag_ids = dict(Tag.objects.filter(name__in=names).values_list('name', 'id'))
+    missing_names = names - tag_ids.keys()
+    taken_slugs = set(Tag.objects.filter(slug__in=[slugify(name) for name in missing_names]).values_list('slug', flat=True))
+    new_tags = []
+    for name in sorted(missing_names):
+        slug = slugify(name)
+        if not slug or slug in taken_slugs:
+            Tag.objects.create(name=name) # a rare case, taggit makes the slug unique
+        else:
+            taken_slugs.add(slug)
+            new_tags.append(Tag(name=name, slug=slug))
+    Tag.objects.bulk_create(new_tags)
+    tag_ids.update(Tag.objects.filter(name__in=missing_names).values_list('name', 'id'))
+    content_type = ContentType.objects.get_for_model(Product)
+    tagged_items = [TaggedItem(content_type=content_type, object_id=product_id, tag_id=tag_ids[name])
+                    for product_id, tags in product_tags.items() for name in tags]
+    TaggedItem.objects.bulk_create(tagged_items)
+    return len(tagged_items)
@@ -1,7 +1,17 @@
+import re
+import hashlib
 from functools import wraps
-from django.http.response import Http404
+from urllib.parse import urlencode
+from django.core.cache import cache
+from django.conf import settings
+from django.http.response import Http404, HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+from django.middleware.csrf import get_token
 from django.contrib.auth.mixins import UserPassesTestMixin
 
+from .caching import get_versions
+
 
 def user_passes_test_or_404(test_func):
     """ Based on default 'user_passes_test'
@@ -42,3 +52,70 @@ class UserIsSuperuser_Or404_Mixin(UserPassesTest_Or404_Mixin):
     """Mixin that checks if the user is_superuser, redirecting to 404 if not."""
     def test_func(self):
         return self.request.user.is_superuser # pragma: no cover - exclude from coverage
+
+class AnonymousPageCacheMixin:
+    """Mixin that caches whole responses for anonymous users, logged in users always get live pages.
+    Pages are cached per path and normalized (sorted) query string.
+    A cached page is only served while the versions of its dependency tags (get_page_cache_tags) are the same as when it was cached,
+    tags' versions are bumped via signals, e.g. 'product:5' on the product's save/delete.
+    CSRF tokens are cached as a placeholder and filled in per request.
+    Anonymous responses also get ETag and Last-Modified derived from the tags' versions, so conditional requests are answered with 304
+    before the page is even read from the cache. Cache-Control is set by page_cache_control (for anonymous users)"""
+    page_cache_timeout = 60 * 60
+    page_cache_tags = ()
+    # pages have CSRF tokens in them, so they are only reused by the browser (after revalidating)
+    page_cache_control = {'private': True, 'no_cache': True}
+    csrf_token_placeholder = '\ue020'
+    csrf_token_re = re.compile(r'(name="csrfmiddlewaretoken" value=")[^"]*(")')
+
+    def is_page_cacheable(self):
+        return self.request.method == 'GET' and not self.request.user.is_authenticated
+
+    def get_page_cache_tags(self):
+        """Returns the tags of the data the page depends on"""
+        return list(self.page_cache_tags)
+
+    def get_page_cache_key(self):
+        query = urlencode(sorted((key, value) for key, values in self.request.GET.lists() for value in values))
+        return f'page:{self.request.path}?{query}'
+
+    def get_page_cache_control(self):
+        return dict(self.page_cache_control)
+
+    def get_page_validators(self, cache_key, versions):
+        """Returns (ETag, Last-Modified timestamp) of the page, (None, None) if it has no dependency tags.
+        Versions are timestamps of the tags' last changes, so the latest one is the page's last modification.
+        The CSRF cookie is a part of the ETag, as the page's tokens are only valid along with it"""
+        if not versions: return None, None
+        csrf_cookie = self.request.COOKIES.get(settings.CSRF_COOKIE_NAME, '')
+        etag = hashlib.md5(f'{cache_key}:{versions}:{csrf_cookie}'.encode()).hexdigest()
+        return quote_etag(etag), max(versions) // 10 ** 6
+
+    def dispatch(self, request, *args, **kwargs):
+        if not self.is_page_cacheable():
+            response = super().dispatch(request, *args, **kwargs)
+            patch_cache_control(response, private=True, no_cache=True) # e.g. the user's cart is on the page
+            return response
+        cache_key = self.get_page_cache_key()
+        versions = get_versions(self.get_page_cache_tags())
+        etag, last_modified = self.get_page_validators(cache_key, versions)
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified) # 304 (or 412), None if the page has to be sent
+        if response is None:
+            cached_page = cache.get(cache_key)
+            if cached_page and cached_page['versions'] == versions:
+                content = cached_page['content']
+                if self.csrf_token_placeholder in content: # get_token makes the middleware set the CSRF cookie, as the live page would do
+                    content = content.replace(self.csrf_token_placeholder, get_token(request))
+                response = HttpResponse(content, content_type=cached_page['content_type'])
+            else:
+                response = super().dispatch(request, *args, **kwargs)
+                if response.status_code == 200 and not response.streaming:
+                    if hasattr(response, 'render'): response.render() # TemplateResponse
+                    content = self.csrf_token_re.sub(rf'\g<1>{self.csrf_token_placeholder}\g<2>', response.content.decode(response.charset))
+                    cache.set(cache_key, {'versions': versions, 'content': content, 'content_type': response['Content-Type']}, self.page_cache_timeout)
+        if response.status_code in (200, 304):
+            if etag: response['ETag'] = etag
+            if last_modified: response['Last-Modified'] = http_date(last_modified)
+            patch_cache_control(response, **self.get_page_cache_control())
+            patch_vary_headers(response, ('Cookie',))
+        return response
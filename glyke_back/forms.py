@@ -59,6 +59,47 @@ class PhotosForm(forms.Form):
                                                                      'style': "display:none;",
                                                                      'onchange': "previewImages(event)"}))
 
+class ImportProductForm(forms.ModelForm):
+    """Fields of an imported catalogue's row. Rows are cleaned by the fields directly, w/o form instances,
+    and names' uniqueness is checked per batch (see glyke_back.catalogue_io)"""
+    class Meta:
+        model = Product
+        fields = ['name', 'description', 'stock', 'cost_price', 'selling_price', 'discount_percent', 'is_active']
+
+class ImportCatalogueForm(forms.Form):
+    catalogue_file = forms.FileField(label=_('Catalogue file (.csv or .jsonl)'),
+                                     widget=forms.ClearableFileInput(attrs={'class': 'form-control', 'accept': '.csv,.jsonl'}))
+
+    def clean_catalogue_file(self):
+        catalogue_file = self.cleaned_data['catalogue_file']
+        if catalogue_file.name.rsplit('.', 1)[-1].lower() not in ('csv', 'jsonl'):
+            raise forms.ValidationError(_('Only .csv and .jsonl files are supported'))
+        return catalogue_file
+
+class ProductsBulkActionForm(forms.Form):
+    """An action on all the products the staff table is filtered to, see ProductsStaffBulkActionView.
+    Every action but activation/deactivation needs its own value field"""
+    ACTIONS = {'set_discount': 'discount_percent', 'adjust_discount': 'discount_delta', 'change_price': 'price_percent',
+               'activate': None, 'deactivate': None, 'move_category': 'category'}
+    action = forms.ChoiceField(choices=[('set_discount', _('Set discount, %')),
+                                        ('adjust_discount', _('Adjust discount by, %')),
+                                        ('change_price', _('Change selling price by, %')),
+                                        ('activate', _('Activate')),
+                                        ('deactivate', _('Deactivate')),
+                                        ('move_category', _('Move to category'))],
+                               widget=forms.Select(attrs={'class': 'custom-select'}))
+    discount_percent = forms.IntegerField(required=False, min_value=0, max_value=Product.MAX_DISCOUNT_PERCENT)
+    discount_delta = forms.IntegerField(required=False, min_value=-Product.MAX_DISCOUNT_PERCENT, max_value=Product.MAX_DISCOUNT_PERCENT)
+    price_percent = forms.DecimalField(required=False, min_value=-50, max_value=100, max_digits=5, decimal_places=2) # a price can't drop to 0
+    category = forms.ModelChoiceField(required=False, queryset=Category.objects.all(), empty_label='..')
+
+    def clean(self):
+        cleaned_data = super().clean()
+        value_field = self.ACTIONS.get(cleaned_data.get('action'))
+        if value_field and cleaned_data.get(value_field) is None and value_field not in self.errors:
+            self.add_error(value_field, _('This field is required.'))
+        return cleaned_data
+
 class RegisterForm(UserCreationForm):
     class Meta:
         model = User
@@ -0,0 +1,61 @@
+import re
+from django.core.cache import cache
+from django.middleware.csrf import get_token
+from django.template.loader import render_to_string
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+from .caching import get_versions
+from .models import ProductCard
+from .templatetags.glyke_back_extras import remove_all_occ_url_param
+
+
+# per-request parts of a cached card, private use chars are not expected in products' data
+PLACEHOLDERS = {'staff_only_start': '\ue010', 'staff_only_end': '\ue011', 'csrf_token_value': '\ue012',
+                'next_url': '\ue013', 'category_query': '\ue014', 'tag_query': '\ue015'}
+STAFF_ONLY_RE = re.compile(f"{PLACEHOLDERS['staff_only_start']}.*?{PLACEHOLDERS['staff_only_end']}", re.DOTALL)
+TAG_LINK_RE = re.compile(r'<a class="tag-link" href="[^"]*&(tag=[^"]*)">(.*?)</a>')
+
+def get_card_cache_key(product, *, versions):
+    """A card changes whenever the product changes ('product:<id>' version, bumped by sync_products, bulk updates included),
+    or any tags, photos or categories change (namespaces' versions). versions start with the product's one"""
+    return f'product_card:{product.id}:' + ':'.join(str(version) for version in versions)
+
+def render_product_card_list(request, products, *, no_image_url, page_url=None):
+    """Returns a list of html of products' cards (see product_card.html).
+    Cards are cached per product with placeholders for per-request parts, so a warm page is assembled from a single cache multi-get.
+    The cards which aren't cached are rendered from their ProductCard rows (a single query).
+    page_url is the url of the page the cards are shown on, the current one by default"""
+    products = list(products)
+    # products' and namespaces' versions are read with a single cache multi-get
+    versions = get_versions([*(f'product:{product.id}' for product in products), 'product_tags', 'product_photos', 'category_tree'])
+    namespace_versions = versions[len(products):]
+    cache_keys = {product.id: get_card_cache_key(product, versions=[product_version, *namespace_versions]) for product, product_version in zip(products, versions)}
+    cards = cache.get_many(cache_keys.values())
+    missing_products = [product for product in products if cache_keys[product.id] not in cards]
+    if missing_products:
+        product_cards = ProductCard.objects.get_cards([product.id for product in missing_products])
+        missing_cards = {cache_keys[product.id]: render_to_string('product_card.html', {'product': product_cards[product.id], 'no_image_url': no_image_url, **PLACEHOLDERS})
+                         for product in missing_products}
+        cache.set_many(missing_cards, None)
+        cards.update(missing_cards)
+    return [mark_safe(fill_card_placeholders(request, cards[cache_keys[product.id]], page_url=page_url)) for product in products]
+
+def render_product_cards(request, products, *, no_image_url, page_url=None):
+    """Returns html of products' cards, see render_product_card_list"""
+    return mark_safe(''.join(render_product_card_list(request, products, no_image_url=no_image_url, page_url=page_url)))
+
+def fill_card_placeholders(request, html, *, page_url=None):
+    """Fills cards' placeholders in for the current request (and page_url, the current one by default)"""
+    page_url = page_url or request.get_full_path()
+    current_params = page_url.partition('?')[2]
+    if request.user.is_staff:
+        html = html.replace(PLACEHOLDERS['staff_only_start'], '').replace(PLACEHOLDERS['staff_only_end'], '')
+    else:
+        html = STAFF_ONLY_RE.sub('', html)
+    html = html.replace(PLACEHOLDERS['csrf_token_value'], get_token(request)) \
+               .replace(PLACEHOLDERS['next_url'], escape(page_url)) \
+               .replace(PLACEHOLDERS['category_query'], escape(remove_all_occ_url_param(current_params, 'category'))) \
+               .replace(PLACEHOLDERS['tag_query'], escape(remove_all_occ_url_param(current_params, 'page')))
+    # tags which are already filtered by aren't links
+    return TAG_LINK_RE.sub(lambda match: match[2] if match[1] in current_params else match[0], html)
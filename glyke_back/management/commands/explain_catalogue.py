@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from glyke_back.models import Product
+from glyke_back.paginators import KeysetPaginator
+from glyke_back.views import ProductsView
+
+
+def get_catalogue_plans():
+    """Returns {sort mode: [(page, query plan), ...]} of catalogue's first and keyset pages, as the database explains them"""
+    plans = dict()
+    for sort_mode, (label, ordering) in ProductsView.sort_modes.items():
+        paginator = KeysetPaginator(Product.objects.filter(is_active=True), ProductsView.paginate_by, ordering=ordering)
+        last_product = paginator.queryset.first() or Product(id=0, discount_percent=0, stock=0, end_user_price=0, created='2000-01-01')
+        seek_filter = paginator.get_seek_filter([getattr(last_product, field) for field in paginator.fields])
+        plans[sort_mode] = [('first page', paginator.queryset[:paginator.per_page + 1].explain()),
+                            ('keyset page', paginator.queryset.filter(seek_filter)[:paginator.per_page + 1].explain())]
+    return plans
+
+def is_index_plan(plan):
+    """Checks if a plan reads rows in order from an index, with no sorting (SQLite's plan)"""
+    return 'USING INDEX' in plan and 'TEMP B-TREE' not in plan
+
+class Command(BaseCommand):
+    help = "Prints query plans of the catalogue's pages for every sort mode, to check they are read from the indexes with no sorting"
+
+    def handle(self, *args, **options):
+        for sort_mode, plans in get_catalogue_plans().items():
+            for page, plan in plans:
+                status = self.style.SUCCESS('index') if is_index_plan(plan) else self.style.WARNING('NOT index-only')
+                self.stdout.write(f'{sort_mode}, {page}: {status}\n{plan}\n')
+        if connection.vendor != 'sqlite':
+            self.stdout.write(self.style.WARNING('Index checks only parse SQLite plans'))
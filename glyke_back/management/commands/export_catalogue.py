@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from glyke_back.catalogue_io import EXPORT_FORMATS, export_catalogue
+
+
+class Command(BaseCommand):
+    help = "Exports the catalogue (products with category, tags, attributes, prices and photos' urls) as CSV or JSONL, streaming it by batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=EXPORT_FORMATS, default='csv', help='Export format')
+        parser.add_argument('--output', '-o', help='Output file, stdout if none')
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of products read at once')
+        parser.add_argument('--url-prefix', default='', help="Prefix of photos' urls, e.g. https://example.com")
+
+    def handle(self, *args, format, output, batch_size, url_prefix, **options):
+        lines = export_catalogue(format, batch_size=batch_size, url_prefix=url_prefix)
+        if output:
+            with open(output, 'w', encoding='utf-8', newline='') as output_file:
+                output_file.writelines(lines)
+        else:
+            for line in lines: self.stdout.write(line, ending='')
@@ -0,0 +1,27 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from glyke_back.catalogue_io import import_catalogue
+
+
+class Command(BaseCommand):
+    help = "Imports products from a CSV or JSONL catalogue file (as 'export_catalogue' writes it) by batches, invalid rows are reported and skipped"
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Catalogue file')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help="Import format, taken from the file's extension if none")
+        parser.add_argument('--batch-size', type=int, default=500, help='Number of rows validated and inserted at once')
+        parser.add_argument('--created-by', help="Username of the products' creator")
+
+    def handle(self, *args, path, format, batch_size, created_by, **options):
+        import_format = format or path.rsplit('.', 1)[-1].lower()
+        if import_format not in ('csv', 'jsonl'): raise CommandError('Unknown format, use --format')
+        user = None
+        if created_by:
+            user = User.objects.filter(username=created_by).first()
+            if user is None: raise CommandError(f'No user "{created_by}"')
+        with open(path, encoding='utf-8-sig', newline='') as catalogue_file:
+            report = import_catalogue(catalogue_file, import_format, created_by=user, batch_size=batch_size)
+        for error in report['errors']:
+            self.stderr.write(f"row {error['row']}: " + '; '.join(f"{field}: {' '.join(messages)}" for field, messages in error['errors'].items()))
+        self.stdout.write(self.style.SUCCESS(f"{report['created']} products imported, {len(report['errors'])} rows skipped"))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from glyke_back.models import ProductAttributeValue
+
+
+class Command(BaseCommand):
+    help = "Rebuilds the attribute facet index of products' attributes, of all the products or of given ones"
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int, help="Products' ids, all the products if none")
+
+    def handle(self, *args, product_ids, **options):
+        values_count = ProductAttributeValue.objects.rebuild(product_ids or None)
+        self.stdout.write(self.style.SUCCESS(f'{values_count} attribute values indexed'))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from glyke_back.models import Category
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds categories' tree index (path, child_level, ordering_index) from their parents and recounts their active products. "
+            "Runs on its own after migrate if any category has no path")
+
+    def handle(self, *args, **options):
+        Category.objects.rebuild_tree()
+        Category.objects.recount_products()
+        self.stdout.write(self.style.SUCCESS(f'{Category.objects.count()} categories indexed'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from glyke_back.models import ProductCard
+
+
+class Command(BaseCommand):
+    help = "Rebuilds products' cards (the denormalized read model of the catalogue), all of them or of given products"
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int, help="Products' ids, all the products if none")
+
+    def handle(self, *args, product_ids, **options):
+        cards_count = ProductCard.objects.rebuild(product_ids or None)
+        self.stdout.write(self.style.SUCCESS(f'{cards_count} product cards rebuilt'))
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from glyke_back.models import Product, RelatedProduct
+
+
+class Command(BaseCommand):
+    help = ("Rebuilds the related products index, of all the products or of given ones (and of the products similar to them). "
+            "With --changed only the products modified since the last run are rescored, tags' changes are picked up by a full rebuild")
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int, help="Products' ids, all the products if none")
+        parser.add_argument('--changed', action='store_true', help='Rescore the products modified since the last run')
+        parser.add_argument('--top', type=int, default=8, help='Number of related products per product')
+
+    def handle(self, *args, product_ids, changed, top, **options):
+        if changed:
+            last_run = RelatedProduct.objects.aggregate(last_run=Max('created'))['last_run']
+            products = Product.objects.all() if last_run is None else Product.objects.filter(modified__gte=last_run)
+            product_ids = list(products.values_list('id', flat=True))
+            if not product_ids:
+                self.stdout.write(self.style.SUCCESS('No products changed'))
+                return
+        rows_count = RelatedProduct.objects.rebuild(product_ids or None, top_k=top)
+        self.stdout.write(self.style.SUCCESS(f'{rows_count} related products indexed'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from glyke_back.models import Category, Product
+from glyke_back.pricing import reprice_queryset, reprice_file
+
+
+class Command(BaseCommand):
+    help = ("Recomputes end_user_price and profit of products by batches, with the same results as Product.save(). "
+            "Prices are taken from the DB (all the products, given ones or a category's), or set from a CSV or JSONL file of id, cost_price, selling_price, discount_percent")
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int, help="Products' ids, all the products if none")
+        parser.add_argument('--category', type=int, help="Category's id, its descendants' products are repriced as well")
+        parser.add_argument('--file', help='Prices file, an empty or missing price keeps the stored one')
+        parser.add_argument('--format', choices=('csv', 'jsonl'), help="Prices file's format, taken from its extension if none")
+        parser.add_argument('--batch-size', type=int, default=1000, help='Number of products computed and written at once')
+
+    def handle(self, *args, product_ids, category, file, format, batch_size, **options):
+        if file:
+            file_format = format or file.rsplit('.', 1)[-1].lower()
+            if file_format not in ('csv', 'jsonl'): raise CommandError('Unknown format, use --format')
+            with open(file, encoding='utf-8-sig', newline='') as prices_file:
+                report = reprice_file(prices_file, file_format, batch_size=batch_size)
+            for error in report['errors']:
+                self.stderr.write(f"row {error['row']}: " + '; '.join(f"{field}: {' '.join(messages)}" for field, messages in error['errors'].items()))
+        else:
+            products = Product.objects.all()
+            if product_ids: products = products.filter(id__in=product_ids)
+            if category is not None:
+                path = Category.objects.filter(id=category).values_list('path', flat=True).first()
+                if path is None: raise CommandError(f'No category {category}')
+                products = products.filter(category__path__startswith=path)
+            report = reprice_queryset(products, batch_size=batch_size)
+        self.stdout.write(self.style.SUCCESS(f"{report['processed']} products processed, {report['updated']} updated "
+                                             f"in {report['seconds']:.2f}s ({report['per_second']} products/s)"))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from glyke_back.models import OrderLine
+
+
+class Command(BaseCommand):
+    help = ("Copies products' current prices to their lines in current orders (carts) and refreshes the orders' totals, with a fixed number of queries. "
+            "Product changes do it on their own, the command is meant for the prices changed bypassing Product.save() and sync_products")
+
+    def add_arguments(self, parser):
+        parser.add_argument('product_ids', nargs='*', type=int, help="Products' ids, all the products if none")
+
+    def handle(self, *args, product_ids, **options):
+        lines_count = OrderLine.objects.update_current_prices(product_ids or None)
+        self.stdout.write(self.style.SUCCESS(f'{lines_count} cart lines updated'))
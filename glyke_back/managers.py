@@ -1,7 +1,453 @@
-from django.db import models
+import math
+import heapq
+import bisect
+import functools
+import operator
+from decimal import Decimal, ROUND_HALF_UP
+from django.db import models, transaction
+from django.core.cache import cache
+from django.utils import timezone
+from django.db.models import F, Max, Min, Value, Count, Sum, Case, When, IntegerField, DecimalField, ExpressionWrapper, OuterRef, Subquery
+from django.db.models.functions import Concat, Substr, Cast, Round, Greatest, Least, Now
+from django.utils.html import format_html, format_html_join
+
+from .caching import get_version, get_versioned_key, bump_version, get_or_set_two_tier
 
 
 class OrderFiltersManager(models.Manager):
     def get_latest_current(self):
         """Returns the latest order of 'current' status"""
-        return self.filter(status='CUR').order_by('-created').first()
\ No newline at end of file
+        return self.filter(status='CUR').order_by('-created').first()
+
+    def refresh_totals(self, order_ids):
+        """Recounts prices and items_total of orders as Order.save() does, with a single grouped aggregate of their lines and a bulk_update,
+        instead of an Order.save() per order. Meant for the lines' changes made via queryset.update()"""
+        order_line_model = self.model._meta.get_field('order_lines').related_model
+        totals = {row['parent_order_id']: row for row in order_line_model.objects.filter(parent_order_id__in=order_ids).values('parent_order_id')
+                                                                   .annotate(cost_price_sum=Sum('cost_price'), selling_price_sum=Sum('selling_price'),
+                                                                             end_user_price_sum=Sum('end_user_price'), quantity_sum=Sum('quantity'))
+                                                                   .order_by()}
+        quantize = lambda value: Decimal(value).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP) if value else 0
+        orders, now = [], timezone.now()
+        for order_id in order_ids:
+            row = totals.get(order_id, dict())
+            order = self.model(id=order_id,
+                               cost_price=quantize(row.get('cost_price_sum')),
+                               selling_price=quantize(row.get('selling_price_sum')),
+                               end_user_price=quantize(row.get('end_user_price_sum')),
+                               items_total=row.get('quantity_sum') or 0,
+                               modified=now)
+            order.profit = order.end_user_price - order.cost_price
+            orders.append(order)
+        self.bulk_update(orders, ['cost_price', 'selling_price', 'end_user_price', 'profit', 'items_total', 'modified'])
+
+class OrderLineManager(models.Manager):
+    def update_current_prices(self, product_ids=None):
+        """Copies the current prices of products (all of them if None) to their lines in current orders (carts) as OrderLine.save() does,
+        with a single UPDATE, then refreshes the affected orders' totals (see OrderFiltersManager.refresh_totals).
+        Lines of placed orders keep the prices they were ordered at. Returns the number of lines updated"""
+        lines = self.filter(parent_order__status='CUR')
+        if product_ids is not None: lines = lines.filter(product_id__in=product_ids)
+        order_ids = list(lines.values_list('parent_order_id', flat=True).distinct().order_by())
+        if not order_ids: return 0
+        product = self.model._meta.get_field('product').related_model.objects.filter(id=OuterRef('product_id'))
+        line_cents = lambda field: ExpressionWrapper(to_cents(Subquery(product.values(field))) * F('quantity'), output_field=IntegerField())
+        with transaction.atomic():
+            updated = lines.update(cost_price=from_cents(line_cents('cost_price')),
+                                   selling_price=from_cents(line_cents('selling_price')),
+                                   end_user_price=from_cents(line_cents('end_user_price')),
+                                   discount_percent=Subquery(product.values('discount_percent')),
+                                   profit=from_cents(line_cents('end_user_price') - line_cents('cost_price')))
+            self.model._meta.get_field('parent_order').related_model.objects.refresh_totals(order_ids)
+        return updated
+
+def to_cents(expression):
+    """Returns an integer SQL expression of a price in cents (SQLite keeps decimals as floats, so they are rounded)"""
+    return Cast(Round(expression * 100), IntegerField())
+
+def from_cents(expression):
+    """Returns a decimal SQL expression of a price in integer cents. It's divided as a float, so SQLite stores what a saved Decimal would be"""
+    return ExpressionWrapper(expression / 100.0, output_field=DecimalField(max_digits=7, decimal_places=2))
+
+class ProductQuerySet(models.QuerySet):
+    def with_card_data(self):
+        """Fetches everything a product card (or a staff table row) shows: category, main photo, creator, gallery photos and tags.
+        A fixed number of queries, whatever the number of products. Meant for building ProductCard rows"""
+        return self.select_related('category', 'main_photo', 'photos', 'created_by') \
+                   .prefetch_related('photos__photos', 'tags')
+
+    def update_prices(self, *, price_percent=None, discount_percent=None, discount_delta=None):
+        """Changes the selling price by price_percent % (at most 2 decimal places, rounded half-up to cents),
+        sets the discount to discount_percent or adjusts it by discount_delta (within 0-MAX_DISCOUNT_PERCENT) with a single UPDATE.
+        end_user_price and profit are recomputed in SQL in integer cents, rounded as Price.get_end_user_price does,
+        so the results are identical to Price.save(). Returns the number of products updated"""
+        max_discount = self.model.MAX_DISCOUNT_PERCENT
+        new_discount, discount_expression = (lambda discount: discount), F('discount_percent') # a new discount of a stored one
+        if discount_percent is not None:
+            new_discount, discount_expression = (lambda discount: discount_percent), Value(discount_percent)
+        elif discount_delta:
+            new_discount = lambda discount: min(max(discount + discount_delta, 0), max_discount)
+            discount_expression = Greatest(Least(F('discount_percent') + discount_delta, max_discount), 0)
+        selling_cents = to_cents(F('selling_price'))
+        if price_percent:
+            selling_cents = (selling_cents * (10000 + int(price_percent * 100)) + 5000) / 10000 # integer division, half-cents up
+        # the SET clause sees the stored discounts, so the ones which will get a half-cent-down discount are picked in Python
+        half_cent = Case(When(discount_percent__in=[discount for discount in range(max_discount + 1)
+                                                    if new_discount(discount) in self.model.HALF_CENT_DOWN_DISCOUNTS], then=49),
+                         default=50)
+        end_user_cents = (selling_cents * (100 - discount_expression) + half_cent) / 100
+        fields = {'end_user_price': from_cents(end_user_cents), 'profit': from_cents(end_user_cents - to_cents(F('cost_price'))), 'modified': Now()}
+        if price_percent: fields['selling_price'] = from_cents(selling_cents)
+        if discount_percent is not None or discount_delta: fields['discount_percent'] = discount_expression
+        return self.update(**fields)
+
+    def filter_by_tags(self, *, any_tags=(), all_tags=(), no_tags=()):
+        """Filters products by tags using the inverted tag index (see get_tag_index), so there is no join with taggit's table and no DISTINCT.
+        any_tags: a product must have at least one of them (OR)
+        all_tags: a product must have all of them (AND)
+        no_tags: a product must have none of them (NOT)"""
+        queryset = self
+        if not (any_tags or all_tags or no_tags): return queryset
+        tag_index = get_tag_index()
+        if any_tags or all_tags:
+            ids_bitmap = -1 # all bits set, a neutral element for AND
+            if any_tags:
+                ids_bitmap &= functools.reduce(operator.or_, (tag_index.get(tag, 0) for tag in any_tags))
+            for tag in all_tags:
+                ids_bitmap &= tag_index.get(tag, 0)
+            queryset = queryset.filter(id__in=bitmap_to_ids(ids_bitmap))
+        if no_tags:
+            queryset = queryset.exclude(id__in=bitmap_to_ids(functools.reduce(operator.or_, (tag_index.get(tag, 0) for tag in no_tags))))
+        return queryset
+
+    def filter_by_attributes(self, attribute_filters):
+        """Filters products by attributes using the attribute facet index (see ProductAttributeValue).
+        attribute_filters: {attribute: values}, a product must match every attribute, and any of its values, e.g. {'color': ['blue', 'red']}"""
+        from .models import ProductAttributeValue # models import this module
+        queryset = self
+        for attribute, values in attribute_filters.items():
+            attribute_values = ProductAttributeValue.objects.filter(attribute=ProductAttributeValue.normalize(attribute),
+                                                                    value__in=[ProductAttributeValue.normalize(value) for value in values])
+            queryset = queryset.filter(id__in=attribute_values.values('product_id'))
+        return queryset
+
+class ProductCardManager(models.Manager):
+    def get_cards(self, product_ids):
+        """Returns {id: card} of products with given ids, the missing cards are rebuilt first
+        (e.g. 'rebuild_product_cards' command hasn't been run yet)"""
+        product_ids = list(product_ids)
+        cards = self.in_bulk(product_ids)
+        if len(cards) < len(set(product_ids)):
+            self.rebuild([product_id for product_id in product_ids if product_id not in cards])
+            cards = self.in_bulk(product_ids)
+        return cards
+
+    def rebuild(self, product_ids=None):
+        """Rebuilds the cards of products with given ids (or all the cards), products that don't exist anymore lose their cards.
+        A fixed number of queries, whatever the number of products"""
+        from taggit.models import TaggedItem # taggit's models can't be imported while the app registry is loading
+        from photologue.models import Gallery
+        from .models import Product # models import this module
+        # tags and galleries' photos are read from the m2m tables directly, as prefetching them builds a queryset per product
+        products = Product.objects.with_card_data().prefetch_related(None)
+        tagged_items = TaggedItem.objects.filter(content_type__app_label=Product._meta.app_label, content_type__model=Product._meta.model_name)
+        cards = self.all()
+        if product_ids is not None:
+            product_ids = list(product_ids)
+            products = products.filter(id__in=product_ids)
+            tagged_items = tagged_items.filter(object_id__in=product_ids)
+            cards = cards.filter(id__in=product_ids)
+        tags, photos = dict(), dict()
+        for product_id, tag_name in tagged_items.order_by('id').values_list('object_id', 'tag__name'):
+            tags.setdefault(product_id, []).append(tag_name)
+        for gallery_photo in Gallery.photos.through.objects.filter(gallery_id__in=products.values('photos_id')).select_related('photo').order_by('sort_value'):
+            photos.setdefault(gallery_photo.gallery_id, []).append(gallery_photo.photo)
+        new_cards = [self.model.from_product(product, tags=tags.get(product.id, []), photos=photos.get(product.photos_id, [])) for product in products]
+        with transaction.atomic():
+            cards.delete()
+            self.bulk_create(new_cards, batch_size=500)
+        return len(new_cards)
+
+class ProductAttributeValueManager(models.Manager):
+    def rebuild(self, product_ids=None):
+        """Rebuilds the attribute facet index of products with given ids (or of all the products)"""
+        from .models import Product # models import this module
+        products = Product.objects.all()
+        attribute_values = self.all()
+        if product_ids is not None:
+            product_ids = list(product_ids)
+            products = products.filter(id__in=product_ids)
+            attribute_values = attribute_values.filter(product_id__in=product_ids)
+        new_attribute_values = [self.model(product_id=product_id,
+                                           attribute=self.model.normalize(attribute),
+                                           value=self.model.normalize(value),
+                                           display_value=str(value)[:255])
+                                for product_id, attributes in products.values_list('id', 'attributes')
+                                for attribute, value in (attributes or {}).items()
+                                if str(value).strip()]
+        with transaction.atomic():
+            attribute_values.delete()
+            self.bulk_create(new_attribute_values, batch_size=500, ignore_conflicts=True) # attributes differing in case only are merged
+        return len(new_attribute_values)
+
+    def get_facets(self, *, category=None):
+        """Returns {attribute: [{'value', 'display_value', 'count'}, ...]} of active products of the category (and its descendants), or of all the products.
+        A single grouped query, cached until any product is saved or deleted ('products' version is bumped via signals)"""
+        from .models import Category # models import this module
+        def count_facets():
+            attribute_values = self.filter(product__is_active=True)
+            if category:
+                attribute_values = attribute_values.filter(product__category_id__in=Category.objects.get_descendants_ids(category))
+            facets = dict()
+            for facet in attribute_values.values('attribute', 'value').annotate(display_value=Min('display_value'), count=Count('product_id')).order_by('attribute', 'value'):
+                facets.setdefault(facet.pop('attribute'), []).append(facet)
+            return facets
+        # categories' moves change the descendants, so the tree's version is a part of the key as well
+        return cache.get_or_set(get_versioned_key('products', 'facets', get_version('category_tree'), category.id if category else None), count_facets, None)
+
+def bitmap_to_ids(bitmap):
+    """Returns a list of ids set in a bitmap, e.g. [0, 2, 3] for 0b1101"""
+    return [id for id, bit in enumerate(reversed(bin(bitmap)[2:])) if bit == '1']
+
+class RelatedProductManager(models.Manager):
+    """Keeps the precomputed top-K related products of each active product (see RelatedProduct).
+    Similarity is a weighted sum of shared tags, the categories' common path and close attribute values"""
+    tag_weight = 3
+    category_weight = 2
+    attribute_weight = 1
+    # a product is scored against at most this many products per shared feature: the nearest ones by id in the feature's posting list
+    # (half before, half after), so a tag or category shared by the whole catalogue costs as much as a rare one and rebuilds stay linear
+    max_feature_candidates = 100
+
+    def rebuild(self, product_ids=None, *, top_k=8):
+        """Rescores products with given ids (or all the products), along with the products that share a tag, a category or an attribute with them.
+        Loads the whole catalogue's features with 3 queries and writes the rows in a single transaction, returns the number of rows written"""
+        from taggit.models import TaggedItem # taggit's models can't be imported while the app registry is loading
+        from .models import Product, ProductAttributeValue
+        products = dict(Product.objects.filter(is_active=True).values_list('id', 'category__path'))
+        features = {product_id: {'tags': set(), 'path': (path or '').split('/')[:-1], 'attributes': dict()} for product_id, path in products.items()}
+        tagged_items = TaggedItem.objects.filter(content_type__app_label=Product._meta.app_label, content_type__model=Product._meta.model_name)
+        for product_id, tag_id in tagged_items.values_list('object_id', 'tag_id'):
+            if product_id in features: features[product_id]['tags'].add(tag_id)
+        for product_id, attribute, value in ProductAttributeValue.objects.values_list('product_id', 'attribute', 'value'):
+            if product_id in features: features[product_id]['attributes'][attribute] = value
+        # inverted index, products are only scored against the ones sharing a feature with them (capped, see max_feature_candidates)
+        products_by_feature = dict()
+        for product_id in sorted(features):
+            for feature in self.get_index_features(features[product_id]):
+                products_by_feature.setdefault(feature, []).append(product_id) # sorted posting lists
+        half_window = self.max_feature_candidates // 2
+        def get_candidates(product_id):
+            # windows are symmetric (y is x's candidate iff x is y's one), so the products which may list a changed one are its candidates
+            candidates = set()
+            for feature in self.get_index_features(features[product_id]):
+                posting_list = products_by_feature[feature]
+                position = bisect.bisect_left(posting_list, product_id)
+                candidates.update(posting_list[max(position - half_window, 0):position + half_window + 1])
+            return candidates - {product_id}
+        if product_ids is None:
+            rescored_ids = set(features)
+        else:
+            product_ids = set(product_ids)
+            rescored_ids = set(product_ids)
+            for product_id in product_ids & features.keys(): rescored_ids |= get_candidates(product_id)
+            # products which list the given ones, e.g. a product which has been deactivated
+            rescored_ids |= set(self.filter(related_id__in=product_ids).values_list('product_id', flat=True))
+        rows = []
+        for product_id in rescored_ids:
+            if product_id not in features: continue # inactive products have no related ones
+            scores = ((self.get_score(features[product_id], features[candidate_id]), candidate_id) for candidate_id in get_candidates(product_id))
+            for rank, (score, related_id) in enumerate(heapq.nlargest(top_k, (item for item in scores if item[0] > 0), key=lambda item: (item[0], -item[1]))):
+                rows.append(self.model(product_id=product_id, related_id=related_id, score=score, rank=rank))
+        with transaction.atomic():
+            (self.all() if product_ids is None else self.filter(product_id__in=rescored_ids)).delete()
+            self.bulk_create(rows, batch_size=500)
+        bump_version('related_products')
+        return len(rows)
+
+    @staticmethod
+    def get_index_features(product_features):
+        """Returns the inverted index's keys of a product. Categories are indexed by the product's own category and its parent,
+        so the candidates are the products of the same, parent, child and sibling categories, not the whole root category's subtree"""
+        return ([('tag', tag_id) for tag_id in product_features['tags']] +
+                [('category', category_id) for category_id in product_features['path'][-2:]] +
+                [('attribute', attribute, value) for attribute, value in product_features['attributes'].items()])
+
+    def get_score(self, features, other_features):
+        """Returns similarity of two products' features, 0 if they have nothing in common"""
+        score = 0
+        if features['tags'] and other_features['tags']: # cosine similarity of tag sets
+            score += self.tag_weight * len(features['tags'] & other_features['tags']) / (len(features['tags']) * len(other_features['tags'])) ** 0.5
+        if features['path'] and other_features['path']: # share of the categories' common ancestors, 1 for the same category
+            common_path_length = 0
+            for category_id, other_category_id in zip(features['path'], other_features['path']):
+                if category_id != other_category_id: break
+                common_path_length += 1
+            score += self.category_weight * common_path_length / max(len(features['path']), len(other_features['path']))
+        attributes = features['attributes'].keys() | other_features['attributes'].keys()
+        if attributes:
+            closeness = sum(self.get_value_closeness(features['attributes'].get(attribute), other_features['attributes'].get(attribute)) for attribute in attributes)
+            score += self.attribute_weight * closeness / len(attributes)
+        return score
+
+    @staticmethod
+    def get_value_closeness(value, other_value):
+        """1 for equal values, relative closeness for numeric ones (e.g. sizes), 0 otherwise"""
+        if value is None or other_value is None: return 0
+        if value == other_value: return 1
+        try:
+            number, other_number = float(value), float(other_value)
+        except ValueError:
+            return 0
+        if not (math.isfinite(number) and math.isfinite(other_number)): return 0
+        return max(0, 1 - abs(number - other_number) / max(abs(number), abs(other_number)))
+
+def get_tag_index():
+    """Returns an inverted tag index of products: {tag name: bitmap of ids of products tagged with it}.
+    Bitmaps are python ints (bit N is set if product N has the tag), so AND/OR/NOT of tags are plain bitwise operations.
+    Built with a single query, cached until products' tags change ('product_tags' version is bumped via signals)"""
+    def build_tag_index():
+        from taggit.models import TaggedItem # taggit's models can't be imported while the app registry is loading
+        from .models import Product
+        tag_index = dict()
+        tagged_items = TaggedItem.objects.filter(content_type__app_label=Product._meta.app_label, content_type__model=Product._meta.model_name)
+        for tag_name, product_id in tagged_items.values_list('tag__name', 'object_id'):
+            tag_index[tag_name] = tag_index.get(tag_name, 0) | (1 << product_id)
+        return tag_index
+    return get_or_set_two_tier('product_tags', 'index', build_tag_index)
+
+def check_tree_path(path):
+    """Raises ValueError if a category's path is empty (the tree index hasn't been built yet, see 'rebuild_category_tree' command),
+    because path__startswith='' would select all the categories"""
+    if not path: raise ValueError("A category has no path, the tree index has to be rebuilt ('rebuild_category_tree' command)")
+
+class CategoryTreeManager(models.Manager):
+    """Keeps Category's tree index (path, child_level, ordering_index) consistent using set-based updates.
+    Path is a materialized path of ancestors' ids (including the category's own id), e.g. '1/5/12/',
+    so any subtree can be selected with a single path__startswith lookup."""
+    def get_subtree(self, path):
+        """Returns a queryset of the category with given path and all of its descendants"""
+        check_tree_path(path)
+        return self.filter(path__startswith=path)
+
+    def get_descendants_ids(self, category):
+        """Returns a list of ids of the category and all of its descendants.
+        Cached per category until any category is saved or deleted ('category_tree' version is bumped via signals)"""
+        cache_key = get_versioned_key('category_tree', 'descendants', category.id)
+        descendants_ids = cache.get(cache_key)
+        if descendants_ids is None:
+            descendants_ids = list(self.get_subtree(category.path).values_list('id', flat=True))
+            cache.set(cache_key, descendants_ids, None)
+        return descendants_ids
+
+    def get_navigation_tree(self):
+        """Returns a list of active categories ordered by ordering_index, as used for templates' select options.
+        Each category gets an option_label attribute (indented name, pre-rendered HTML).
+        Cached in the process-local and shared caches until any category is saved or deleted, or its active products' counter changes.
+        Counters have their own namespace ('category_counts'), so their changes don't invalidate the other category tree data"""
+        def build_navigation_tree():
+            categories = list(self.filter(is_active=True).order_by('ordering_index'))
+            for category in categories:
+                indent = format_html_join('', "<span class='select-indent'>{}</span>", (('\u00a0' * 4,) for _ in range(category.child_level)))
+                category.option_label = format_html('{}{}', indent, category.name)
+            return categories
+        return get_or_set_two_tier('category_counts', f"navigation:{get_version('category_tree')}", build_navigation_tree)
+
+    def move_subtree(self, *, old_path, new_path, level_delta=0):
+        """Replaces old_path prefix with new_path for the whole subtree and shifts its child_level by level_delta.
+        A single UPDATE statement"""
+        self.get_subtree(old_path).update(path=Concat(Value(new_path), Substr('path', len(old_path) + 1)),
+                                          child_level=F('child_level') + level_delta)
+
+    def get_tree_position(self, category):
+        """Returns the ordering_index the category has to take if its subtree is (re)inserted into the tree.
+        Categories are numerated top down by name as if they were in a fully unrolled list 1 -> 1.1 -> 1.2 -> 1.2.1 -> 1.3 -> 2,
+        so a category goes right after its previous sibling's subtree or right after its parent if there is no such sibling."""
+        check_tree_path(category.path)
+        previous_sibling = self.exclude(path__startswith=category.path) \
+                               .filter(parent_id=category.parent_id, name__lt=category.name) \
+                               .order_by('-name').first()
+        if previous_sibling:
+            return self.get_subtree(previous_sibling.path).aggregate(Max('ordering_index'))['ordering_index__max'] + 1
+        if category.parent_id:
+            return self.filter(id=category.parent_id).values_list('ordering_index', flat=True).get() + 1
+        return 1 # top-lvl-category, first by name
+
+    def reposition_subtree(self, category, *, previous_index=None):
+        """Moves the category's subtree to its place in the ordering_index sequence. Returns category's new ordering_index.
+        previous_index is the current ordering_index of the category (None if it has just been created).
+        Only the categories between the old and the new positions are shifted, each shift is a single F() update."""
+        subtree = self.get_subtree(category.path)
+        rest = self.exclude(path__startswith=category.path)
+        subtree_size = subtree.count() if previous_index is not None else 1 # a just created category has no children yet
+        if previous_index is not None: # close the gap the subtree leaves behind
+            rest.filter(ordering_index__gt=previous_index).update(ordering_index=F('ordering_index') - subtree_size)
+        new_index = self.get_tree_position(category)
+        rest.filter(ordering_index__gte=new_index).update(ordering_index=F('ordering_index') + subtree_size)
+        if previous_index is None:
+            subtree.update(ordering_index=new_index)
+        else:
+            subtree.update(ordering_index=F('ordering_index') - previous_index + new_index)
+        return new_index
+
+    def sort_children(self, parent_id, parent_path):
+        """Reorders the subtrees of a category's children (top-lvl-categories if parent_id is None) by name, e.g. after some of them have been reparented.
+        Every subtree is contiguous and moves as a whole, so the new indices are computed from the children's rows only
+        and written with a single UPDATE (a shift per moved subtree). 3 statements, whatever the number of children"""
+        children = list(self.filter(parent_id=parent_id).order_by('ordering_index').values('name', 'path', 'ordering_index'))
+        if not children: return
+        subtree_end = self.filter(path__startswith=parent_path).aggregate(Max('ordering_index'))['ordering_index__max'] + 1
+        for child, next_child in zip(children, children[1:] + [{'ordering_index': subtree_end}]):
+            child['size'] = next_child['ordering_index'] - child['ordering_index']
+        shifts, next_index = [], children[0]['ordering_index']
+        for child in sorted(children, key=lambda child: child['name']):
+            if next_index != child['ordering_index']:
+                shifts.append(When(path__startswith=child['path'], then=F('ordering_index') + next_index - child['ordering_index']))
+            next_index += child['size']
+        if shifts:
+            self.filter(path__startswith=parent_path).update(ordering_index=Case(*shifts, default=F('ordering_index')))
+
+    def update_active_products_count(self, category_id, delta):
+        """Adds delta to active_products_count of the category and all of its ancestors (a single UPDATE, ids are taken from the path)"""
+        if not category_id: return
+        path = self.filter(id=category_id).values_list('path', flat=True).first()
+        if path:
+            self.filter(id__in=[int(ancestor_id) for ancestor_id in path.split('/')[:-1]]).update(active_products_count=F('active_products_count') + delta)
+            bump_version('category_counts') # counters are shown with the cached navigation tree only, see get_navigation_tree
+
+    def recount_products(self):
+        """Recalculates active_products_count of all categories from scratch with a single grouped query.
+        Meant for the changes made via queryset.update() or bulk_create(), which don't go through Product.save()"""
+        product_model = self.model._meta.get_field('products').related_model
+        direct_counts = dict(product_model.objects.filter(is_active=True, category__isnull=False)
+                                                  .values_list('category_id').annotate(Count('id')).order_by())
+        categories = list(self.all())
+        counts = dict.fromkeys((category.id for category in categories), 0)
+        for category in categories:
+            for ancestor_id in category.path.split('/')[:-1]:
+                counts[int(ancestor_id)] += direct_counts.get(category.id, 0)
+        for category in categories:
+            category.active_products_count = counts[category.id]
+        self.bulk_update(categories, ['active_products_count'])
+        bump_version('category_counts')
+
+    def rebuild_tree(self):
+        """Recalculates path, child_level and ordering_index of all categories from their parents in a single pass.
+        Meant for the data created before the tree index existed (or changed via queryset.update())."""
+        categories = list(self.all().order_by('name'))
+        children = dict()
+        for category in categories:
+            children.setdefault(category.parent_id, []).append(category)
+        next_index = 1
+        def numerate_recur(category, parent_path, child_level):
+            nonlocal next_index
+            category.path = f'{parent_path}{category.id}/'
+            category.child_level = child_level
+            category.ordering_index = next_index
+            next_index += 1
+            for child_category in children.get(category.id, []):
+                numerate_recur(child_category, category.path, child_level + 1)
+        for top_lvl_category in children.get(None, []):
+            numerate_recur(top_lvl_category, '', 0)
+        self.bulk_update(categories, ['path', 'child_level', 'ordering_index'])
+        bump_version('category_tree') # bulk_update doesn't send any signals
@@ -1,5 +1,6 @@
 import os
-from django.db import models
+from django.db import models, transaction
+from django.db.models import F, Q
 from django.utils import timezone, dateformat
 from django.utils.text import slugify
 from django.utils.translation import gettext_lazy as _
@@ -16,7 +17,9 @@ from django.core.files.temp import NamedTemporaryFile
 from proj_folio.settings import MEDIA_ROOT
 
 from photologue import models as photo_models
-from .managers import OrderFiltersManager
+from .managers import OrderFiltersManager, CategoryTreeManager, ProductQuerySet, ProductCardManager, ProductAttributeValueManager, RelatedProductManager, OrderLineManager
+from .caching import get_or_set_two_tier
+from .templatetags.glyke_back_extras import photo_size_url
 
 
 def get_deleted_instance(model):
@@ -51,7 +54,8 @@ def get_upload_dir(base_dir, no_file_name=''):
 
 
 class Category(TimeStampedModel):
-    __original_name = None # an attribute to keep track on the previous name when changed
+    objects = CategoryTreeManager() # this manager keeps the tree index (path, child_level, ordering_index) up to date
+
     name = models.CharField(_('name'), max_length=255, unique=True)
     description = models.TextField(_('description'), max_length=1000, blank=True)
     parent = models.ForeignKey('self',
@@ -67,6 +71,15 @@ class Category(TimeStampedModel):
                                       validators=[MinValueValidator(1)],
                                       blank=True,
                                       null=True)
+    path = models.CharField(_('path'), # materialized path of ancestors' ids, e.g. '1/5/12/'. Updated via CategoryTreeManager
+                            max_length=255,
+                            blank=True,
+                            editable=False,
+                            db_index=True)
+    active_products_count = models.IntegerField(_('active products count'), # active products of the category and all of its descendants
+                                                validators=[MinValueValidator(0)],
+                                                default=0,
+                                                editable=False)
     is_active = models.BooleanField(_('is active'), default=True)
     picture = models.ImageField(_('picture'),
                                 default = get_upload_dir('category', no_file_name='no_image.png'),
@@ -87,44 +100,64 @@ class Category(TimeStampedModel):
     def __str__(self):
         return self.name
 
-    def __init__(self, *args, **kwargs):
-        """__init__ is overridden to track self.name changes"""
-        super().__init__(*args, **kwargs)
-        self.__original_name = self.name
+    def get_ancestors_ids(self):
+        """Returns a list of the category's ancestors' ids (top-lvl-category first), taken from the path (no queries)"""
+        return [int(ancestor_id) for ancestor_id in self.path.split('/')[:-2]]
+
+    def get_ancestors(self, include_self=False):
+        """Returns a list of the category's ancestors, top-lvl-category first (e.g. for breadcrumbs).
+        A single query per category, cached until any category is saved or deleted ('category_tree' version)"""
+        ancestors = get_or_set_two_tier('category_tree', f'ancestors:{self.id}',
+                                        lambda: list(Category.objects.filter(id__in=self.get_ancestors_ids()).order_by('child_level')))
+        return ancestors + [self] if include_self else ancestors
+
+    def get_descendants(self, include_self=False):
+        """Returns a queryset of the category's descendants (ordered by ordering_index), based on the cached descendants' ids"""
+        descendants_ids = Category.objects.get_descendants_ids(self)
+        if not include_self: descendants_ids = [category_id for category_id in descendants_ids if category_id != self.id]
+        return Category.objects.filter(id__in=descendants_ids)
 
     def save(self, *args, **kwargs):
-        """Updates child_level based on how many ancestor "levels" does the current instance have.
+        """Updates child_level based on how many ancestor "levels" does the current instance have (taken from the parent's path, a single lookup).
         Ordering_index is used for sorting in templates (basically categories are numerated top down as if they were in a fully unrolled list 1 -> 1.1 -> 1.2 -> 1.2.1 -> 1.3 -> 2)
-        Update instance's ordering_index aftercalling super().save()"""
-        just_created = False if self.pk else True
-        # child_level block
-        self.child_level = 0 # top-lvl-categories are 0
-        current_parent = self.parent
-        while True:
-            if not current_parent: break
-            self.child_level += 1
-            current_parent = current_parent.parent
-        super().save(*args, **kwargs)
-
-        # ordering_index block
-        if just_created or self.name != self.__original_name: # update all ordering_indices if a new category was created or any category got renamed
-            indiced_order_by = 'name' # basic ordering for ordering_indices
-            self.next_index = 1 # starting from 1
-            def numerate_category_recur(current_parrent_cat):
-                if current_parrent_cat.ordering_index != self.next_index:
-                    # do not disturb the DB if an instance's ordering_index doesn't have to be updated
-                    current_parrent_cat.ordering_index = self.next_index
-                    current_parrent_cat.save()
-                self.next_index += 1
-                if current_parrent_cat.child_categories.exists():
-                    for child_category in current_parrent_cat.child_categories.order_by(indiced_order_by):
-                        numerate_category_recur(child_category)
-
-            # start from top-lvl-categories and proceed recursively through all their children
-            for parent_category in Category.objects.filter(parent__isnull=True).order_by(indiced_order_by):
-                numerate_category_recur(parent_category)
+        Path, child_level and ordering_index are taken from the DB (never overwritten with stale values) and updated via CategoryTreeManager
+        only if the instance has been created, renamed or moved: only its subtree and the categories between its old and new positions are updated."""
+        with transaction.atomic():
+            tree_state = Category.objects.filter(id=self.id).values('path', 'child_level', 'ordering_index', 'parent_id', 'name', 'active_products_count').first() if self.pk else None
+            just_created = tree_state is None
+            if not just_created:
+                self.path, self.child_level, self.ordering_index = tree_state['path'], tree_state['child_level'], tree_state['ordering_index']
+                self.active_products_count = tree_state['active_products_count']
+            moved = not just_created and tree_state['parent_id'] != self.parent_id
+            renamed = not just_created and tree_state['name'] != self.name
+            # child_level block
+            if just_created or moved:
+                parent_path = Category.objects.filter(id=self.parent_id).values_list('path', flat=True).first() or ''
+                self.child_level = parent_path.count('/') # top-lvl-categories are 0
+
+            # path block: the whole subtree of a moved category is switched to the new parent's path
+            if moved:
+                # its active products leave the old ancestors and join the new ones
+                Category.objects.filter(id__in=self.get_ancestors_ids()).update(active_products_count=F('active_products_count') - self.active_products_count)
+                Category.objects.filter(id__in=[int(ancestor_id) for ancestor_id in parent_path.split('/')[:-1]]).update(active_products_count=F('active_products_count') + self.active_products_count)
+                new_path = f'{parent_path}{self.id}/'
+                Category.objects.move_subtree(old_path=self.path, new_path=new_path, level_delta=self.child_level - tree_state['child_level'])
+                self.path = new_path
+            super().save(*args, **kwargs)
+            if just_created: # path contains the instance's id, so it's only available after the first save
+                self.path = f'{parent_path}{self.id}/'
+                Category.objects.filter(id=self.id).update(path=self.path)
+
+            # ordering_index block
+            if just_created or moved or renamed:
+                self.ordering_index = Category.objects.reposition_subtree(self, previous_index=None if just_created else self.ordering_index)
 
 class Price(models.Model):
+    MAX_DISCOUNT_PERCENT = 80
+    # discounts whose factor Decimal(1 - discount_percent / 100) is a bit less than the exact one (it's a binary float),
+    # so get_end_user_price rounds their half-cents down, e.g. 10.10 with 15% off is 8.58. Bulk updates in SQL have to do the same
+    HALF_CENT_DOWN_DISCOUNTS = frozenset(discount for discount in range(101) if Decimal(1 - discount / 100) < Decimal(100 - discount) / 100)
+
     cost_price = models.DecimalField(_('cost price'),
                                      max_digits=7,
                                      decimal_places=2,
@@ -137,7 +170,7 @@ class Price(models.Model):
                                         default=0)
     discount_percent = models.IntegerField(_('discount, %'),
                                            validators=[MinValueValidator(0),
-                                           MaxValueValidator(80)],
+                                           MaxValueValidator(MAX_DISCOUNT_PERCENT)],
                                            default=0)
     end_user_price = models.DecimalField(_('end user price'),
                                          max_digits=7,
@@ -151,12 +184,20 @@ class Price(models.Model):
 
     def save(self, *args, **kwargs):
         # recount profit and end_user_price on save
-        self.end_user_price = self.selling_price * Decimal(1 - self.discount_percent / 100)
-        self.end_user_price = Decimal(self.end_user_price).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        self.end_user_price = self.get_end_user_price(self.selling_price, self.discount_percent)
         self.profit = self.end_user_price - self.cost_price
         super().save(*args, **kwargs)
 
+    @staticmethod
+    def get_end_user_price(selling_price, discount_percent):
+        """Returns the selling price with the discount off, rounded to cents.
+        Is also used by the bulk operations, which don't go through save()"""
+        end_user_price = selling_price * Decimal(1 - discount_percent / 100)
+        return Decimal(end_user_price).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
 class Product(Price, TimeStampedModel):
+    objects = ProductQuerySet.as_manager() # this manager adds with_card_data method, which is needed for the catalogue templates
+
     __original_name = None # an attribute to keep track on the previous name when changed
     name = models.CharField(_('name'), max_length=255, unique=True)
     description = models.TextField(_('description'), max_length=3000, blank=True)
@@ -182,15 +223,28 @@ class Product(Price, TimeStampedModel):
                                       null=True)
     attributes = models.JSONField(_('attributes'), blank = True, null=True)
 
+    class Meta:
+        # partial indexes of active products, one per catalogue's sort mode (see ProductsView.sort_modes),
+        # so any page (keyset ones included, see KeysetPaginator) is read straight from an index, with no sorting
+        indexes = [
+            models.Index(fields=['-discount_percent', '-stock', 'id'], condition=Q(is_active=True), name='product_discount_idx'),
+            models.Index(fields=['end_user_price', 'id'], condition=Q(is_active=True), name='product_price_idx'),
+            models.Index(fields=['-created', '-id'], condition=Q(is_active=True), name='product_newest_idx'),
+            models.Index(fields=['-stock', 'id'], condition=Q(is_active=True), name='product_stock_idx'),
+        ]
+
     def __str__(self):
         return self.name
 
     def __init__(self, *args, **kwargs):
-        """__init__ is overridden to track self.name changes"""
+        """__init__ is overridden to track self.name, self.category and self.is_active changes"""
         super().__init__(*args, **kwargs)
         self.__original_name = self.name
+        self.__original_category_id = self.category_id
+        self.__original_is_active = self.is_active
 
     def save(self, *args, **kwargs):
+        just_created = False if self.pk else True
         # main_photo block: update main_photo
         try:# check if main_photo is None or has just been deleted (DoesNotExist is raised)
             if not self.main_photo: raise photo_models.Photo.DoesNotExist
@@ -207,8 +261,17 @@ class Product(Price, TimeStampedModel):
             self.photos.save()
         # status block: products with no selling price cannot be shown or added to cart, therefor should be marked as inactive
         if self.selling_price <= 0: self.is_active = False
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
+            # active products counters block: the product leaves its previous category's counters and joins the current one's
+            if just_created or (self.category_id, self.is_active) != (self.__original_category_id, self.__original_is_active):
+                if not just_created and self.__original_is_active:
+                    Category.objects.update_active_products_count(self.__original_category_id, -1)
+                if self.is_active:
+                    Category.objects.update_active_products_count(self.category_id, 1)
         self.__original_name = self.name
+        self.__original_category_id = self.category_id
+        self.__original_is_active = self.is_active
 
     def add_images_from_url(self, *, url_list):
         """Saves images from url_list to photologue/photos folder, then creates photologue photo instances of them and assignes them to the current product instance"""
@@ -226,6 +289,110 @@ class Product(Price, TimeStampedModel):
             photo = photo_models.Photo.objects.create(image=image_file, title=image_name, slug=slugify(image_name))
             self.photos.photos.add(photo)
 
+class ProductCard(models.Model):
+    """A denormalized read model of a product: everything its catalogue card or staff table row shows, in a single row.
+    id is the product's id. Kept in sync via signals (see ProductCardManager), can be rebuilt with 'rebuild_product_cards' command"""
+    objects = ProductCardManager()
+
+    id = models.BigIntegerField(primary_key=True)
+    name = models.CharField(max_length=255)
+    description = models.TextField(blank=True)
+    is_active = models.BooleanField(default=True)
+    stock = models.IntegerField(default=0)
+    cost_price = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+    selling_price = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+    discount_percent = models.IntegerField(default=0)
+    end_user_price = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+    profit = models.DecimalField(max_digits=7, decimal_places=2, default=0)
+    category_id = models.BigIntegerField(blank=True, null=True, db_index=True)
+    category_name = models.CharField(max_length=255, blank=True)
+    category_bg_color = models.CharField(max_length=50, blank=True)
+    main_photo_url = models.CharField(max_length=255, blank=True)
+    photos = models.JSONField(default=list) # a list of {'title', 'url', 'display_url', 'thumbnail_url'} of all the gallery's photos
+    tags = models.JSONField(default=list) # a list of tags' names
+    created_by_id = models.BigIntegerField(blank=True, null=True, db_index=True)
+    created_by_username = models.CharField(max_length=150, blank=True)
+    created = models.DateTimeField()
+    modified = models.DateTimeField()
+
+    def __str__(self):
+        return self.name
+
+    @classmethod
+    def from_product(cls, product, *, tags=None, photos=None):
+        """Returns an unsaved card of a product fetched with ProductQuerySet.with_card_data(), tags' names and gallery's photos may be given instead"""
+        if photos is None: photos = product.photos.photos.all() if product.photos else []
+        return cls(id=product.id,
+                   name=product.name,
+                   description=product.description,
+                   is_active=product.is_active,
+                   stock=product.stock,
+                   cost_price=product.cost_price,
+                   selling_price=product.selling_price,
+                   discount_percent=product.discount_percent,
+                   end_user_price=product.end_user_price,
+                   profit=product.profit,
+                   category_id=product.category_id,
+                   category_name=product.category.name if product.category else '',
+                   category_bg_color=(product.category.bg_color or '') if product.category else '',
+                   main_photo_url=product.main_photo.image.url if product.main_photo else '',
+                   photos=[{'id': photo.id,
+                            'title': photo.title,
+                            'url': photo.image.url,
+                            'display_url': photo_size_url(photo, 'display'),
+                            'thumbnail_url': photo_size_url(photo, 'thumbnail')} for photo in photos],
+                   tags=[tag.name for tag in product.tags.all()] if tags is None else tags,
+                   created_by_id=product.created_by_id,
+                   created_by_username=product.created_by.username if product.created_by else '',
+                   created=product.created,
+                   modified=product.modified)
+
+    @property
+    def other_photos(self):
+        """Up to 4 gallery's photos except for the main one, as shown on a catalogue card"""
+        return [photo for photo in self.photos[:4] if photo['url'] != self.main_photo_url]
+
+class ProductAttributeValue(models.Model):
+    """An attribute facet index of products: a row per (attribute, value) of Product.attributes, both normalized (see normalize).
+    Kept in sync on Product save (see ProductAttributeValueManager)"""
+    objects = ProductAttributeValueManager()
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='attribute_values')
+    attribute = models.CharField(max_length=255)
+    value = models.CharField(max_length=255)
+    display_value = models.CharField(max_length=255) # the value as it was entered
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['product', 'attribute'], name='unique_product_attribute')]
+        indexes = [models.Index(fields=['attribute', 'value', 'product'], name='attribute_value_product_idx')]
+
+    def __str__(self):
+        return f'{self.attribute}: {self.display_value}'
+
+    @staticmethod
+    def normalize(text):
+        """Attributes and values are matched case-insensitively and regardless of extra whitespace"""
+        return ' '.join(str(text).split()).lower()[:255]
+
+class RelatedProduct(models.Model):
+    """Precomputed top-K related products of a product, ranked by similarity score (see RelatedProductManager).
+    Related products are read from their cards, so a product's related ones take a single indexed lookup"""
+    objects = RelatedProductManager()
+
+    product = models.ForeignKey(Product, on_delete=models.CASCADE, related_name='related_products')
+    # cards are rebuilt by delete and insert, so there's no constraint, rows of deleted cards are left out by the join
+    related = models.ForeignKey(ProductCard, on_delete=models.DO_NOTHING, db_constraint=False, related_name='+')
+    score = models.FloatField()
+    rank = models.PositiveSmallIntegerField()
+    created = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields=['product', 'related'], name='unique_related_product')]
+        indexes = [models.Index(fields=['product', 'rank'], name='related_product_rank_idx')]
+
+    def __str__(self):
+        return f'{self.product_id} -> {self.related_id} ({self.score:.2f})'
+
 class Order(Price, TimeStampedModel):
     """Prices represent the total value of an order
     Discount is removed"""
@@ -291,6 +458,8 @@ class Order(Price, TimeStampedModel):
 class OrderLine(Price):
     """Prices represent the aggregate value for a line (product.price * quantity)
     Discount stays untouched"""
+    objects = OrderLineManager() # this manager adds update_current_prices method, which keeps carts' prices up to date in bulk
+
     parent_order = models.ForeignKey(Order,
                                      on_delete=models.CASCADE,
                                      verbose_name=_('order'),
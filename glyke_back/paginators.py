@@ -0,0 +1,146 @@
+import base64
+import binascii
+import datetime
+import json
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.paginator import Paginator, Page, EmptyPage, PageNotAnInteger
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.utils.functional import cached_property
+from django.utils.translation import gettext_lazy as _
+
+
+class CursorJSONEncoder(DjangoJSONEncoder):
+    """Encodes datetimes with microseconds, which DjangoJSONEncoder truncates to milliseconds:
+    a truncated sort key value would make a keyset page skip the rows of the same millisecond"""
+    def default(self, o):
+        if isinstance(o, datetime.datetime): return o.isoformat()
+        return super().default(o)
+
+def encode_cursor(values):
+    """Returns an opaque url-safe cursor of given sort key values"""
+    return base64.urlsafe_b64encode(json.dumps(values, cls=CursorJSONEncoder).encode()).decode()
+
+def decode_cursor(cursor):
+    """Returns a list of sort key values from a cursor made by encode_cursor. Raises ValueError if the cursor is invalid"""
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, UnicodeDecodeError, json.JSONDecodeError) as error:
+        raise ValueError('Invalid cursor') from error
+    if not isinstance(values, list): raise ValueError('Invalid cursor')
+    return values
+
+class KeysetPage:
+    """A page of KeysetPaginator. Mimics django's Page as far as the templates need it"""
+    is_keyset = True
+
+    def __init__(self, object_list, *, next_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return False # a cursor only points forward
+
+class KeysetPaginator:
+    """Keyset (seek) paginator: instead of COUNT(*) and OFFSET, every page is selected with a WHERE on the sort key of the previous page's last row.
+    Ordering has to be unique (end with 'id'), e.g. ('-discount_percent', '-stock', 'id'), and is expected to be backed by a matching index,
+    so any page costs the same as the first one."""
+    def __init__(self, queryset, per_page, *, ordering):
+        self.queryset = queryset.order_by(*ordering)
+        self.per_page = per_page
+        self.ordering = ordering
+        self.fields = [field.lstrip('-') for field in ordering]
+
+    def get_seek_filter(self, values):
+        """Returns a Q object selecting the rows going after the row with given sort key values,
+        e.g. a <= 1 AND ((a < 1) OR (a = 1 AND b > 2) OR (a = 1 AND b = 2 AND id > 3)) for ('-a', 'b', 'id').
+        The redundant bound of the first field lets the database seek the index instead of scanning it from the start.
+        Raises ValueError if the values don't fit the fields"""
+        if len(values) != len(self.ordering): raise ValueError('Invalid cursor')
+        try: # a cursor comes from the url, its values are cleaned as the model's fields (a wrong type, None, out of range)
+            values = [self.queryset.model._meta.get_field(field).clean(value, None) for field, value in zip(self.fields, values)]
+        except (ValidationError, TypeError) as error:
+            raise ValueError('Invalid cursor') from error
+        if any(isinstance(value, int) and not -2 ** 63 <= value < 2 ** 63 for value in values): # no database integer is bigger
+            raise ValueError('Invalid cursor')
+        seek_filter = Q()
+        for i, field in enumerate(self.ordering):
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            equal_fields = dict(zip(self.fields[:i], values[:i]))
+            seek_filter |= Q(**equal_fields, **{f'{self.fields[i]}__{lookup}': values[i]})
+        first_field_bound = Q(**{f"{self.fields[0]}__{'lte' if self.ordering[0].startswith('-') else 'gte'}": values[0]})
+        return first_field_bound & seek_filter
+
+    def get_page(self, cursor=None):
+        """Returns a KeysetPage going after the cursor (the first page if there is no cursor).
+        Raises ValueError if the cursor is invalid"""
+        queryset = self.queryset
+        if cursor:
+            queryset = queryset.filter(self.get_seek_filter(decode_cursor(cursor)))
+        object_list = list(queryset[:self.per_page + 1]) # one extra row tells if there is a next page
+        next_cursor = None
+        if len(object_list) > self.per_page:
+            object_list = object_list[:self.per_page]
+            next_cursor = encode_cursor([getattr(object_list[-1], field) for field in self.fields])
+        return KeysetPage(object_list, next_cursor=next_cursor)
+
+class EstimatedCountPage(Page):
+    """A page of CachedCountPaginator whose count is estimated: whether there is a next page is told by an extra row, not by the count"""
+    def __init__(self, object_list, number, paginator, *, has_next):
+        super().__init__(object_list, number, paginator)
+        self._has_next = has_next
+
+    def has_next(self):
+        return self._has_next
+
+class CachedCountPaginator(Paginator):
+    """Paginator which caches its count under count_cache_key (if given) for count_cache_timeout seconds.
+    Counts only up to count_threshold + 1 rows (if given): bigger counts are estimated as count_threshold + 1, is_count_estimated is set then,
+    so a count query never reads more than count_threshold + 1 rows.
+    An estimated count doesn't limit the pages: any page number is valid, a page fetches one extra row to tell if there is a next one"""
+    def __init__(self, object_list, per_page, *, count_cache_key=None, count_threshold=None, count_cache_timeout=60, **kwargs):
+        super().__init__(object_list, per_page, **kwargs)
+        self.count_cache_key = count_cache_key
+        self.count_threshold = count_threshold
+        self.count_cache_timeout = count_cache_timeout
+        self.is_count_estimated = False
+
+    @cached_property
+    def count(self):
+        cached_count = cache.get(self.count_cache_key) if self.count_cache_key else None
+        if cached_count is None:
+            if self.count_threshold is None:
+                cached_count = (super().count, False)
+            else:
+                count = self.object_list.order_by()[:self.count_threshold + 1].count() # COUNT(*) over a LIMIT subquery
+                cached_count = (count, count > self.count_threshold)
+            if self.count_cache_key: cache.set(self.count_cache_key, cached_count, self.count_cache_timeout)
+        count, self.is_count_estimated = cached_count
+        return count
+
+    def validate_number(self, number):
+        if not (self.count and self.is_count_estimated): return super().validate_number(number)
+        try:
+            number = int(number)
+        except (TypeError, ValueError):
+            raise PageNotAnInteger(_('That page number is not an integer'))
+        if number < 1: raise EmptyPage(_('That page number is less than 1'))
+        return number
+
+    def page(self, number):
+        number = self.validate_number(number)
+        if not self.is_count_estimated: return super().page(number)
+        bottom = (number - 1) * self.per_page
+        object_list = list(self.object_list[bottom:bottom + self.per_page + 1]) # one extra row tells if there is a next page
+        if not object_list and number > 1: raise EmptyPage(_('That page contains no results'))
+        return EstimatedCountPage(object_list[:self.per_page], number, self, has_next=len(object_list) > self.per_page)
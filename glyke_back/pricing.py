@@ -0,0 +1,130 @@
+import time
+from decimal import Decimal
+from itertools import islice
+from django.db import transaction
+from django.utils import timezone
+from django.core.exceptions import ValidationError
+from django.utils.translation import gettext as _
+
+from .models import Category, Price, Product
+from .forms import ImportProductForm
+from .signals import sync_products
+from .catalogue_io import iter_rows
+
+
+# fields a repricing reads and writes, is_active is switched off for products w/o a selling price as Product.save() does
+PRICE_FIELDS = ('cost_price', 'selling_price', 'discount_percent', 'end_user_price', 'profit', 'is_active')
+LOADED_FIELDS = ('id', 'name', 'category_id', *PRICE_FIELDS) # Product.__init__ reads name and category_id
+REPRICE_FILE_FIELDS = ('cost_price', 'selling_price', 'discount_percent') # besides 'id', an empty or missing one keeps the stored value
+
+def get_end_user_cents(selling_cents, discount_percent):
+    """Returns Price.get_end_user_price in integer cents, which is an order of magnitude faster than Decimal arithmetic.
+    Half-cents round up, except for HALF_CENT_DOWN_DISCOUNTS, so the results are identical"""
+    if selling_cents < 0 or not 0 <= discount_percent <= 100: # invalid prices aren't worth a shortcut
+        return int(Price.get_end_user_price(Decimal(selling_cents) / 100, discount_percent) * 100)
+    half_cent = 49 if discount_percent in Price.HALF_CENT_DOWN_DISCOUNTS else 50
+    return (selling_cents * (100 - discount_percent) + half_cent) // 100
+
+def reprice_batch(products, *, changed_ids=()):
+    """Recomputes end_user_price, profit (and is_active) of product instances in place.
+    Returns the ones that have changed, the ones with changed_ids (e.g. their prices have been set) are returned anyway"""
+    changed_products = []
+    for product in products:
+        end_user_cents = get_end_user_cents(int(product.selling_price * 100), product.discount_percent)
+        end_user_price = Decimal(end_user_cents) / 100
+        profit = Decimal(end_user_cents - int(product.cost_price * 100)) / 100
+        is_active = product.is_active and product.selling_price > 0
+        if (end_user_price, profit, is_active) != (product.end_user_price, product.profit, product.is_active) or product.id in changed_ids:
+            product.end_user_price, product.profit, product.is_active = end_user_price, profit, is_active
+            changed_products.append(product)
+    return changed_products
+
+def reprice(batches, *, changed_ids=()):
+    """Reprices batches of product instances (see reprice_batch) and writes the changed ones back with bulk_update in a single transaction.
+    Then category counters are recounted (if any product got deactivated) and the products' derived data is synced.
+    Returns {'processed', 'updated', 'seconds' the transaction took, 'per_second' products processed}"""
+    report = {'processed': 0, 'updated': 0}
+    started = time.perf_counter()
+    updated_ids, is_active_changed = [], False
+    with transaction.atomic():
+        for batch in batches:
+            was_active = {product.id: product.is_active for product in batch}
+            changed_products = reprice_batch(batch, changed_ids=changed_ids)
+            modified = timezone.now() # bulk_update() doesn't set it, as Product.save() does
+            for product in changed_products: product.modified = modified
+            Product.objects.bulk_update(changed_products, (*PRICE_FIELDS, 'modified'))
+            report['processed'] += len(batch)
+            updated_ids += [product.id for product in changed_products]
+            is_active_changed = is_active_changed or any(product.is_active != was_active[product.id] for product in changed_products)
+        if is_active_changed: Category.objects.recount_products()
+    report['updated'] = len(updated_ids)
+    report['seconds'] = time.perf_counter() - started
+    report['per_second'] = round(report['processed'] / report['seconds']) if report['seconds'] else 0
+    if updated_ids: sync_products(updated_ids)
+    return report
+
+def iter_batches(items, batch_size):
+    items = iter(items)
+    while True:
+        batch = list(islice(items, batch_size))
+        if not batch: return
+        yield batch
+
+def iter_queryset_batches(queryset, batch_size):
+    """Yields batches of a queryset's products with the price fields only, a query per batch.
+    Batches are read by id ranges (not by a server-side cursor), so they can be written back while reading"""
+    queryset, last_id = queryset.only(*LOADED_FIELDS).order_by('id'), 0
+    while True:
+        batch = list(queryset.filter(id__gt=last_id)[:batch_size])
+        if not batch: return
+        yield batch
+        last_id = batch[-1].id
+
+def reprice_queryset(queryset, *, batch_size=1000):
+    """Recomputes end_user_price and profit of a queryset's products from their stored prices, e.g. after prices have been changed via update().
+    Only the changed products are written. Returns the report of reprice()"""
+    return reprice(iter_queryset_batches(queryset, batch_size))
+
+def clean_reprice_row(row):
+    """Returns (product id, {field: value} of REPRICE_FILE_FIELDS given, errors) of a row, validated as imported products' fields are"""
+    errors, fields = dict(), dict()
+    try:
+        product_id = int(row.get('id'))
+    except (TypeError, ValueError):
+        product_id, errors['id'] = None, [_('A product id is required')]
+    for field_name in REPRICE_FILE_FIELDS:
+        if row.get(field_name) in (None, ''): continue
+        try:
+            fields[field_name] = ImportProductForm.base_fields[field_name].clean(row[field_name])
+            Product._meta.get_field(field_name).run_validators(fields[field_name])
+        except ValidationError as error:
+            errors[field_name] = error.messages
+    return product_id, fields, errors
+
+def reprice_file(lines, file_format, *, batch_size=1000):
+    """Sets the prices of products from CSV (with a header) or JSONL lines of REPRICE_FILE_FIELDS and 'id', and recomputes the derived ones.
+    Products are fetched and written by batches of rows. Invalid rows and unknown ids are skipped.
+    Returns the report of reprice() with 'errors': [{'row': row number, 'errors': {field: messages}}]"""
+    errors, changed_ids = [], set()
+    def iter_product_batches():
+        for batch in iter_batches(iter_rows(lines, file_format), batch_size):
+            rows = dict() # {product id: (row number, fields)}, the last row of an id wins
+            for row_number, row in batch:
+                product_id, fields, row_errors = clean_reprice_row(row) if isinstance(row, dict) else (None, None, {'__all__': [row]})
+                if row_errors:
+                    errors.append({'row': row_number, 'errors': row_errors})
+                else:
+                    rows[product_id] = (row_number, fields)
+            products, product_batch = Product.objects.only(*LOADED_FIELDS).in_bulk(rows), []
+            for product_id, (row_number, fields) in rows.items():
+                if product_id not in products:
+                    errors.append({'row': row_number, 'errors': {'id': [_('Unknown product')]}})
+                    continue
+                product = products[product_id]
+                if any(getattr(product, field) != value for field, value in fields.items()): changed_ids.add(product_id)
+                for field, value in fields.items(): setattr(product, field, value)
+                product_batch.append(product)
+            yield product_batch # a batch is written before the next one is read, so repeated ids get the latest values
+    report = reprice(iter_product_batches(), changed_ids=changed_ids)
+    report['errors'] = sorted(errors, key=lambda error: error['row'])
+    return report
@@ -0,0 +1,90 @@
+import re
+from django.db import connection
+from django.db.models import Q
+from django.utils.html import escape
+
+from taggit.models import TaggedItem
+from .models import Product
+
+
+SEARCH_TABLE = 'glyke_back_product_search' # FTS5 virtual table, its rowid is the product's id
+HIGHLIGHT_START, HIGHLIGHT_END = '\ue000', '\ue001' # private use chars, replaced by <mark> tags once the text is escaped
+
+def is_search_index_supported():
+    """The search index is an SQLite FTS5 table, other databases fall back to a plain (slow) lookup"""
+    return connection.vendor == 'sqlite'
+
+def create_search_index(**kwargs):
+    """Creates the search index table if there is none and fills it with all the products. Connected to post_migrate"""
+    if not is_search_index_supported(): return
+    with connection.cursor() as cursor:
+        if SEARCH_TABLE in connection.introspection.table_names(cursor): return
+        cursor.execute(f"CREATE VIRTUAL TABLE {SEARCH_TABLE} USING fts5(name, description, tags, attributes, tokenize='unicode61 remove_diacritics 2')")
+    rebuild_search_index()
+
+def rebuild_search_index():
+    """Re-indexes all the products"""
+    if not is_search_index_supported(): return
+    with connection.cursor() as cursor:
+        cursor.execute(f'DELETE FROM {SEARCH_TABLE}')
+    index_products(Product.objects.values_list('id', flat=True))
+
+def index_products(product_ids):
+    """(Re-)indexes products with given ids: name, description, tags and attributes' values. Three queries, whatever the number of products"""
+    if not is_search_index_supported(): return
+    product_ids = list(product_ids)
+    tags = dict()
+    tagged_items = TaggedItem.objects.filter(content_type__app_label=Product._meta.app_label,
+                                             content_type__model=Product._meta.model_name,
+                                             object_id__in=product_ids)
+    for product_id, tag_name in tagged_items.values_list('object_id', 'tag__name'):
+        tags.setdefault(product_id, []).append(tag_name)
+    rows = [(id, name, description, ' '.join(tags.get(id, [])), ' '.join(str(value) for value in (attributes or {}).values()))
+            for id, name, description, attributes in Product.objects.filter(id__in=product_ids).values_list('id', 'name', 'description', 'attributes')]
+    remove_products(product_ids)
+    with connection.cursor() as cursor:
+        cursor.executemany(f'INSERT INTO {SEARCH_TABLE} (rowid, name, description, tags, attributes) VALUES (%s, %s, %s, %s, %s)', rows)
+
+def remove_products(product_ids):
+    """Removes products with given ids from the search index"""
+    if not is_search_index_supported(): return
+    product_ids = list(product_ids)
+    if not product_ids: return
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {SEARCH_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(product_ids))})", product_ids)
+
+def get_match_expression(query):
+    """Turns user's input into an FTS5 query: every word is quoted (so FTS5 syntax can't be injected) and prefix-matched,
+    and all the words are required, e.g. 'red dr' -> '"red"* "dr"*'. Returns an empty string if there are no words"""
+    return ' '.join(f'"{word}"*' for word in re.findall(r'\w+', str(query)))
+
+def search_queryset(queryset, query):
+    """Filters a product queryset by a search query, ordering the results by relevance (bm25, name matches weigh most).
+    The filter is a join with the FTS5 index, so the queryset can still be filtered, counted and paginated as usual"""
+    match_expression = get_match_expression(query)
+    if not match_expression: return queryset.none()
+    if not is_search_index_supported():
+        return queryset.filter(Q(name__icontains=query) | Q(description__icontains=query))
+    return queryset.extra(select={'search_rank': f'bm25({SEARCH_TABLE}, 10.0, 1.0, 5.0, 2.0)'},
+                          tables=[SEARCH_TABLE],
+                          where=[f'{SEARCH_TABLE}.rowid = {Product._meta.db_table}.id', f'{SEARCH_TABLE} MATCH %s'],
+                          params=[match_expression]).order_by('search_rank')
+
+def get_highlighted_html(text):
+    """Escapes a text highlighted by FTS5 and wraps the matches in <mark> tags"""
+    return escape(text).replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_END, '</mark>')
+
+def search_products(query, *, limit=10):
+    """Returns a list of the best matching active products as dicts of id, highlighted name and a highlighted description's snippet (both html)"""
+    match_expression = get_match_expression(query)
+    if not match_expression: return []
+    if not is_search_index_supported():
+        products = Product.objects.filter(Q(name__icontains=query) | Q(description__icontains=query), is_active=True)[:limit]
+        return [{'id': id, 'name': escape(name), 'snippet': escape(description[:100])} for id, name, description in products.values_list('id', 'name', 'description')]
+    with connection.cursor() as cursor:
+        cursor.execute(f"SELECT {SEARCH_TABLE}.rowid, highlight({SEARCH_TABLE}, 0, %s, %s), snippet({SEARCH_TABLE}, 1, %s, %s, '…', 16) "
+                       f"FROM {SEARCH_TABLE} JOIN {Product._meta.db_table} ON {Product._meta.db_table}.id = {SEARCH_TABLE}.rowid "
+                       f"WHERE {SEARCH_TABLE} MATCH %s AND {Product._meta.db_table}.is_active "
+                       f"ORDER BY bm25({SEARCH_TABLE}, 10.0, 1.0, 5.0, 2.0) LIMIT %s",
+                       [HIGHLIGHT_START, HIGHLIGHT_END, HIGHLIGHT_START, HIGHLIGHT_END, match_expression, limit])
+        return [{'id': id, 'name': get_highlighted_html(name), 'snippet': get_highlighted_html(snippet)} for id, name, snippet in cursor.fetchall()]
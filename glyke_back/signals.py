@@ -1,37 +1,185 @@
 from django.dispatch.dispatcher import receiver
-from django.db.models.signals import pre_delete, post_delete, post_save
+from django.db import transaction
+from django.db.models import F, Q
+from django.apps import apps
+from django.db.models.signals import pre_delete, post_delete, post_save, m2m_changed, post_migrate
 from django.contrib.auth.signals import user_logged_in
 from django.contrib.auth.models import User
-from .models import Category, Product, Order, OrderLine
+from taggit.models import Tag
+from photologue.models import Photo, Gallery
+from .models import Category, Product, ProductCard, ProductAttributeValue, Order, OrderLine
+from .caching import bump_version, bump_versions
+from . import search
 
 
-def recur_update_child_categories_child_level(current_parrent, *, update_by):
-    """Recursively updates all children's child_level by update_by value"""
-    if current_parrent.child_categories.exists():
-        new_child_level = current_parrent.child_categories.first().child_level + update_by
-        current_parrent.child_categories.update(child_level=new_child_level)
-        for child_category in current_parrent.child_categories.all():
-            recur_update_child_categories_child_level(child_category, update_by=-1)
-
 @receiver(pre_delete,
           sender=Category,
           dispatch_uid='pre_delete_category')
 def category_pre_delete_handler(sender, instance, **kwargs):
     """When a category is deleted, switchs its children's parent attr to its own parent (or None).
     Also decrement all the following (by ordering_index after this instance) categories' ordering indices by 1.
-    Also decrement all instance's children's child_level by 1."""
-    instance.refresh_from_db() # because sometimes instance.ordering_index doesn't get updated
-    for category in sender.objects.filter(ordering_index__gt=instance.ordering_index):
-        category.ordering_index -= 1
-        category.save()
+    Also move all instance's descendants one level up (child_level and path).
+    Runs a constant number of set-based statements in a single transaction, whatever the size of the tree."""
+    with transaction.atomic():
+        # the instance's tree index is taken from the DB, because the instance itself may be stale
+        tree_state = sender.objects.filter(id=instance.id).values('path', 'ordering_index', 'parent_id').get()
+        sender.objects.filter(ordering_index__gt=tree_state['ordering_index']).update(ordering_index=F('ordering_index') - 1)
+        parent_path = tree_state['path'][:-len(f'{instance.id}/')]
+        sender.objects.move_subtree(old_path=tree_state['path'], new_path=parent_path, level_delta=-1)
+        if sender.objects.filter(parent_id=instance.id).update(parent_id=tree_state['parent_id']):
+            # the children are sorted among their new siblings after the instance's row is gone (see category_post_delete_handler)
+            instance._reparented_to = (tree_state['parent_id'], parent_path)
+        Product.objects.filter(category_id=instance.id).update(category_id=tree_state['parent_id'])
+        parent = sender.objects.filter(id=tree_state['parent_id']).values('name', 'bg_color').first() if tree_state['parent_id'] else None
+        ProductCard.objects.filter(category_id=instance.id).update(category_id=tree_state['parent_id'],
+                                                                   category_name=parent['name'] if parent else '',
+                                                                   category_bg_color=(parent['bg_color'] or '') if parent else '')
+
+@receiver(post_delete,
+          sender=Category,
+          dispatch_uid='post_delete_category')
+def category_post_delete_handler(sender, instance, **kwargs):
+    """Moves the subtrees of the deleted category's children (reparented by category_pre_delete_handler) to their places
+    among the new siblings by name, so the tree index is the same as rebuild_tree() gives"""
+    if hasattr(instance, '_reparented_to'):
+        sender.objects.sort_children(*instance._reparented_to)
+
+@receiver(post_save,
+          sender=Category,
+          dispatch_uid='save_category')
+@receiver(post_delete,
+          sender=Category,
+          dispatch_uid='delete_category')
+def category_post_save_delete_handler(sender, instance, **kwargs):
+    """When a category is saved or deleted, all the cached category tree data (descendants etc.) becomes stale.
+    Also products' cards get the category's current name and color"""
+    bump_version('category_tree')
+    if kwargs.get('created') is False: # saved, not created or deleted
+        ProductCard.objects.filter(category_id=instance.id).update(category_name=instance.name, category_bg_color=instance.bg_color or '')
+
+@receiver(post_delete,
+          sender=Product,
+          dispatch_uid='delete_product')
+def product_post_delete_handler(sender, instance, **kwargs):
+    """When an active product is deleted, its category's (and ancestors') active_products_count has to be decremented"""
+    if instance.is_active:
+        Category.objects.update_active_products_count(instance.category_id, -1)
+    bump_version('product_tags') # the deleted product's tags are gone as well
+    search.remove_products([instance.id])
+    ProductCard.objects.filter(id=instance.id).delete()
+    bump_version('products')
+    bump_version(f'product:{instance.id}')
+
+@receiver(m2m_changed,
+          sender=Product.tags.through,
+          dispatch_uid='change_product_tags')
+def product_tags_m2m_changed_handler(sender, instance, action, reverse, pk_set, **kwargs):
+    """When products' tags are added, removed or cleared, the cached tag index becomes stale and the products have to be re-indexed for search"""
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version('product_tags')
+        product_ids = (pk_set or []) if reverse else [instance.id] # if reverse, instance is a tag and pk_set are products' ids
+        search.index_products(product_ids)
+        ProductCard.objects.rebuild(product_ids)
+
+@receiver(post_save,
+          sender=Tag,
+          dispatch_uid='save_tag')
+@receiver(post_delete,
+          sender=Tag,
+          dispatch_uid='delete_tag')
+def tag_post_save_delete_handler(sender, instance, **kwargs):
+    """When a tag is renamed or deleted, the cached tag index becomes stale and its products have to be re-indexed for search"""
+    bump_version('product_tags')
+    tagged_product_ids = getattr(instance, '_tagged_product_ids', None) # see tag_pre_delete_handler
+    if tagged_product_ids is None:
+        tagged_product_ids = get_tagged_product_ids(instance)
+    search.index_products(tagged_product_ids)
+    ProductCard.objects.rebuild(tagged_product_ids)
 
-    # decrement all children's child_level by 1
-    # needs to be run after all Category.save() methods
-    recur_update_child_categories_child_level(instance, update_by=-1)
+@receiver(pre_delete,
+          sender=Tag,
+          dispatch_uid='pre_delete_tag')
+def tag_pre_delete_handler(sender, instance, **kwargs):
+    """Keeps the ids of the tag's products, which are lost once its tagged items are deleted"""
+    instance._tagged_product_ids = get_tagged_product_ids(instance)
+
+def get_tagged_product_ids(tag):
+    return list(Product.tags.through.objects.filter(tag=tag,
+                                                    content_type__app_label=Product._meta.app_label,
+                                                    content_type__model=Product._meta.model_name).values_list('object_id', flat=True))
+
+@receiver(post_save,
+          sender=Photo,
+          dispatch_uid='save_photo')
+@receiver(post_delete,
+          sender=Photo,
+          dispatch_uid='delete_photo')
+def photo_post_save_delete_handler(sender, instance, **kwargs):
+    """When a photo is saved or deleted, the cached product cards become stale and its products' cards have to be rebuilt"""
+    bump_version('product_photos')
+    photo_product_ids = getattr(instance, '_photo_product_ids', None) # see photo_pre_delete_handler
+    if photo_product_ids is None:
+        photo_product_ids = get_photo_product_ids(instance)
+    ProductCard.objects.rebuild(photo_product_ids)
+
+@receiver(pre_delete,
+          sender=Photo,
+          dispatch_uid='pre_delete_photo')
+def photo_pre_delete_handler(sender, instance, **kwargs):
+    """Keeps the ids of the photo's products, which are lost once the photo is deleted"""
+    instance._photo_product_ids = get_photo_product_ids(instance)
+
+def get_photo_product_ids(photo):
+    return list(Product.objects.filter(Q(main_photo=photo) | Q(photos__photos=photo)).values_list('id', flat=True).distinct())
 
-    new_parent = instance.parent if instance.parent else None
-    sender.objects.filter(parent_id=instance.id).update(parent=new_parent)
-    Product.objects.filter(category_id=instance.id).update(category=new_parent)
+@receiver(m2m_changed,
+          sender=Gallery.photos.through,
+          dispatch_uid='change_gallery_photos')
+def gallery_photos_m2m_changed_handler(sender, instance, action, reverse, pk_set, **kwargs):
+    """When galleries' photos are added, removed or cleared, the cached product cards become stale and the galleries' products' cards have to be rebuilt"""
+    if action == 'pre_clear' and reverse: # instance is a photo, its galleries are lost once cleared
+        instance._photo_product_ids = get_photo_product_ids(instance)
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        bump_version('product_photos')
+        if not reverse: # instance is a gallery
+            product_ids = Product.objects.filter(photos=instance).values_list('id', flat=True)
+        elif action == 'post_clear':
+            product_ids = instance._photo_product_ids
+        else: # instance is a photo, pk_set are galleries' ids
+            product_ids = Product.objects.filter(photos_id__in=pk_set).values_list('id', flat=True)
+        ProductCard.objects.rebuild(product_ids)
+
+@receiver(post_save,
+          sender=Product,
+          dispatch_uid='save_product')
+def product_post_save_handler(sender, instance, **kwargs):
+    """When a product is saved, it has to be re-indexed for search and attribute facets, its card has to be rebuilt, and the cached pages showing it become stale.
+    Also the carts containing it get its current prices"""
+    sync_products([instance.id])
+
+def sync_products(product_ids):
+    """Does what product_post_save_handler does for products with given ids, with a fixed number of queries (carts' lines and totals included).
+    Meant for the changes made via queryset.update(), bulk_create() or bulk_update(), which send no signals"""
+    product_ids = list(product_ids)
+    search.index_products(product_ids)
+    ProductCard.objects.rebuild(product_ids)
+    ProductAttributeValue.objects.rebuild(product_ids)
+    OrderLine.objects.update_current_prices(product_ids) # carts get the new prices
+    bump_versions(['products', *(f'product:{product_id}' for product_id in product_ids)])
+
+@receiver(post_migrate,
+          sender=apps.get_app_config('glyke_back'),
+          dispatch_uid='create_search_index')
+def post_migrate_handler(sender, **kwargs):
+    """Creates (and fills) the search index table, which isn't a model, so it can't be created by migrations.
+    Also builds the tree index of the categories created before it existed (their path is empty)
+    and recounts categories' active_products_count, which is only incremented/decremented afterwards.
+    Also builds the cards of the products created before they existed, as the staff table and catalogue export read the cards only"""
+    search.create_search_index()
+    if Category.objects.filter(path='').exists(): Category.objects.rebuild_tree()
+    Category.objects.recount_products()
+    missing_card_ids = list(Product.objects.exclude(id__in=ProductCard.objects.values('id')).values_list('id', flat=True))
+    if missing_card_ids: ProductCard.objects.rebuild(missing_card_ids)
 
 @receiver(post_save,
           sender=OrderLine,
@@ -47,6 +195,14 @@ def order_line_post_delete_handler(sender, instance, **kwargs):
     """When an OrderLine is deleted, its parent Order has to be updated"""
     instance.parent_order.save() # save parent_order to update its prices
 
+@receiver(post_save,
+          sender=User,
+          dispatch_uid='save_user')
+def user_post_save_handler(sender, instance, created, **kwargs):
+    """When a user is renamed, the cards of the products created by them have to show the new username"""
+    if not created:
+        ProductCard.objects.filter(created_by_id=instance.id).exclude(created_by_username=instance.username).update(created_by_username=instance.username)
+
 @receiver(user_logged_in,
           sender=User,
           dispatch_uid='user_logs_in')
@@ -1,9 +1,56 @@
-
-window.onload = function() {
-    var other_photos_containers = document.getElementsByClassName('other-photos-container')
+function trim_other_photos(root) {
+    var other_photos_containers = root.getElementsByClassName('other-photos-container')
     for (container of other_photos_containers) {
         if (container.children.length > 3) {
             container.removeChild(container.lastElementChild);
         }
     }
-}
\ No newline at end of file
+}
+
+function fetch_products_page(url) {
+    // cards' html is taken, so appended cards are the same as the rendered ones
+    // (set, not appended: the API's next urls already carry the fields parameter)
+    var page_url = new URL(url, window.location.href)
+    page_url.searchParams.set('fields', 'html')
+    return fetch(page_url, {headers: {'Accept': 'application/json'}}).then(function(response) {
+        if (!response.ok) throw new Error(response.statusText);
+        return response.json();
+    });
+}
+
+function setup_infinite_scroll() {
+    // appends the next pages of the products' API when the end of the list is reached, the page after is prefetched meanwhile
+    var products_list = document.getElementById('products_list')
+    var products_list_end = document.getElementById('products_list_end')
+    if (!products_list || !products_list.dataset.nextUrl || !('IntersectionObserver' in window)) return;
+    var next_page = fetch_products_page(products_list.dataset.nextUrl)
+    var loading = false
+    var pagination = document.querySelector('.pagination-block')
+    if (pagination) pagination.style.display = 'none';
+
+    var observer = new IntersectionObserver(function(entries) {
+        if (!entries[0].isIntersecting || loading || !next_page) return;
+        loading = true
+        next_page.then(function(data) {
+            var new_cards = document.createElement('div')
+            new_cards.innerHTML = data.results.map(function(record) { return record.html; }).join('')
+            trim_other_photos(new_cards)
+            while (new_cards.firstChild) products_list.appendChild(new_cards.firstChild);
+            next_page = data.next ? fetch_products_page(data.next) : null
+            if (!next_page) observer.disconnect();
+            else { observer.unobserve(products_list_end); observer.observe(products_list_end); } // the end may still be in view
+        }).catch(function() {
+            // falls back to the pagination links
+            observer.disconnect()
+            if (pagination) pagination.style.display = '';
+        }).finally(function() {
+            loading = false
+        });
+    }, {rootMargin: '400px'});
+    observer.observe(products_list_end)
+}
+
+window.onload = function() {
+    trim_other_photos(document)
+    setup_infinite_scroll()
+}
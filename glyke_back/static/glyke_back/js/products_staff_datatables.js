@@ -1,30 +1,45 @@
 $(document).ready(function() {
-    $('#products_staff_table').DataTable( {
+    // paging, ordering, search and filters are done server-side (ProductsStaffDataView), columns are taken from the table's head
+    var columns = $('#products_staff_thead th').map(function() {
+        var column = $(this).data('column');
+        return {
+            data: column,
+            name: column,
+            className: this.className + (column == 'photos' ? ' image-container' : ''),
+            orderable: !['tags', 'photos'].includes(column),
+        };
+    }).get();
+
+    var table = $('#products_staff_table').DataTable( {
         dom: 'Blfrtip',
         "pagingType": "full_numbers",
         scrollX: true,
-        "lengthMenu": [ [25, 50, 100, -1], [25, 50, 100, "All"]],
+        "lengthMenu": [ [25, 50, 100, 500], [25, 50, 100, 500]],
         buttons: [
             'colvis'
         ],
+        processing: true,
+        serverSide: true,
+        searchDelay: 400,
+        ajax: $('#products_staff_table').data('ajaxUrl'),
+        columns: columns,
 
-        initComplete: function () {
+        initComplete: function (settings, json) {
+            // footer filters' options are the distinct values the first draw came with
             this.api().columns().every( function () {
                 var column = this;
+                var values = json.filters[column.dataSrc()];
+                if (!values) return;
                 var select = $('<select style="width: 100%;" class="col-filter"><option value=""></option></select>')
                     .appendTo( $(column.footer()).empty() )
                     .on( 'change', function () {
-                        var val = $.fn.dataTable.util.escapeRegex(
-                            $(this).val()
-                        );
-
                         column
-                            .search( val ? '^'+val+'$' : '', true, false )
+                            .search( $(this).val() )
                             .draw();
                     } );
 
-                column.data().unique().sort().each( function ( d, j ) {
-                    select.append( '<option value="'+d+'">'+d+'</option>' )
+                values.forEach( function ( filter ) {
+                    select.append( $('<option>').val(filter.value).text(filter.label + ' (' + filter.count + ')') )
                 } );
             } );
         }
@@ -32,4 +47,30 @@ $(document).ready(function() {
 
     } );
 
-} );
\ No newline at end of file
+    // bulk actions are applied to all the products the table is filtered to, its current parameters go in the query string
+    var bulkForm = $('#products_bulk_action_form');
+    var valueFields = {set_discount: 'discount_percent', adjust_discount: 'discount_delta', change_price: 'price_percent', move_category: 'category'};
+    bulkForm.find('[name=action]').on('change', function () {
+        var valueField = valueFields[$(this).val()];
+        bulkForm.find('input[type=number], select:not([name=action])').each(function () {
+            $(this).toggle(this.name == valueField);
+        });
+    }).trigger('change');
+    table.on('xhr', function (e, settings, json) {
+        if (json) $('#products_bulk_action_count').text(json.recordsFiltered);
+    });
+    bulkForm.on('submit', function (event) {
+        event.preventDefault();
+        if (!confirm('Apply to ' + table.page.info().recordsDisplay + ' products?')) return;
+        $.post(bulkForm.attr('action') + '?' + $.param(table.ajax.params()), bulkForm.serialize())
+            .done(function (json) {
+                $('#products_bulk_action_message').text(json.updated + ' products updated');
+                table.draw(false);
+            })
+            .fail(function (xhr) {
+                var errors = xhr.responseJSON ? xhr.responseJSON.errors : {};
+                $('#products_bulk_action_message').text(Object.values(errors).join(' '));
+            });
+    });
+
+} );
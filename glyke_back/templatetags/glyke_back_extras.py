@@ -1,5 +1,7 @@
 from django import template
+from django.utils.encoding import filepath_to_uri
 from urllib.parse import quote_plus
+from photologue.models import PhotoSizeCache
 
 register = template.Library()
 
@@ -35,3 +37,19 @@ def remove_all_occ_url_param(current_params, param_to_remove):
     new_params = new_params[:-1] if new_params.endswith('&') else new_params
     return new_params
 
+@register.filter
+def photo_size_url(photo, size_name):
+    """Return the url of a photologue photo of given size (e.g. 'display'), the size is created if it doesn't exist yet.
+    Unlike photo.get_display_url of a size with increment_count set, doesn't increment the photo's view_count (a DB write per photo),
+    which is meant for listing pages"""
+    photosize = PhotoSizeCache().sizes.get(size_name)
+    if not photosize.increment_count: # the public accessor writes nothing then
+        return getattr(photo, f'get_{size_name}_url')()
+    return get_uncounted_photo_size_url(photo, photosize)
+
+def get_uncounted_photo_size_url(photo, photosize):
+    """Returns what photologue's get_SIZE_url returns, w/o its increment_count() call.
+    Relies on the private ImageModel._get_filename_for_size of django-photologue==3.13 (see requirements.txt), check it on upgrades"""
+    if not photo.size_exists(photosize):
+        photo.create_size(photosize)
+    return '/'.join([photo.cache_url(), filepath_to_uri(photo._get_filename_for_size(photosize.name))])
@@ -18,7 +18,13 @@ urlpatterns = [
     path("product/<int:id>", views.ProductDetailView.as_view(), name="product_details"),
     path("delete_product/<int:id>", views.delete_product_view, name="delete_product"),
     path("products", views.ProductsView.as_view(), name="products"),
+    path("api/products", views.ProductsAPIView.as_view(), name="products_api"),
     path("products_staff", views.ProductsStaffView.as_view(), name="products_staff"),
+    path("products_staff/data", views.ProductsStaffDataView.as_view(), name="products_staff_data"),
+    path("products_staff/bulk_action", views.ProductsStaffBulkActionView.as_view(), name="products_staff_bulk_action"),
+    path("products_staff/export", views.export_catalogue_view, name="export_catalogue"),
+    path("products_staff/import", views.import_catalogue_view, name="import_catalogue"),
+    path("search", views.search_view, name="search"),
 
     path("cart", views.cart_view, name="cart"),
     path("add_to_cart", views.AddToCartView.as_view(), name="add_to_cart"),
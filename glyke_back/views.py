@@ -1,9 +1,12 @@
+import io
 import random
 import decimal
+import operator
+import functools
 from urllib.parse import urlencode
 from django.shortcuts import render, redirect, get_object_or_404, resolve_url
 from django.urls import reverse, reverse_lazy
-from django.http import HttpResponseRedirect, Http404, request
+from django.http import HttpResponseRedirect, Http404, JsonResponse, StreamingHttpResponse, request
 from django import forms
 from django.utils.translation import gettext_lazy as _
 from django.views.decorators.http import require_http_methods
@@ -13,16 +16,29 @@ from django.contrib.auth.views import LoginView, LogoutView
 from django.contrib.auth.models import User
 from django.contrib.auth import authenticate, login
 from django.utils.text import slugify
-from django.views.generic import ListView, DetailView, TemplateView, CreateView
+from django.utils.html import escape, format_html, format_html_join
+from django.utils.formats import date_format
+from django.utils import timezone
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q, Count, Max
+from django.db.models.functions import TruncDate, Now
+from django.views.generic import View, ListView, DetailView, TemplateView, CreateView
 from django.views.generic.base import RedirectView
 
 from proj_folio.defaults import *
 from proj_folio.settings import DEBUG as DEBUG_MODE
 
 from photologue import models as photo_models
-from .forms import AddProductForm, PhotosForm, SelectCategoryProductForm, RegisterForm, SignInForm, CustomPasswordChangeForm, UsernameChangeForm, EmailChangeForm
-from .models import Category, Order, OrderLine, Product
-from .decorators_mixins import user_is_staff_or_404, UserIsStaff_Or404_Mixin
+from .forms import AddProductForm, PhotosForm, SelectCategoryProductForm, RegisterForm, SignInForm, CustomPasswordChangeForm, UsernameChangeForm, EmailChangeForm, ImportCatalogueForm, ProductsBulkActionForm
+from .models import Category, Order, OrderLine, Product, ProductCard, ProductAttributeValue, RelatedProduct
+from .decorators_mixins import user_is_staff_or_404, UserIsStaff_Or404_Mixin, AnonymousPageCacheMixin
+from .paginators import KeysetPaginator, CachedCountPaginator, encode_cursor
+from .caching import get_version, get_versioned_key, get_or_set_two_tier
+from .fragments import render_product_cards, render_product_card_list
+from .signals import sync_products
+from . import search, catalogue_io
+from .templatetags.glyke_back_extras import remove_all_occ_url_param, append_url_param_value
 
 
 def create_gallery(*, title):
@@ -319,6 +335,39 @@ def profile_view(request):
     request.user.refresh_from_db()
     return render(request, "profile.html", context)
 
+@require_http_methods(["GET",])
+def search_view(request):
+    """Returns a JSON of the best matching active products for the 'q' parameter (e.g. for search suggestions).
+    Names and snippets are html with the matches wrapped in <mark> tags"""
+    results = search.search_products(request.GET.get('q', ''))
+    for result in results:
+        result['url'] = reverse('product_details', kwargs={'id': result['id']})
+    return JsonResponse({'results': results})
+
+@user_is_staff_or_404()
+@require_http_methods(["GET",])
+def export_catalogue_view(request):
+    """Streams the whole catalogue as a CSV (default) or JSONL ('?format=jsonl') file, see glyke_back.catalogue_io"""
+    export_format = request.GET.get('format', 'csv')
+    if export_format not in catalogue_io.EXPORT_FORMATS: raise Http404(_('Unknown export format'))
+    lines = catalogue_io.export_catalogue(export_format, url_prefix=request.build_absolute_uri('/').rstrip('/'))
+    response = StreamingHttpResponse(lines, content_type=catalogue_io.EXPORT_FORMATS[export_format])
+    response['Content-Disposition'] = f'attachment; filename="catalogue_{timezone.localdate():%Y%m%d}.{export_format}"'
+    return response
+
+@user_is_staff_or_404()
+@require_http_methods(["GET", "POST"])
+def import_catalogue_view(request):
+    """Imports products from an uploaded CSV or JSONL catalogue file, see glyke_back.catalogue_io.
+    Shows the number of products created and the errors of the skipped rows"""
+    form = ImportCatalogueForm(request.POST or None, request.FILES or None)
+    context = {'form': form}
+    if request.method == 'POST' and form.is_valid():
+        catalogue_file = form.cleaned_data['catalogue_file']
+        lines = io.TextIOWrapper(catalogue_file.file, encoding='utf-8-sig', newline='')
+        context['report'] = catalogue_io.import_catalogue(lines, catalogue_file.name.rsplit('.', 1)[-1].lower(), created_by=request.user)
+    return render(request, "import_catalogue.html", context)
+
 @require_http_methods(["GET",])
 def generate_stuff_view(request):
     """The view can only be used in DEBUG mode, for demo purposes.
@@ -381,53 +430,308 @@ def generate_stuff_view(request):
     # login(request, auth_admin)
     return redirect(reverse('products'))
 
-class ProductsView(ListView):
+class ProductsView(AnonymousPageCacheMixin, ListView):
     http_method_names = ['get', ]
     model = Product
+    page_cache_tags = ('products', 'category_tree', 'category_counts', 'product_tags', 'product_photos')
     paginate_by = 9
     template_name = 'products.html'
     context_object_name = 'products'
     extra_context = {'no_image_url': DEFAULT_NO_IMAGE_URL}
+    # {'sort' parameter: (label, ordering)}, each ordering is backed by a partial index (see Product.Meta)
+    # and ends with 'id', which makes it unique, as keyset pagination relies on
+    sort_modes = {'discount': (_('Best discount'), ('-discount_percent', '-stock', 'id')),
+                  'price': (_('Lowest price'), ('end_user_price', 'id')),
+                  'newest': (_('Newest'), ('-created', '-id')),
+                  'stock': (_('In stock first'), ('-stock', 'id')),}
+    default_sort_mode = 'discount'
+
+    def get_sort_mode(self):
+        return self.request.GET.get('sort') if self.request.GET.get('sort') in self.sort_modes else self.default_sort_mode
+
+    def get_ordering(self):
+        return self.sort_modes[self.get_sort_mode()][1]
 
     def get_queryset(self):
-        queryset = base_queryset = self.model.objects.filter(is_active=True).order_by('-discount_percent', '-stock') # basic queryset
+        queryset = base_queryset = self.model.objects.filter(is_active=True).order_by(*self.get_ordering()) # basic queryset, cards are rendered from ProductCard rows
         # category filter block
+        self.current_category = None # is also used for the attribute facets
         if self.request.GET.get('category'): # to be able to make a queryset
             category_filter = self.request.GET.get('category')
-            current_category = Category.objects.get(name = category_filter)
-            queryset = base_queryset.filter(category=current_category)
+            self.current_category = Category.objects.get(name = category_filter)
             # if a parent category is chosen - add all of its children (and theirs too, etc.) either
-            def add_children_to_queryset(current_parent_category):
-                nonlocal queryset
-                if current_parent_category.child_categories.exists():
-                    for child_category in current_parent_category.child_categories.order_by('ordering_index'):
-                        new_items = base_queryset.filter(category=child_category)
-                        queryset = queryset | new_items
-                        add_children_to_queryset(child_category)
-            add_children_to_queryset(current_category)
+            queryset = base_queryset.filter(category_id__in=Category.objects.get_descendants_ids(self.current_category))
         # tag_filters block
-        tag_filters = set(self.request.GET.getlist('tag'))
-        if tag_filters: # check if there are any tag parameters
-            # FOR NOW, tag filters add up as OR statements, so if a product has ANY tag from tag_filters, it will be added to the queryset
-            queryset = queryset.filter(tags__name__in=tag_filters).distinct()
+        # 'tag' filters add up as OR statements, 'tag_all' ones as AND, 'tag_not' ones exclude products
+        queryset = queryset.filter_by_tags(any_tags=set(self.request.GET.getlist('tag')),
+                                           all_tags=set(self.request.GET.getlist('tag_all')),
+                                           no_tags=set(self.request.GET.getlist('tag_not')))
+        # attribute filters block
+        queryset = queryset.filter_by_attributes(self.get_attribute_filters())
+        # search block
+        if self.request.GET.get('q'): # search results are ordered by relevance instead
+            queryset = search.search_queryset(queryset, self.request.GET['q'])
         return queryset
 
+    def get_paginator(self, queryset, per_page, **kwargs):
+        """Counts are cached per normalized filters and estimated above the threshold (see CachedCountPaginator)"""
+        filters = urlencode(sorted((key, value) for key, values in self.request.GET.lists() if key not in ('page', 'after', 'sort') for value in values))
+        # any product, category tree or tags change may change the count
+        count_cache_key = get_versioned_key('products', 'count', get_version('category_tree'), get_version('product_tags'), filters)
+        return CachedCountPaginator(queryset, per_page,
+                                    count_cache_key=count_cache_key,
+                                    count_threshold=CATALOGUE_COUNT_THRESHOLD,
+                                    count_cache_timeout=CATALOGUE_COUNT_CACHE_TIMEOUT,
+                                    **kwargs)
+
+    def get_attribute_filters(self):
+        """Returns {attribute: values} of 'attr' parameters, e.g. {'color': ['blue', 'red']} of '?attr=color:blue&attr=color:red'"""
+        attribute_filters = dict()
+        for attr_filter in self.request.GET.getlist('attr'):
+            attribute, separator, value = attr_filter.partition(':')
+            if separator and attribute.strip() and value.strip():
+                attribute_filters.setdefault(ProductAttributeValue.normalize(attribute), []).append(ProductAttributeValue.normalize(value))
+        return attribute_filters
+
+    def get_attribute_facets(self):
+        """Returns the attribute facets of the current category with per-value counts, each value with its 'attr' parameter and whether it's selected"""
+        attribute_filters = self.get_attribute_filters()
+        facets = ProductAttributeValue.objects.get_facets(category=self.current_category)
+        return {attribute: [dict(facet, param=append_url_param_value('attr=', f"{attribute}:{facet['value']}"), selected=facet['value'] in attribute_filters.get(attribute, []))
+                            for facet in values]
+                for attribute, values in facets.items()}
+
+    def is_keyset_pagination(self):
+        """Keyset pagination is used if there is an 'after' parameter (empty for the first page)"""
+        return 'after' in self.request.GET and not self.request.GET.get('q') # search results are ordered by relevance, which has no keyset
+
+    def get_pagination_query(self):
+        """Returns current params w/o pagination ones, so page links keep the filters"""
+        return remove_all_occ_url_param(remove_all_occ_url_param(self.request.GET.urlencode(), 'page='), 'after=')
+
+    def get_next_page_query(self, page):
+        """Returns the query string of the page after the given one, None if it's the last one.
+        It's a keyset page (whichever the given one is), unless it's a search"""
+        if not page.has_next(): return None
+        if self.request.GET.get('q'): return f'{self.get_pagination_query()}&page={page.next_page_number()}'
+        last_product = list(page.object_list)[-1] # the page is evaluated already
+        return f"{self.get_pagination_query()}&after={encode_cursor([getattr(last_product, field.lstrip('-')) for field in self.get_ordering()])}"
+
+    def paginate_queryset(self, queryset, page_size):
+        """Uses keyset pagination if is_keyset_pagination, offset pagination otherwise.
+        Keyset pages skip COUNT(*) and OFFSET, so deep pages cost as much as the first one"""
+        if not self.is_keyset_pagination():
+            return super().paginate_queryset(queryset, page_size)
+        try:
+            page = KeysetPaginator(queryset, page_size, ordering=self.get_ordering()).get_page(self.request.GET.get('after'))
+        except ValueError:
+            raise Http404(_('Invalid page'))
+        return (None, page, page.object_list, page.has_next())
+
     def get_context_data(self, *, object_list=None, **kwargs):
         context = super().get_context_data(**kwargs)
-        context['categories'] = [category for category in Category.objects.filter(is_active=True).order_by('ordering_index')]
+        context['pagination_query'] = self.get_pagination_query()
+        context['categories'] = Category.objects.get_navigation_tree() # cached, see CategoryTreeManager
+        context['category_query'] = remove_all_occ_url_param(self.request.GET.urlencode(), 'category') # current params w/o category, same for every option
         context['category'] = self.request.GET.get('category')
         context['tag_filters'] = set(self.request.GET.getlist('tag'))
+        context['search_query'] = self.request.GET.get('q', '')
+        context['sort_mode'] = self.get_sort_mode()
+        context['sort_modes'] = {sort_mode: label for sort_mode, (label, ordering) in self.sort_modes.items()}
+        context['sort_query'] = remove_all_occ_url_param(context['pagination_query'], 'sort=') # current params w/o pagination and sort ones
+        context['attribute_facets'] = self.get_attribute_facets()
+        context['product_cards'] = render_product_cards(self.request, context['products'], no_image_url=self.extra_context['no_image_url']) # cached, see glyke_back.fragments
+        # infinite scroll continues from the next page of the API (see ProductsAPIView)
+        next_page_query = self.get_next_page_query(context['page_obj'])
+        context['api_next_url'] = f"{reverse('products_api')}?{next_page_query}" if next_page_query else ''
         return context
 
+class ProductsAPIView(ProductsView):
+    """JSON catalogue for infinite scroll: {'results': product records of a page, 'next': the next page's url or null}.
+    Takes the same filters, sort modes and search as ProductsView, pages are keyset ones (search results are offset ones).
+    'fields' parameter selects records' fields, e.g. '?fields=id,name,end_user_price', 'html' field is the product's card"""
+    # {field: value of a ProductCard}
+    record_fields = {'id': lambda card: card.id,
+                     'name': lambda card: card.name,
+                     'description': lambda card: card.description,
+                     'url': lambda card: reverse('product_details', kwargs={'id': card.id}),
+                     'category': lambda card: card.category_name,
+                     'selling_price': lambda card: card.selling_price,
+                     'discount_percent': lambda card: card.discount_percent,
+                     'end_user_price': lambda card: card.end_user_price,
+                     'stock': lambda card: card.stock,
+                     'main_photo_url': lambda card: card.main_photo_url,
+                     'photos': lambda card: [photo['display_url'] for photo in card.photos],
+                     'tags': lambda card: card.tags,}
+
+    def get_fields(self):
+        fields = [field for field in self.request.GET.get('fields', '').split(',') if field in self.record_fields or field == 'html']
+        return fields or list(self.record_fields)
+
+    page_cache_control = {'public': True, 'no_cache': True} # records are the same for everyone, so a reverse proxy may keep them (revalidating)
+
+    def is_page_cacheable(self):
+        # cards' html has CSRF tokens in it
+        return super().is_page_cacheable() and 'html' not in self.get_fields()
+
+    def is_keyset_pagination(self):
+        return not self.request.GET.get('q')
+
+    def get(self, request, *args, **kwargs):
+        self.object_list = self.get_queryset()
+        paginator, page, products, has_next = self.paginate_queryset(self.object_list, self.get_paginate_by(self.object_list))
+        products = list(products)
+        fields = self.get_fields()
+        cards = ProductCard.objects.get_cards([product.id for product in products])
+        records = [{field: self.record_fields[field](cards[product.id]) for field in fields if field != 'html'} for product in products]
+        if 'html' in fields:
+            # cards are filled in for the catalogue page the API is called from
+            page_url = f"{reverse('products')}?{remove_all_occ_url_param(request.GET.urlencode(), 'fields=')}"
+            cards_html = render_product_card_list(request, products, no_image_url=self.extra_context['no_image_url'], page_url=page_url)
+            for record, card_html in zip(records, cards_html):
+                record['html'] = card_html
+        next_page_query = self.get_next_page_query(page)
+        return JsonResponse({'results': records, 'next': f"{reverse('products_api')}?{next_page_query}" if next_page_query else None})
+
 class ProductsStaffView(UserIsStaff_Or404_Mixin, ListView):
-    # Paginating, ordering and filtering are done by JS DataTables
+    # the table's rows are loaded by JS DataTables from ProductsStaffDataView, so products aren't rendered here
     http_method_names = ['get', ]
-    model = Product
+    model = ProductCard # a single table, see ProductCard
     queryset = model.objects.all()
     template_name = 'products_staff.html'
     context_object_name = 'products'
 
-class ProductDetailView(DetailView):
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context['bulk_action_form'] = ProductsBulkActionForm()
+        return context
+
+class ProductsStaffDataView(UserIsStaff_Or404_Mixin, View):
+    """DataTables' server-side processing endpoint of the staff products' table: paging, ordering, global search and column filters are done in the DB.
+    The first draw also gets the distinct values of the footer filters ('filters'), computed by grouped queries"""
+    http_method_names = ['get', ]
+    max_length = 500
+    # {column: ProductCard field it's ordered and filtered by, None if it isn't}, in the table's order
+    columns = {'id': 'id', 'name': 'name', 'category': 'category_name', 'tags': None, 'description': 'description',
+               'cost_price': 'cost_price', 'selling_price': 'selling_price', 'discount_percent': 'discount_percent', 'end_user_price': 'end_user_price',
+               'profit': 'profit', 'stock': 'stock', 'is_active': 'is_active', 'photos': None, 'created': 'created__date'}
+    filter_columns = ('category', 'cost_price', 'selling_price', 'discount_percent', 'end_user_price', 'profit', 'stock', 'is_active', 'created')
+    search_fields = ('name', 'description', 'category_name', 'tags')
+
+    def get(self, request, *args, **kwargs):
+        queryset = ProductCard.objects.all()
+        records_total = queryset.count()
+        try:
+            draw = int(request.GET.get('draw') or 0)
+            queryset, is_filtered = self.filter_queryset(queryset)
+            start = max(int(request.GET.get('start', 0)), 0)
+            length = min(int(request.GET.get('length', 25)), self.max_length)
+            length = self.max_length if length < 0 else length # 'All'
+        except (ValueError, ValidationError):
+            return JsonResponse({'draw': request.GET.get('draw'), 'error': _('Invalid filter value')})
+        data = {'draw': draw,
+                'recordsTotal': records_total,
+                'recordsFiltered': queryset.count() if is_filtered else records_total,
+                'data': [self.get_row(card) for card in queryset.order_by(*self.get_ordering())[start:start + length]]}
+        if draw <= 1: data['filters'] = self.get_filters()
+        return JsonResponse(data)
+
+    def get_column(self, index):
+        return self.request.GET.get(f'columns[{index}][data]')
+
+    def filter_queryset(self, queryset):
+        """Returns (the queryset filtered by the global search and column filters, whether it's filtered at all)"""
+        is_filtered = False
+        search_value = self.request.GET.get('search[value]', '').strip()
+        if search_value:
+            search_filter = functools.reduce(operator.or_, (Q(**{f'{field}__icontains': search_value}) for field in self.search_fields))
+            if search_value.isdigit(): search_filter |= Q(id=search_value)
+            queryset, is_filtered = queryset.filter(search_filter), True
+        for index in range(len(self.columns)):
+            column, value = self.get_column(index), self.request.GET.get(f'columns[{index}][search][value]', '')
+            if column in self.filter_columns and value:
+                if column == 'is_active': value = value == 'True'
+                queryset, is_filtered = queryset.filter(**{self.columns[column]: value}), True
+        return queryset, is_filtered
+
+    def get_ordering(self):
+        ordering = []
+        index = 0
+        while f'order[{index}][column]' in self.request.GET:
+            field = self.columns.get(self.get_column(self.request.GET[f'order[{index}][column]']))
+            if field: ordering.append(('-' if self.request.GET.get(f'order[{index}][dir]') == 'desc' else '') + field.replace('__date', ''))
+            index += 1
+        return ordering + ['id'] # a unique ordering, so pages don't overlap
+
+    def get_filters(self):
+        """Returns {column: [{'value', 'label', 'count'}]} of the footer filters, a grouped query per column"""
+        filters = dict()
+        for column in self.filter_columns:
+            field = self.columns[column]
+            values = ProductCard.objects.values(value=TruncDate('created') if field == 'created__date' else F(field)).annotate(count=Count('id')).order_by('value')
+            filters[column] = [{'value': str(row['value']), 'label': str(row['value']) if row['value'] != '' else 'None', 'count': row['count']} for row in values]
+        return filters
+
+    def get_row(self, card):
+        """Returns {column: cell's html} of a card, as the table rendered it"""
+        return {'DT_RowClass': '' if card.is_active else 'product-staff-deleted',
+                'id': card.id,
+                'name': format_html('{}<div class="product-btn-container">'
+                                    '<a href="{}"><button type="button" class="product-btn product-btn-edit"><i class="fas fa-edit"></i></button></a>'
+                                    '<a href="{}"><button type="button" class="product-btn product-btn-edit"><i class="fas fa-store"></i></button></a></div>',
+                                    card.name, reverse('edit_product', kwargs={'id': card.id}), reverse('product_details', kwargs={'id': card.id})),
+                'category': escape(card.category_name or 'None'),
+                'tags': escape(', '.join(card.tags)),
+                'description': format_html('<div>{}</div>', card.description),
+                'cost_price': f'$ {card.cost_price}',
+                'selling_price': f'$ {card.selling_price}',
+                'discount_percent': f'{card.discount_percent} %',
+                'end_user_price': f'$ {card.end_user_price}',
+                'profit': f'$ {card.profit}',
+                'stock': card.stock,
+                'is_active': format_html('<span class="product-color-active">ACTIVE</span>') if card.is_active else format_html('<span class="product-color-deleted">DELETED</span>'),
+                'photos': format_html('<span>{}</span>', format_html_join('', '<a href="{}"><img class="trans02s" src="{}" alt=""></a>',
+                                                                         ((photo['url'], photo['thumbnail_url']) for photo in card.photos))),
+                'created': format_html('{}<br>by {}', date_format(timezone.localtime(card.created), 'DATETIME_FORMAT'), card.created_by_username or 'None'),}
+
+class ProductsStaffBulkActionView(ProductsStaffDataView):
+    """Applies an action (see ProductsBulkActionForm) to all the products the staff table is filtered to.
+    The table's DataTables parameters come in the query string, so they are filtered as ProductsStaffDataView does.
+    Every action is a single UPDATE (prices are recomputed in SQL, see ProductQuerySet.update_prices),
+    then category counters are recounted and the products' derived data is synced, instead of a Product.save() per product"""
+    http_method_names = ['post', ]
+
+    def post(self, request, *args, **kwargs):
+        form = ProductsBulkActionForm(request.POST)
+        if not form.is_valid(): return JsonResponse({'errors': form.errors}, status=400)
+        try:
+            cards = self.filter_queryset(ProductCard.objects.all())[0]
+        except (ValueError, ValidationError):
+            return JsonResponse({'errors': {'__all__': [_('Invalid filter value')]}}, status=400)
+        with transaction.atomic():
+            product_ids = list(cards.values_list('id', flat=True))
+            products = Product.objects.filter(id__in=product_ids)
+            action, data = form.cleaned_data['action'], form.cleaned_data
+            if action == 'change_price':
+                max_selling_price = products.aggregate(Max('selling_price'))['selling_price__max'] or 0
+                if max_selling_price * (100 + data['price_percent']) / 100 > decimal.Decimal('99999.99'): # selling_price's max_digits
+                    return JsonResponse({'errors': {'price_percent': [_('A selling price would get too high')]}}, status=400)
+                updated = products.update_prices(price_percent=data['price_percent'])
+            elif action == 'set_discount':
+                updated = products.update_prices(discount_percent=data['discount_percent'])
+            elif action == 'adjust_discount':
+                updated = products.update_prices(discount_delta=data['discount_delta'])
+            elif action == 'activate':
+                updated = products.filter(selling_price__gt=0).update(is_active=True, modified=Now()) # as Product.save() does
+            elif action == 'deactivate':
+                updated = products.update(is_active=False, modified=Now())
+            else:
+                updated = products.update(category=data['category'], modified=Now())
+            if action in ('activate', 'deactivate', 'move_category'): Category.objects.recount_products()
+        sync_products(product_ids)
+        return JsonResponse({'updated': updated})
+
+class ProductDetailView(AnonymousPageCacheMixin, DetailView):
     http_method_names = ['get', ]
     model = Product
     pk_url_kwarg = 'id'
@@ -436,7 +740,23 @@ class ProductDetailView(DetailView):
     context_object_name = 'product'
     extra_context={'no_image_url': DEFAULT_NO_IMAGE_URL}
 
-class Home(TemplateView):
+    def get_page_cache_tags(self):
+        """The page shows its related products' names and prices, so it depends on their versions too.
+        Their ids are cached until related products are rebuilt, so conditional requests still cost no queries"""
+        product_id = self.kwargs['id']
+        related_ids = get_or_set_two_tier('related_products', f'related_ids:{product_id}',
+                                          lambda: list(RelatedProduct.objects.filter(product_id=product_id).values_list('related_id', flat=True)))
+        return [f'product:{product_id}', 'category_tree', 'product_tags', 'product_photos', 'related_products',
+                *(f'product:{related_id}' for related_id in related_ids)]
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        # precomputed by 'rebuild_related_products' command, a single indexed lookup joined with the cards
+        context['related_products'] = [related_product.related for related_product in self.object.related_products.filter(related__is_active=True)
+                                                                                                     .select_related('related').order_by('rank')]
+        return context
+
+class Home(AnonymousPageCacheMixin, TemplateView):
     http_method_names = ['get',]
     template_name = 'home.html'
     extra_context = {'debug_mode_on': DEBUG_MODE}
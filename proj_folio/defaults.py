@@ -2,6 +2,10 @@
 
 DEFAULT_NO_IMAGE_URL = 'https://static.thenounproject.com/png/1554489-200.png'
 
+# Catalogue's paginator counts: counts above the threshold are shown as an estimate ("1000+"), counts are cached for the timeout (seconds)
+CATALOGUE_COUNT_THRESHOLD = 1000
+CATALOGUE_COUNT_CACHE_TIMEOUT = 60
+
 # Defaults values to generate demo staff user
 staff_user_username_demo = 'General_Kenobi'
 staff_user_password_demo = 'staffpassword'
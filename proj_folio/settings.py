@@ -98,6 +98,17 @@ DATABASES = {
     }
 }
 
+# Cache
+# https://docs.djangoproject.com/en/3.1/ref/settings/#caches
+# The cached data is invalidated by bumping namespace versions (see glyke_back.caching), which every worker has to see:
+# a local-memory cache is only fine for a single process (runserver), run several workers with a shared one (e.g. PyMemcacheCache)
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 AUTHENTICATION_BACKENDS = [
     # Needed to login by username in Django admin, regardless of `allauth`
     'django.contrib.auth.backends.ModelBackend',
@@ -1,9 +1,15 @@
 from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.db import connection, transaction
+from django.core.cache import cache
 from django.db.models.signals import pre_delete
-from unittest.mock import MagicMock
+from unittest.mock import MagicMock, patch
 from django.apps import apps
+from django.core.management import call_command
+from io import StringIO
 from django.utils.crypto import get_random_string
 from django.contrib.auth.models import User
+from django.contrib.contenttypes.models import ContentType
 from django.core.files.uploadedfile import SimpleUploadedFile
 import tempfile, shutil # temp dir to test filefields (test_auto_upload_dir_method)
 from django.utils.text import slugify
@@ -14,6 +20,7 @@ from photologue import models as photo_models
 from glyke_back.models import *
 from glyke_back.views import create_gallery
 from glyke_back import signals
+from glyke_back.caching import get_version
 
 
 def get_random_temp_file(extension):
@@ -140,6 +147,295 @@ class ModelsTest(TestCase):
         self.assertEqual(Category.objects.get(name='ba').ordering_index, 3)
         self.assertEqual(Category.objects.get(name='c').ordering_index, 4)
 
+    def test_category_path_update(self):
+        """Assert categories' materialized paths update properly on create, move and delete"""
+        self.assertEqual(self.parent_cat.path, f'{self.parent_cat.id}/')
+        self.assertEqual(self.sub_parent_cat.path, f'{self.parent_cat.id}/{self.sub_parent_cat.id}/')
+        self.assertEqual(self.child_cat.path, f'{self.parent_cat.id}/{self.sub_parent_cat.id}/{self.child_cat.id}/')
+        # case: move a subtree under a new top-lvl-category
+        new_parent_cat = Category.objects.create(name='New parent cat')
+        self.sub_parent_cat.parent = new_parent_cat
+        self.sub_parent_cat.save()
+        child_cat = Category.objects.get(id=self.child_cat.id)
+        self.assertEqual(child_cat.path, f'{new_parent_cat.id}/{self.sub_parent_cat.id}/{self.child_cat.id}/')
+        self.assertEqual(child_cat.child_level, 2)
+        # case: delete a category in the middle of the subtree
+        self.sub_parent_cat.delete()
+        child_cat = Category.objects.get(id=self.child_cat.id)
+        self.assertEqual(child_cat.path, f'{new_parent_cat.id}/{self.child_cat.id}/')
+        self.assertEqual(child_cat.child_level, 1)
+
+    def test_category_ordering_indices_on_rename_and_move(self):
+        """Assert categories' ordering_indices follow renamed and moved subtrees"""
+        Category.objects.all().delete()
+        category_a = Category.objects.create(name='a')
+        category_a_a = Category.objects.create(name='aa', parent=category_a)
+        Category.objects.create(name='aaa', parent=category_a_a)
+        category_b = Category.objects.create(name='b')
+        Category.objects.create(name='c')
+        # case: rename a subtree's root so it goes to the end of the list
+        category_a.name = 'd'
+        category_a.save()
+        self.assertListEqual(list(Category.objects.order_by('ordering_index').values_list('name', flat=True)), ['b', 'c', 'd', 'aa', 'aaa'])
+        # case: move a subtree under another category
+        category_a_a.parent = category_b
+        category_a_a.save()
+        self.assertListEqual(list(Category.objects.order_by('ordering_index').values_list('name', flat=True)), ['b', 'aa', 'aaa', 'c', 'd'])
+        self.assertListEqual(list(Category.objects.order_by('ordering_index').values_list('ordering_index', flat=True)), [1, 2, 3, 4, 5])
+        # the tree index has to match the one rebuilt from scratch
+        tree_index = list(Category.objects.order_by('id').values_list('path', 'child_level', 'ordering_index'))
+        Category.objects.rebuild_tree()
+        self.assertListEqual(list(Category.objects.order_by('id').values_list('path', 'child_level', 'ordering_index')), tree_index)
+
+    def test_category_tree_backfill(self):
+        """Assert categories created before the tree index existed (no path) get it after migrate, as well as their active products' counters.
+        Subtree operations refuse to run w/o it"""
+        Product.objects.create(name='Active product of child cat', category=self.child_cat, selling_price=10, is_active=True)
+        tree_index = list(Category.objects.order_by('id').values_list('path', 'child_level', 'ordering_index', 'active_products_count'))
+        self.assertListEqual([index[3] for index in tree_index], [1, 1, 1])
+        Category.objects.update(path='', child_level=0, ordering_index=0, active_products_count=0)
+        with self.assertRaises(ValueError):
+            Category.objects.get(id=self.child_cat.id).get_descendants()
+        with self.assertRaises(ValueError), transaction.atomic(): # the subtree would be the whole table
+            Category.objects.get(id=self.sub_parent_cat.id).delete()
+        signals.post_migrate_handler(sender=apps.get_app_config('glyke_back'))
+        self.assertListEqual(list(Category.objects.order_by('id').values_list('path', 'child_level', 'ordering_index', 'active_products_count')), tree_index)
+        self.assertListEqual(list(Category.objects.get(id=self.child_cat.id).get_descendants(include_self=True)), [self.child_cat])
+        # case: the command
+        Category.objects.update(path='', active_products_count=0)
+        call_command('rebuild_category_tree', stdout=StringIO())
+        self.assertListEqual(list(Category.objects.order_by('id').values_list('path', 'child_level', 'ordering_index', 'active_products_count')), tree_index)
+
+    def test_category_create_queries_count(self):
+        """Assert creating a category doesn't depend on the number of existing categories"""
+        for i in range(20):
+            Category.objects.create(name=f'Filler cat {i}', parent=self.child_cat if i % 2 else None)
+        with self.assertNumQueries(9):
+            Category.objects.create(name='Another child cat', parent=self.child_cat)
+
+    def test_category_delete_queries_count(self):
+        """Assert deleting a top-lvl-category doesn't depend on the size of its subtree"""
+        def count_delete_queries(category):
+            with CaptureQueriesContext(connection) as context:
+                category.delete()
+            return len(context.captured_queries)
+        small_cat = Category.objects.create(name='Small cat')
+        Category.objects.create(name='Small child cat', parent=small_cat)
+        big_cat = Category.objects.create(name='Big cat')
+        parent = big_cat
+        for i in range(15): # a deep subtree
+            parent = Category.objects.create(name=f'Big child cat {i}', parent=parent)
+        self.assertEqual(count_delete_queries(small_cat), count_delete_queries(big_cat))
+        self.assertEqual(Category.objects.get(name='Big child cat 0').child_level, 0)
+        self.assertEqual(Category.objects.get(name='Big child cat 14').child_level, 14)
+
+    def test_category_delete_matches_rebuild(self):
+        """Assert the children of a deleted category take their places among the new siblings by name, as if the tree was rebuilt"""
+        def get_tree_index():
+            return list(Category.objects.order_by('id').values_list('id', 'path', 'child_level', 'ordering_index'))
+        for name in ('b', 'd', 'f'):
+            Category.objects.create(name=name)
+        for name in ('a', 'c', 'e', 'g'):
+            child = Category.objects.create(name=name, parent=Category.objects.get(name='d'))
+            Category.objects.create(name=f'{name}a', parent=child)
+        Category.objects.create(name='Child cat 2', parent=self.sub_parent_cat)
+        Category.objects.create(name='Sub-parent cat 0', parent=self.parent_cat)
+        Category.objects.create(name='Sub-parent cat 2', parent=self.parent_cat)
+        for name in ('d', 'Sub-parent cat'): # top-lvl and nested ones
+            Category.objects.get(name=name).delete()
+            tree_index = get_tree_index()
+            Category.objects.rebuild_tree()
+            self.assertListEqual(get_tree_index(), tree_index)
+
+    def test_category_delete_children_queries_count(self):
+        """Assert sorting a deleted category's children among their new siblings doesn't depend on the number of children"""
+        ContentType.objects.get_for_model(Category) # cached for the tags' deletion
+        for children_count in (2, 20):
+            for name in ('b', 'm', 'y'):
+                Category.objects.create(name=name)
+            parent = Category.objects.create(name='n')
+            for i in range(children_count):
+                Category.objects.create(name=f'{"az"[i % 2]}{i:02}', parent=parent) # before and after the siblings
+            with self.assertNumQueries(13):
+                parent.delete()
+            tree_index = list(Category.objects.order_by('id').values_list('id', 'path', 'child_level', 'ordering_index'))
+            Category.objects.rebuild_tree()
+            self.assertListEqual(list(Category.objects.order_by('id').values_list('id', 'path', 'child_level', 'ordering_index')), tree_index)
+            Category.objects.exclude(id__in=[self.parent_cat.id, self.sub_parent_cat.id, self.child_cat.id]).delete()
+
+    def test_category_counters_cache(self):
+        """Assert active products' counters refresh the navigation tree only, the other category tree data stays cached"""
+        cache.clear()
+        def get_counts():
+            return {category.id: category.active_products_count for category in Category.objects.get_navigation_tree()}
+        self.assertEqual(get_counts()[self.child_cat.id], 0)
+        tree_version = get_version('category_tree')
+        Product.objects.create(name='Active product of child cat', category=self.child_cat, selling_price=10, is_active=True)
+        self.assertEqual(get_counts()[self.child_cat.id], 1)
+        Category.objects.recount_products()
+        self.assertEqual(get_version('category_tree'), tree_version)
+        # case: a category is saved
+        self.child_cat.name = 'Renamed child cat'
+        self.child_cat.save()
+        self.assertEqual(Category.objects.get_navigation_tree()[-1].name, 'Renamed child cat')
+
+    def test_category_get_descendants_ids(self):
+        """Assert descendants' ids are cached and invalidated when the tree changes"""
+        cache.clear() # cached tree data must not outlive the DB rollback of the previous tests
+        expected_ids = [self.parent_cat.id, self.sub_parent_cat.id, self.child_cat.id]
+        self.assertCountEqual(Category.objects.get_descendants_ids(self.parent_cat), expected_ids)
+        with self.assertNumQueries(0): # cached
+            self.assertCountEqual(Category.objects.get_descendants_ids(self.parent_cat), expected_ids)
+        self.child_cat.delete()
+        self.assertCountEqual(Category.objects.get_descendants_ids(self.parent_cat), expected_ids[:2])
+
+    def test_category_get_ancestors_descendants(self):
+        """Assert ancestors and descendants are taken from the tree index"""
+        cache.clear() # cached tree data must not outlive the DB rollback of the previous tests
+        child_cat = Category.objects.get(id=self.child_cat.id) # no parent instances loaded
+        self.assertListEqual(child_cat.get_ancestors_ids(), [self.parent_cat.id, self.sub_parent_cat.id])
+        with self.assertNumQueries(1):
+            self.assertListEqual(child_cat.get_ancestors(), [self.parent_cat, self.sub_parent_cat])
+        with self.assertNumQueries(0): # cached
+            self.assertListEqual(child_cat.get_ancestors(include_self=True), [self.parent_cat, self.sub_parent_cat, child_cat])
+        self.assertListEqual(self.parent_cat.get_ancestors(), [])
+        self.assertQuerysetEqual(self.parent_cat.get_descendants(), [self.sub_parent_cat, self.child_cat])
+        self.assertQuerysetEqual(self.parent_cat.get_descendants(include_self=True), [self.parent_cat, self.sub_parent_cat, self.child_cat])
+        self.assertFalse(self.child_cat.get_descendants().exists())
+
+    def test_category_child_level_queries_count(self):
+        """Assert saving a deep category doesn't fetch its ancestors one by one"""
+        parent = self.child_cat
+        for i in range(10):
+            parent = Category.objects.create(name=f'Deep cat {i}', parent=parent)
+        deep_cat = Category.objects.get(id=parent.id) # no parent instances loaded
+        with self.assertNumQueries(5): # savepoint, tree state, update, product cards' category name, savepoint release
+            deep_cat.description = 'new description'
+            deep_cat.save()
+        self.assertEqual(Category.objects.get(id=deep_cat.id).child_level, 12)
+
+    def test_category_active_products_count(self):
+        """Assert active products counters roll up to ancestors and follow product and category changes"""
+        def assert_counts(expected_counts):
+            actual_counts = [Category.objects.get(id=category.id).active_products_count for category in (self.parent_cat, self.sub_parent_cat, self.child_cat)]
+            self.assertListEqual(actual_counts, expected_counts)
+        # products with no selling price are inactive
+        assert_counts([0, 0, 0])
+        # case: activation
+        product = Product.objects.create(name='Active product of child cat', category=self.child_cat, selling_price=1)
+        assert_counts([1, 1, 1])
+        self.product_sub_parent.selling_price = 1
+        self.product_sub_parent.is_active = True
+        self.product_sub_parent.save()
+        assert_counts([2, 2, 1])
+        # case: deactivation
+        product.is_active = False
+        product.save()
+        assert_counts([1, 1, 0])
+        # case: category change
+        product.is_active = True
+        product.category = self.parent_cat
+        product.save()
+        assert_counts([2, 1, 0])
+        # case: category move
+        self.sub_parent_cat.parent = None
+        self.sub_parent_cat.save()
+        assert_counts([1, 1, 0])
+        # case: deletion
+        product.delete()
+        assert_counts([0, 1, 0])
+        # incremental counters have to match the ones recounted from scratch
+        incremental_counts = list(Category.objects.order_by('id').values_list('active_products_count', flat=True))
+        Category.objects.update(active_products_count=0)
+        Category.objects.recount_products()
+        self.assertListEqual(list(Category.objects.order_by('id').values_list('active_products_count', flat=True)), incremental_counts)
+
+    def test_product_card_sync(self):
+        """Assert products' cards follow products, tags, photos and categories changes, and match the ones rebuilt from scratch"""
+        def get_cards():
+            return list(ProductCard.objects.order_by('id').values())
+        card = ProductCard.objects.get(id=self.product_child.id)
+        self.assertEqual((card.name, card.category_name, card.tags), (self.product_child.name, 'Child cat', []))
+        # case: product's data, tags and photos
+        self.product_child.stock = 5
+        self.product_child.save()
+        self.product_child.tags.add('tag1', 'tag2')
+        self.product_child.photos = create_gallery(title=self.product_child.name)
+        self.product_child.save()
+        photo = photo_models.Photo.objects.create(image=get_random_temp_file('jpg')[0], title='photo', slug='photo')
+        self.product_child.photos.photos.add(photo)
+        card = ProductCard.objects.get(id=self.product_child.id)
+        self.assertEqual((card.stock, sorted(card.tags), [card_photo['id'] for card_photo in card.photos]), (5, ['tag1', 'tag2'], [photo.id]))
+        photo.delete()
+        self.assertEqual(ProductCard.objects.get(id=self.product_child.id).photos, [])
+        # case: category's rename and deletion
+        self.child_cat.name = 'Renamed child cat'
+        self.child_cat.save()
+        self.assertEqual(ProductCard.objects.get(id=self.product_child.id).category_name, 'Renamed child cat')
+        self.child_cat.delete()
+        card = ProductCard.objects.get(id=self.product_child.id)
+        self.assertEqual((card.category_id, card.category_name), (self.sub_parent_cat.id, 'Sub-parent cat'))
+        # case: product's deletion
+        self.product_sub_parent.delete()
+        self.assertFalse(ProductCard.objects.filter(id=self.product_sub_parent.id).exists())
+        # incremental cards have to match the ones rebuilt from scratch
+        incremental_cards = get_cards()
+        ProductCard.objects.all().delete()
+        call_command('rebuild_product_cards', stdout=StringIO())
+        self.assertListEqual(get_cards(), incremental_cards)
+        # case: the cards missing after migrate (the products were created before cards existed)
+        ProductCard.objects.filter(id=self.product_child.id).delete()
+        signals.post_migrate_handler(sender=apps.get_app_config('glyke_back'))
+        self.assertListEqual(get_cards(), incremental_cards)
+
+    def test_related_products(self):
+        """Assert related products are ranked by shared tags, categories and attributes, and follow products' changes"""
+        product_twin = Product.objects.create(name='Twin of child', category=self.child_cat, attributes={'size': '42', 'color': 'red'}, selling_price=1)
+        product_similar = Product.objects.create(name='Similar to child', category=self.sub_parent_cat, attributes={'size': '40'}, selling_price=1)
+        product_other = Product.objects.create(name='Other', category=Category.objects.create(name='Other cat'), selling_price=1)
+        product_parent = Product.objects.create(name='Product of parent cat', category=self.parent_cat, selling_price=1)
+        for product in (self.product_child, self.product_sub_parent):
+            product.selling_price, product.is_active = 1, True # products w/o a price are inactive
+            product.save()
+        self.product_child.attributes = {'size': '42', 'color': 'red'}
+        self.product_child.save()
+        self.product_child.tags.add('tag1', 'tag2')
+        product_twin.tags.add('tag1', 'tag2')
+        product_similar.tags.add('tag2')
+        call_command('rebuild_related_products', stdout=StringIO())
+        related_ids = list(RelatedProduct.objects.filter(product=self.product_child).order_by('rank').values_list('related_id', flat=True))
+        self.assertListEqual(related_ids, [product_twin.id, product_similar.id, self.product_sub_parent.id])
+        self.assertFalse(RelatedProduct.objects.filter(product=product_other).exists())
+        # products of the parent category are candidates, the grandparent's ones share nothing but the root category
+        self.assertIn(product_parent.id, RelatedProduct.objects.filter(product=self.product_sub_parent).values_list('related_id', flat=True))
+        # case: a deactivated product is rescored incrementally
+        product_twin.is_active = False
+        product_twin.save()
+        call_command('rebuild_related_products', '--changed', stdout=StringIO())
+        self.assertNotIn(product_twin.id, RelatedProduct.objects.filter(product=self.product_child).values_list('related_id', flat=True))
+        self.assertFalse(RelatedProduct.objects.filter(product=product_twin).exists())
+        # incremental rows have to match the ones rebuilt from scratch
+        incremental_rows = list(RelatedProduct.objects.order_by('product_id', 'rank').values_list('product_id', 'related_id', 'rank'))
+        call_command('rebuild_related_products', stdout=StringIO())
+        self.assertListEqual(list(RelatedProduct.objects.order_by('product_id', 'rank').values_list('product_id', 'related_id', 'rank')), incremental_rows)
+
+    def test_related_products_candidates_cap(self):
+        """Assert a product is only scored against the nearest products of a feature's posting list, incremental rebuilds included"""
+        products = [Product.objects.create(name=f'Common {i}', category=self.child_cat, selling_price=1) for i in range(20)]
+        for product in products: product.tags.add('common')
+        with patch.object(RelatedProduct.objects, 'max_feature_candidates', 4):
+            with patch.object(RelatedProduct.objects, 'get_score', wraps=RelatedProduct.objects.get_score) as get_score:
+                RelatedProduct.objects.rebuild(top_k=20)
+            self.assertLessEqual(get_score.call_count, 20 * 4 * 2) # a tag and a category, 4 candidates each
+            related_ids = RelatedProduct.objects.filter(product=products[10]).values_list('related_id', flat=True)
+            self.assertCountEqual(related_ids, [product.id for product in products[8:13] if product != products[10]])
+            # incremental rows have to match the ones rebuilt from scratch
+            products[10].tags.add('rare')
+            RelatedProduct.objects.rebuild([products[10].id], top_k=20)
+            incremental_rows = list(RelatedProduct.objects.order_by('product_id', 'rank').values_list('product_id', 'related_id', 'rank'))
+            RelatedProduct.objects.rebuild(top_k=20)
+            self.assertListEqual(list(RelatedProduct.objects.order_by('product_id', 'rank').values_list('product_id', 'related_id', 'rank')), incremental_rows)
+
     def test_get_deleted_product_instance_on_delete(self):
         """Assert a deleted instance is created on_delete"""
         self.assertFalse(Product.objects.filter(name='_deleted_').exists())
@@ -283,6 +579,43 @@ class ModelsTest(TestCase):
         rnd_discount = random.randint(1, 99)
         update_check_prices()
 
+    def test_product_update_prices(self):
+        """Assert prices recomputed in SQL by ProductQuerySet.update_prices are identical to the ones Product.save() computes"""
+        def check_prices(products):
+            for product in Product.objects.filter(id__in=[product.id for product in products]):
+                end_user_price = product.get_end_user_price(product.selling_price, product.discount_percent)
+                self.assertEqual((product.end_user_price, product.profit), (end_user_price, end_user_price - product.cost_price), product.name)
+            self.assertTrue(Product.objects.filter(id=product.id, end_user_price=end_user_price, profit=end_user_price - product.cost_price).exists()) # stored as save() stores it
+        # half-cents (10.10 with 15% off is 8.585) and random prices
+        products = [Product.objects.create(name='Half cent', selling_price=Decimal('10.10'), cost_price=Decimal('3.33'))]
+        products += [Product.objects.create(name=f'{i}_{get_random_string()}',
+                                            selling_price=Decimal(random.randrange(1, 8000000)) / 100, # room for +12.5%
+                                            cost_price=Decimal(random.randrange(0, 999999)) / 100,
+                                            discount_percent=random.randint(0, 80)) for i in range(40)]
+        queryset = Product.objects.filter(id__in=[product.id for product in products])
+        for discount in (15, 13, 10):
+            Product.objects.filter(id=products[0].id).update_prices(discount_percent=discount)
+            self.assertEqual(Product.objects.get(id=products[0].id).end_user_price,
+                             Product.get_end_user_price(Decimal('10.10'), discount))
+        self.assertEqual(Product.objects.get(id=products[0].id).end_user_price, Decimal('9.09'))
+        self.assertEqual(queryset.update_prices(discount_delta=5), len(products))
+        check_prices(products)
+        queryset.update_prices(discount_delta=-30) # clamped to 0
+        self.assertEqual(Product.objects.get(id=products[0].id).discount_percent, 0)
+        check_prices(products)
+        for discount in range(0, 81):
+            queryset.update_prices(discount_percent=discount)
+            check_prices(products)
+        # selling prices change by a percent, rounded half-up to cents
+        Product.objects.filter(id=products[0].id).update(selling_price=Decimal('0.05'))
+        Product.objects.filter(id=products[0].id).update_prices(price_percent=Decimal('-50'))
+        self.assertEqual(Product.objects.get(id=products[0].id).selling_price, Decimal('0.03'))
+        old_prices = dict(queryset.values_list('id', 'selling_price'))
+        queryset.update_prices(price_percent=Decimal('12.5'))
+        for product in queryset:
+            self.assertEqual(product.selling_price, (old_prices[product.id] * Decimal('1.125')).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP))
+        check_prices(products)
+
     def test_orderline_autoinc(self):
         """Assert line auto-numering in checks work properly"""
         order_no_user = Order.objects.create()
@@ -375,6 +708,42 @@ class ModelsTest(TestCase):
         order_line.delete()
         self.assertEqual(order.selling_price, 0)
 
+    def test_cart_prices_update(self):
+        """Checks if product price changes are copied to lines of current orders only, and their totals are refreshed as OrderLine/Order.save() do"""
+        products = [Product.objects.create(name=f'Cart product {i}', selling_price=decimal.Decimal('10.10') + i, cost_price=3) for i in range(3)]
+        carts = [Order.objects.create(status='CUR') for i in range(2)]
+        placed_order = Order.objects.create(status='PEN')
+        for order in (*carts, placed_order):
+            for quantity, product in enumerate(products, start=1):
+                OrderLine.objects.create(parent_order=order, product=product, quantity=quantity)
+        # case: a product is saved
+        products[0].discount_percent = 15
+        products[0].save()
+        line = OrderLine.objects.get(parent_order=carts[0], product=products[0])
+        self.assertEqual((line.end_user_price, line.discount_percent, line.profit), (decimal.Decimal('8.58'), 15, decimal.Decimal('5.58')))
+        self.assertEqual(OrderLine.objects.get(parent_order=placed_order, product=products[0]).end_user_price, decimal.Decimal('10.10'))
+        # case: bulk changes, the lines and the orders are as saved ones would be
+        Product.objects.filter(id__in=[product.id for product in products]).update_prices(price_percent=decimal.Decimal('12.5'), discount_delta=10)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertEqual(OrderLine.objects.update_current_prices([product.id for product in products]), 6)
+        self.assertEqual(len(queries), 6) # order ids, lines, totals, orders, a savepoint and its release
+        for order in carts:
+            expected_lines = OrderLine.objects.filter(parent_order=order).order_by('id')
+            lines = list(expected_lines.values_list('cost_price', 'selling_price', 'end_user_price', 'discount_percent', 'profit'))
+            order = Order.objects.get(id=order.id)
+            totals = (order.cost_price, order.selling_price, order.end_user_price, order.profit, order.items_total)
+            for line in expected_lines: line.save() # OrderLine.save() copies the prices and saves the order
+            self.assertEqual(lines, list(expected_lines.values_list('cost_price', 'selling_price', 'end_user_price', 'discount_percent', 'profit')))
+            order = Order.objects.get(id=order.id)
+            self.assertEqual(totals, (order.cost_price, order.selling_price, order.end_user_price, order.profit, order.items_total))
+        self.assertEqual(Order.objects.get(id=placed_order.id).selling_price, decimal.Decimal('10.10') + decimal.Decimal('11.10') * 2 + decimal.Decimal('12.10') * 3)
+        # case: the command
+        Product.objects.filter(id=products[1].id).update(selling_price=1, end_user_price=1)
+        output = StringIO()
+        call_command('update_cart_prices', products[1].id, stdout=output)
+        self.assertIn('2 cart lines updated', output.getvalue())
+        self.assertEqual(Order.objects.get(id=carts[1].id).selling_price, OrderLine.objects.filter(parent_order=carts[1]).aggregate(total=models.Sum('selling_price'))['total'])
+
     def test_order_items_total_update(self):
         """Checks if Order's items_total is calculated properly"""
         expected_items_total = 0
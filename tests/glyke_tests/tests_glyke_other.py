@@ -1,9 +1,24 @@
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
 from django.utils.crypto import get_random_string
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 from urllib.parse import quote_plus
+from decimal import Decimal
+from io import StringIO
 import random
+import json
+import tempfile
+import os
 
+from photologue import models as photo_models
 from glyke_back.templatetags import glyke_back_extras as extras
+from glyke_back import caching, pricing
+from glyke_back.models import Category, Product, ProductCard
+from glyke_back.paginators import CachedCountPaginator
+from django.core.paginator import EmptyPage
 
 
 class TestExtraTemplateTags(TestCase):
@@ -38,6 +53,17 @@ class TestExtraTemplateTags(TestCase):
         expected_result = test_url_param_name + quote_plus(self.every_symbol_string, encoding='utf-8')
         self.assertEqual(expected_result, actual_result)
 
+    def test_photo_size_url(self):
+        """Checks if 'photo_size_url' tag returns photologue's url of a size w/o incrementing the photo's view count"""
+        with tempfile.TemporaryDirectory() as media_root, override_settings(MEDIA_ROOT=media_root):
+            photo = photo_models.Photo.objects.create(image=SimpleUploadedFile('photo.jpg', b'file_content'), title='photo', slug='photo')
+            for increment_count in (True, False):
+                photo_models.PhotoSize.objects.create(name=f'counted_{increment_count}', width=10, height=10, increment_count=increment_count)
+            expected_urls = [getattr(photo, f'get_counted_{increment_count}_url')() for increment_count in (True, False)] # public accessors
+            view_count = photo_models.Photo.objects.get(id=photo.id).view_count
+            self.assertEqual([extras.photo_size_url(photo, f'counted_{increment_count}') for increment_count in (True, False)], expected_urls)
+            self.assertEqual(photo_models.Photo.objects.get(id=photo.id).view_count, view_count)
+
     def test_remove_all_occ_url_param(self):
         """Checks if 'remove_all_occ_url_param' tag works as expected"""
         test_urls_params = '&test_param_1=test_value_1&test_param_2=test_value_2&test_param_1=test_value_3&test_param_2=test_value_4&'
@@ -49,11 +75,140 @@ class TestExtraTemplateTags(TestCase):
             actual_result = extras.remove_all_occ_url_param(test_urls_params, test_param)
             self.assertEqual(expected_result, actual_result)
 
+class TestCaching(TestCase):
+    """Testcase for the versioned cache helpers"""
+    def setUp(self):
+        cache.clear()
+        self.calls_count = 0
+
+    def get_value(self):
+        self.calls_count += 1
+        return self.calls_count
+
+    def test_bump_version(self):
+        """Checks if a namespace gets a new version (and a new key) on bump"""
+        version = caching.get_version('test_namespace')
+        self.assertEqual(caching.get_version('test_namespace'), version)
+        key = caching.get_versioned_key('test_namespace', 'key')
+        self.assertNotEqual(caching.bump_version('test_namespace'), version)
+        self.assertNotEqual(caching.get_versioned_key('test_namespace', 'key'), key)
+
+    def test_get_or_set_two_tier(self):
+        """Checks if a value is computed once per namespace version, and is served from the process-local tier"""
+        self.assertEqual(caching.get_or_set_two_tier('test_namespace', 'key', self.get_value), 1)
+        cache.delete(caching.get_versioned_key('test_namespace', 'key')) # the local tier still has it
+        self.assertEqual(caching.get_or_set_two_tier('test_namespace', 'key', self.get_value), 1)
+        caching.bump_version('test_namespace')
+        self.assertEqual(caching.get_or_set_two_tier('test_namespace', 'key', self.get_value), 2)
+        self.assertEqual(self.calls_count, 2)
+
+    def test_get_versions(self):
+        """Checks if versions of several namespaces are read at once, and missing ones are initialized"""
+        version = caching.get_version('test_namespace')
+        versions = caching.get_versions(['test_namespace', 'new_namespace'])
+        self.assertEqual(versions, [version, caching.get_version('new_namespace')])
+        self.assertIsNotNone(versions[1])
+
+class TestCachedCountPaginator(TestCase):
+    """Testcase for the catalogue's paginator"""
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(12):
+            Product.objects.create(name=f'Product {i}', selling_price=1)
 
-
-
-
-
-
-
-
+    def setUp(self):
+        cache.clear()
+
+    def test_estimated_count(self):
+        """Checks if counts above the threshold are estimated, and exact ones are kept as is"""
+        paginator = CachedCountPaginator(Product.objects.order_by('id'), 5, count_threshold=10)
+        self.assertEqual((paginator.count, paginator.is_count_estimated, paginator.num_pages), (11, True, 3))
+        paginator = CachedCountPaginator(Product.objects.order_by('id'), 5, count_threshold=12)
+        self.assertEqual((paginator.count, paginator.is_count_estimated), (12, False))
+
+    def test_pages_past_estimated_count(self):
+        """Checks if an estimated count doesn't cap the pages: the next page is told by an extra row"""
+        products = list(Product.objects.order_by('id'))
+        paginator = CachedCountPaginator(Product.objects.order_by('id'), 5, count_threshold=4)
+        self.assertEqual((paginator.count, paginator.num_pages), (5, 1)) # estimated
+        pages = [paginator.page(number) for number in (1, 2, 3)]
+        self.assertEqual([list(page) for page in pages], [products[:5], products[5:10], products[10:]])
+        self.assertEqual([page.has_next() for page in pages], [True, True, False])
+        self.assertEqual(pages[1].next_page_number(), 3)
+        with self.assertRaises(EmptyPage):
+            paginator.page(4)
+
+    def test_cached_count(self):
+        """Checks if a count is cached under its key"""
+        self.assertEqual(CachedCountPaginator(Product.objects.all(), 5, count_cache_key='test_count').count, 12)
+        Product.objects.create(name='One more product', selling_price=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(CachedCountPaginator(Product.objects.all(), 5, count_cache_key='test_count').count, 12)
+        self.assertEqual(CachedCountPaginator(Product.objects.all(), 5, count_cache_key='another_test_count').count, 13)
+
+class TestPricing(TestCase):
+    """Testcase for the batch repricing engine"""
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = Category.objects.create(name='Pricing cat')
+        cls.products = [Product.objects.create(name=f'Product {i}', category=cls.category,
+                                               selling_price=Decimal(random.randrange(1, 9999999)) / 100,
+                                               cost_price=Decimal(random.randrange(0, 999999)) / 100,
+                                               discount_percent=random.randint(0, 80)) for i in range(30)]
+
+    def test_end_user_cents(self):
+        """Checks if prices computed in integer cents are identical to Price.get_end_user_price"""
+        for discount_percent in range(0, 101):
+            for selling_cents in [*range(0, 2000), *random.sample(range(9999999), 300)]:
+                self.assertEqual(Decimal(pricing.get_end_user_cents(selling_cents, discount_percent)) / 100,
+                                 Product.get_end_user_price(Decimal(selling_cents) / 100, discount_percent), (selling_cents, discount_percent))
+
+    def test_reprice_queryset(self):
+        """Checks if stale derived prices are recomputed as Product.save() computes them, by batches, only the changed products are written"""
+        products = Product.objects.filter(category=self.category)
+        products.update(discount_percent=15, end_user_price=0) # update() doesn't recompute prices
+        modified = Product.objects.get(id=self.products[0].id).modified
+        Product.objects.filter(id=self.products[0].id).update(selling_price=Decimal('10.10'))
+        Product.objects.filter(id=self.products[1].id).update(selling_price=0)
+        with CaptureQueriesContext(connection) as queries:
+            report = pricing.reprice_queryset(products, batch_size=7)
+        self.assertEqual((report['processed'], report['updated']), (30, 30))
+        for product in products:
+            saved = Product(selling_price=product.selling_price, cost_price=product.cost_price, discount_percent=15)
+            saved.end_user_price = saved.get_end_user_price(saved.selling_price, saved.discount_percent)
+            self.assertEqual((product.end_user_price, product.profit), (saved.end_user_price, saved.end_user_price - product.cost_price))
+        self.assertEqual(Product.objects.get(id=self.products[0].id).end_user_price, Decimal('8.58'))
+        self.assertFalse(Product.objects.get(id=self.products[1].id).is_active) # as Product.save() does
+        self.assertEqual(Category.objects.get(id=self.category.id).active_products_count, 29)
+        self.assertEqual(ProductCard.objects.get(id=self.products[0].id).end_user_price, Decimal('8.58'))
+        self.assertGreater(Product.objects.get(id=self.products[0].id).modified, modified)
+        # case: nothing has changed, nothing is written
+        with CaptureQueriesContext(connection) as second_queries:
+            self.assertEqual(pricing.reprice_queryset(products, batch_size=7)['updated'], 0)
+        self.assertLess(len(second_queries), len(queries))
+        self.assertEqual(len(second_queries), 6 + 2) # 5 batches and an empty one, a savepoint and its release
+
+    def test_reprice_file(self):
+        """Checks if prices are set from a file and derived ones are recomputed, invalid rows are reported"""
+        lines = [json.dumps({'id': self.products[0].id, 'selling_price': '10.10', 'discount_percent': 15, 'cost_price': '3'}),
+                 json.dumps({'id': self.products[1].id, 'discount_percent': 50}),
+                 json.dumps({'id': self.products[2].id, 'discount_percent': 95}),
+                 json.dumps({'id': 0, 'discount_percent': 5}),
+                 'not json']
+        report = pricing.reprice_file(lines, 'jsonl')
+        self.assertEqual((report['processed'], report['updated']), (2, 2))
+        self.assertEqual([(error['row'], list(error['errors'])) for error in report['errors']], [(3, ['discount_percent']), (4, ['id']), (5, ['__all__'])])
+        product = Product.objects.get(id=self.products[0].id)
+        self.assertEqual((product.end_user_price, product.profit), (Decimal('8.58'), Decimal('5.58')))
+        product = Product.objects.get(id=self.products[1].id)
+        self.assertEqual((product.selling_price, product.discount_percent), (self.products[1].selling_price, 50))
+        self.assertEqual(product.end_user_price, Product.get_end_user_price(product.selling_price, 50))
+        # case: the command, with a CSV file
+        prices_file = tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False)
+        with prices_file:
+            prices_file.write(f'id,selling_price\n{self.products[3].id},20.00\n')
+        output = StringIO()
+        call_command('reprice_products', f'--file={prices_file.name}', stdout=output)
+        os.remove(prices_file.name)
+        self.assertIn('1 products processed, 1 updated', output.getvalue())
+        self.assertEqual(Product.objects.get(id=self.products[3].id).selling_price, Decimal('20.00'))
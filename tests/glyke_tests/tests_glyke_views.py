@@ -1,17 +1,39 @@
 from logging import raiseExceptions
-from django.test import TestCase
+from django.test import TestCase, override_settings
+from unittest.mock import patch
+from django.core.cache import cache
+from glyke_back.caching import bump_version
+from glyke_back.views import ProductsView
+from glyke_back.paginators import encode_cursor
+from glyke_back import catalogue_io, search
+from glyke_back.management.commands.explain_catalogue import get_catalogue_plans, is_index_plan
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.core.management import call_command
+from io import StringIO
 from django.urls import reverse
 from urllib.parse import urlencode, quote_plus
 from django.contrib.auth.models import User
 from django.core.files.uploadedfile import SimpleUploadedFile
+import csv
+import json
+import datetime
 import decimal
 import random
+import shutil
+import tempfile
+from django.utils import timezone
 from django.utils.crypto import get_random_string
 
 from taggit.models import Tag
 from glyke_back.models import *
 from glyke_back.forms import *
 
+MEDIA_ROOT = tempfile.mkdtemp() # temp dir for uploaded photos, so tests don't write to the project's media
+
+def tearDownModule(): # delete temp dir on teardown
+    shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
 class TestPermissionsGETMixin:
     """
     Inheriting class has to inherit from django's TestCase
@@ -43,6 +65,7 @@ class TestPermissionsGETMixin:
             response = self.client.get(self.basic_url)
             self.assertEqual(response.status_code, expected_status_code)
 
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
 class AddProductViewTest(TestPermissionsGETMixin, TestCase):
     """Tests AddProductView
     To test permissions 'cls.setUpTestPermissionsUsers()' must be set in setUpTestData, e.g. cls.setUpTestPermissionsUsers(expected_permissions_status_codes=[404,404,200,200])"""
@@ -160,6 +183,7 @@ class AddProductViewTest(TestPermissionsGETMixin, TestCase):
         test_end_user_price = Decimal(rnd_selling_price*Decimal(1-rnd_discount/100)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
         self.assertEqual(Product.objects.get(name=rnd_name).end_user_price, test_end_user_price)
 
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
 class EditProductViewTest(TestPermissionsGETMixin, TestCase):
     """Tests EditProductView
     To test permissions 'cls.setUpTestPermissionsUsers()' must be set in setUpTestData, e.g. cls.setUpTestPermissionsUsers(expected_permissions_status_codes=[404,404,200,200])"""
@@ -411,6 +435,7 @@ class DeleteProductViewTest(TestPermissionsGETMixin, TestCase):
         response = self.client.get(self.basic_url + "?recover=y")
         self.assertRedirects(response=response, expected_url=self.expected_error_url, target_status_code=200, status_code=302)
 
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
 class ProductsStaffViewTest(TestPermissionsGETMixin, TestCase):
     """Tests ProductsStaffView
     To test permissions 'cls.setUpTestPermissionsUsers()' must be set in setUpTestData, e.g. cls.setUpTestPermissionsUsers(expected_permissions_status_codes=[404,404,200,200])"""
@@ -418,6 +443,8 @@ class ProductsStaffViewTest(TestPermissionsGETMixin, TestCase):
     def setUpTestData(cls):
         cls.setUpTestPermissionsUsers(expected_permissions_status_codes=[404,404,200,200]) # from TestPermissionsGETMixin
 
+    queries_budget = 5 # session, user, cart panel (2), bulk action form's categories, products are loaded by DataTables (see test_data_endpoint)
+
     def setUp(self):
         self.client.force_login(self.test_user_staff) # force_login before making requests because this is a staff-only view
         self.basic_url = reverse('products_staff')
@@ -428,9 +455,165 @@ class ProductsStaffViewTest(TestPermissionsGETMixin, TestCase):
         for i in range(products_count):
             Product.objects.create(name=f'{i}_{get_random_string()}')
         response = self.client.get(self.basic_url)
-        view_products_queryset = response.context['products'].order_by('id')
+        view_products_queryset = response.context['products'].order_by('id') # products' cards
         self.assertEqual(view_products_queryset.all().count(), products_count)
-        self.assertQuerysetEqual(view_products_queryset, Product.objects.all())
+        self.assertQuerysetEqual(view_products_queryset, Product.objects.order_by('id').values_list('id', flat=True), transform=lambda card: card.id)
+
+    def test_queries_count(self):
+        """Checks if the number of queries doesn't depend on the number of products, photos and tags"""
+        create_rnd_products_with_photos(3)
+        self.client.get(self.basic_url) # warm up photologue's photo sizes cache
+        with self.assertNumQueries(self.queries_budget):
+            self.client.get(self.basic_url)
+        create_rnd_products_with_photos(10, photos_count=3)
+        with self.assertNumQueries(self.queries_budget):
+            self.client.get(self.basic_url)
+
+    def test_data_endpoint(self):
+        """Checks if DataTables' server-side endpoint pages, orders, searches and filters products in the DB"""
+        products = [Product.objects.create(name=f'{i}_product', selling_price=i % 3 + 1, stock=i) for i in range(30)]
+        products[7].description = 'A special one'
+        products[7].save()
+        columns = ['id', 'name', 'category', 'tags', 'description', 'cost_price', 'selling_price', 'discount_percent', 'end_user_price',
+                   'profit', 'stock', 'is_active', 'photos', 'created']
+        def get_data(draw=2, **params):
+            query = {f'columns[{index}][data]': column for index, column in enumerate(columns)}
+            query.update({'draw': draw, 'start': 0, 'length': 10, 'order[0][column]': 10, 'order[0][dir]': 'desc'}, **params)
+            return self.client.get(reverse('products_staff_data') + '?' + urlencode(query)).json()
+        data = get_data(draw=1)
+        self.assertEqual((data['recordsTotal'], data['recordsFiltered']), (30, 30))
+        self.assertEqual([row['id'] for row in data['data']], [product.id for product in products[::-1][:10]])
+        self.assertIn({'value': '2.00', 'label': '2.00', 'count': 10}, data['filters']['selling_price'])
+        # case: the next page, without filters' values
+        data = get_data(start=10)
+        self.assertEqual([row['id'] for row in data['data']], [product.id for product in products[::-1][10:20]])
+        self.assertNotIn('filters', data)
+        # case: global search and column filters
+        self.assertEqual([row['id'] for row in get_data(**{'search[value]': 'special'})['data']], [products[7].id])
+        data = get_data(**{'columns[6][search][value]': '2.00', 'length': 100})
+        self.assertEqual((data['recordsFiltered'], len(data['data'])), (10, 10))
+        self.assertTrue(all(row['selling_price'] == '$ 2.00' for row in data['data']))
+        self.assertIn('error', get_data(**{'columns[10][search][value]': 'not-a-number'}))
+        # case: the number of queries doesn't depend on the page's length
+        with self.assertNumQueries(5): # session, user, total count, filtered count, page
+            get_data(**{'search[value]': 'product', 'length': 100})
+        self.client.force_login(self.test_user)
+        self.assertEqual(self.client.get(reverse('products_staff_data')).status_code, 404)
+
+    def test_bulk_actions(self):
+        """Checks if bulk actions are applied to the products the table is filtered to, as Product.save() would apply them"""
+        category = Category.objects.create(name='Bulk cat')
+        products = [Product.objects.create(name=f'{i}_bulk', selling_price=decimal.Decimal('10.10') + i, cost_price=3, category=category) for i in range(6)]
+        free_product = Product.objects.create(name='Free bulk') # no price, inactive
+        other_product = Product.objects.create(name='Other', selling_price=5)
+        def post_action(**data):
+            query = {'columns[0][data]': 'name', 'search[value]': 'bulk'} # the table's parameters
+            response = self.client.post(reverse('products_staff_bulk_action') + '?' + urlencode(query), data)
+            return response.status_code, response.json()
+        self.assertEqual(post_action(action='set_discount', discount_percent=15), (200, {'updated': 7}))
+        for product in Product.objects.filter(id__in=[product.id for product in products]):
+            saved = Product.objects.create(name=f'Saved {product.id}', selling_price=product.selling_price, cost_price=3, discount_percent=15)
+            self.assertEqual((product.discount_percent, product.end_user_price, product.profit), (15, saved.end_user_price, saved.profit))
+            self.assertEqual(ProductCard.objects.get(id=product.id).end_user_price, saved.end_user_price) # derived data is synced
+        self.assertEqual(Product.objects.get(id=other_product.id).discount_percent, 0)
+        # case: cached cards of the catalogue follow bulk updates
+        product_url = reverse('products') + f'?category={quote_plus(category.name)}'
+        self.assertContains(self.client.get(product_url), f'$ {saved.end_user_price}')
+        post_action(action='set_discount', discount_percent=20)
+        saved = Product.objects.create(name='Saved 20', selling_price=products[-1].selling_price, cost_price=3, discount_percent=20)
+        self.assertContains(self.client.get(product_url), f'$ {saved.end_user_price}')
+        post_action(action='adjust_discount', discount_delta=60)
+        self.assertEqual(Product.objects.get(id=products[0].id).discount_percent, 80)
+        post_action(action='change_price', price_percent='10')
+        product = Product.objects.get(id=products[0].id)
+        self.assertEqual((product.selling_price, product.end_user_price), (decimal.Decimal('11.11'), decimal.Decimal('2.22')))
+        # activation, deactivation and moving keep categories' counters
+        post_action(action='deactivate')
+        self.assertFalse(Product.objects.filter(name__endswith='bulk', is_active=True).exists())
+        self.assertEqual(Category.objects.get(id=category.id).active_products_count, 0)
+        post_action(action='activate')
+        self.assertEqual(Product.objects.filter(name__endswith='bulk', is_active=True).count(), 6) # the free product stays inactive
+        self.assertEqual(Category.objects.get(id=category.id).active_products_count, 6)
+        new_category = Category.objects.create(name='New bulk cat')
+        post_action(action='move_category', category=new_category.id)
+        self.assertEqual(Category.objects.get(id=new_category.id).active_products_count, 6)
+        self.assertEqual(ProductCard.objects.get(id=products[0].id).category_name, 'New bulk cat')
+        # invalid actions
+        status_code, data = post_action(action='set_discount')
+        self.assertEqual((status_code, list(data['errors'])), (400, ['discount_percent']))
+        self.assertEqual(post_action(action='set_discount', discount_percent=95)[0], 400)
+        Product.objects.filter(id=products[0].id).update(selling_price=90000)
+        self.assertEqual(post_action(action='change_price', price_percent='20')[0], 400)
+        # case: the number of queries doesn't depend on the number of products
+        with CaptureQueriesContext(connection) as queries:
+            post_action(action='set_discount', discount_percent=20)
+        for i in range(20): Product.objects.create(name=f'{i}_more_bulk', selling_price=1)
+        with self.assertNumQueries(len(queries)):
+            post_action(action='set_discount', discount_percent=25)
+        self.client.force_login(self.test_user)
+        self.assertEqual(self.client.post(reverse('products_staff_bulk_action'), {'action': 'deactivate'}).status_code, 404)
+
+    def test_export(self):
+        """Checks if the catalogue is streamed as CSV and JSONL with a fixed number of queries per batch"""
+        products = create_rnd_products_with_photos(12, photos_count=1)
+        products[0].attributes = {'color': 'red'}
+        products[0].save()
+        response = self.client.get(reverse('export_catalogue') + '?format=jsonl')
+        self.assertTrue(response.streaming)
+        records = [json.loads(line) for line in b''.join(response.streaming_content).decode().splitlines()]
+        self.assertEqual([record['id'] for record in records], sorted(product.id for product in products))
+        self.assertEqual(records[0]['attributes'], {'color': 'red'})
+        self.assertEqual(sorted(records[0]['tags']), sorted(products[0].tags.names()))
+        self.assertTrue(records[0]['photo_urls'][0].startswith('http://testserver/'))
+        response = self.client.get(reverse('export_catalogue'))
+        rows = list(csv.DictReader(b''.join(response.streaming_content).decode().splitlines()))
+        self.assertEqual((len(rows), rows[0]['name'], json.loads(rows[0]['attributes'])), (12, products[0].name, {'color': 'red'}))
+        self.assertEqual(self.client.get(reverse('export_catalogue') + '?format=xml').status_code, 404)
+        # case: the command, cards are fetched by chunks of a single query, attributes with a query per batch
+        output = StringIO()
+        with self.assertNumQueries(4):
+            call_command('export_catalogue', '--format=jsonl', '--batch-size=5', stdout=output)
+        self.assertEqual(len(output.getvalue().splitlines()), 12)
+
+    def test_import(self):
+        """Checks if a catalogue file is imported in bulk as products saved one by one would be, with a per-row error report"""
+        category = Category.objects.create(name='Import cat')
+        Product.objects.create(name='Existing product', selling_price=1)
+        rows = [{'name': 'Imported 1', 'category': 'Import cat', 'tags': 'blue|wool', 'attributes': '{"color": "blue"}',
+                 'cost_price': '3.10', 'selling_price': '10.99', 'discount_percent': '15', 'stock': '4'},
+                {'name': 'Imported 2', 'tags': 'wool', 'selling_price': '5'},
+                {'name': 'Imported 3'}, # no price, inactive
+                {'name': 'Imported 1'}, # duplicates
+                {'name': 'Existing product'},
+                {'name': 'Bad one', 'category': 'No such cat', 'discount_percent': '95', 'stock': 'many'},]
+        catalogue_file = StringIO()
+        writer = csv.DictWriter(catalogue_file, fieldnames=['name', 'category', 'tags', 'attributes', 'cost_price', 'selling_price', 'discount_percent', 'stock'])
+        writer.writeheader()
+        writer.writerows(rows)
+        upload = SimpleUploadedFile('catalogue.csv', catalogue_file.getvalue().encode())
+        report = self.client.post(reverse('import_catalogue'), {'catalogue_file': upload}).context['report']
+        self.assertEqual(report['created'], 3)
+        self.assertEqual([error['row'] for error in report['errors']], [5, 6, 7])
+        self.assertEqual(set(report['errors'][2]['errors']), {'category', 'discount_percent', 'stock'})
+        # imported products match the ones saved via Product.save()
+        imported = Product.objects.get(name='Imported 1')
+        saved = Product.objects.create(name='Saved one', selling_price=decimal.Decimal('10.99'), cost_price=decimal.Decimal('3.10'), discount_percent=15)
+        self.assertEqual((imported.end_user_price, imported.profit), (saved.end_user_price, saved.profit))
+        self.assertEqual((imported.category, imported.attributes, imported.created_by), (category, {'color': 'blue'}, self.test_user_staff))
+        self.assertEqual(sorted(imported.tags.names()), ['blue', 'wool'])
+        self.assertIsNotNone(imported.photos)
+        self.assertFalse(Product.objects.get(name='Imported 3').is_active)
+        self.assertEqual(Category.objects.get(id=category.id).active_products_count, 1)
+        self.assertEqual(sorted(ProductCard.objects.get(id=imported.id).tags), ['blue', 'wool'])
+        self.assertEqual(ProductAttributeValue.objects.get(product=imported).value, 'blue')
+        self.assertIn(imported.id, [result['id'] for result in search.search_products('imported')])
+        # case: the number of queries doesn't depend on the number of rows
+        def import_rows(count, prefix):
+            lines = [json.dumps({'name': f'{prefix} {i}', 'category': 'Import cat', 'tags': ['wool', f'{prefix}'], 'selling_price': 1}) for i in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                catalogue_io.import_catalogue(lines, 'jsonl')
+            return len(queries)
+        self.assertEqual(import_rows(3, 'few'), import_rows(30, 'many'))
 
 class AddToCartViewTest(TestPermissionsGETMixin, TestCase):
     """Tests AddToCartView
@@ -865,6 +1048,21 @@ class CartViewTest(TestPermissionsGETMixin, TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(current_order.order_lines.count(), 0)
 
+def create_rnd_products_with_photos(count, *, category=None, photos_count=2):
+    """Creates count random active products, each with a gallery of photos_count photos and 2 tags. Returns a list of products"""
+    products = list()
+    for _ in range(count):
+        rnd_name = get_random_string()
+        gallery = photo_models.Gallery.objects.create(title=f'{rnd_name}_gallery', slug=f'{rnd_name}_gallery')
+        for i in range(photos_count):
+            photo = photo_models.Photo.objects.create(image=SimpleUploadedFile(f'{i}_{rnd_name}.jpg', b"file_content"), title=f'{i}_{rnd_name}', slug=f'{i}_{rnd_name}')
+            gallery.photos.add(photo)
+        product = Product.objects.create(name=rnd_name, category=category, photos=gallery, selling_price=1, stock=1)
+        product.tags.add(get_random_string(), 'common_tag')
+        products.append(product)
+    return products
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
 class ProductsViewTest(TestPermissionsGETMixin, TestCase):
     """Tests ProductsView
     To test permissions 'cls.setUpTestPermissionsUsers()' must be set in setUpTestData, e.g. cls.setUpTestPermissionsUsers(expected_permissions_status_codes=[404,404,200,200])"""
@@ -888,7 +1086,10 @@ class ProductsViewTest(TestPermissionsGETMixin, TestCase):
                                                    selling_price = 3)
         cls.product_child.tags.add('tag3', 'tag4', 'tag5', 'tag6')
 
+    queries_budget = 5 # session, user, cart panel (2), products (count and cards are cached, otherwise + count, ProductCard rows)
+
     def setUp(self):
+        cache.clear() # cached catalogue data must not outlive the DB rollback of the previous test
         self.client.force_login(self.test_user) # force_login before making requests because this is a staff-only view
         self.basic_url = reverse('products')
 
@@ -916,6 +1117,210 @@ class ProductsViewTest(TestPermissionsGETMixin, TestCase):
         self.assertQuerysetEqual(response.context['categories'], Category.objects.filter(is_active=True).order_by('ordering_index'))
         self.assertFalse(response.context['products'].exists())
 
+    def test_category_param_cache_invalidation(self):
+        """Checks if the category filter picks up categories and products added after the descendants were cached"""
+        url = self.basic_url + f'?category={quote_plus(self.parent_cat.name)}'
+        self.client.get(url) # descendants of parent_cat are cached here
+        new_child_cat = Category.objects.create(name='New child cat', parent=self.child_cat)
+        new_product = Product.objects.create(name='Product of new child cat', category=new_child_cat, selling_price=4)
+        response = self.client.get(url)
+        self.assertIn(new_product, response.context['products'])
+
+    def test_categories_cache_invalidation(self):
+        """Checks if the cached categories' select options are updated when a category changes"""
+        response = self.client.get(self.basic_url)
+        self.assertQuerysetEqual(response.context['categories'], Category.objects.filter(is_active=True).order_by('ordering_index'))
+        new_cat = Category.objects.create(name='A new cat', parent=self.sub_parent_cat)
+        self.empty_cat.is_active = False
+        self.empty_cat.save()
+        response = self.client.get(self.basic_url)
+        self.assertQuerysetEqual(response.context['categories'], Category.objects.filter(is_active=True).order_by('ordering_index'))
+        self.assertIn(new_cat, response.context['categories'])
+        self.assertContains(response, 'A new cat')
+
+    def test_queries_count(self):
+        """Checks if the number of queries per catalogue page doesn't depend on the number of products, photos and tags"""
+        create_rnd_products_with_photos(3, category=self.child_cat)
+        self.client.get(self.basic_url) # warm up the caches (categories' tree, photologue's photo sizes)
+        with self.assertNumQueries(self.queries_budget):
+            self.client.get(self.basic_url)
+        bump_version('product_photos') # all the cached cards are stale now
+        with self.assertNumQueries(self.queries_budget + 1): # + ProductCard rows of the products whose cards aren't cached
+            self.client.get(self.basic_url)
+        create_rnd_products_with_photos(12, category=self.child_cat, photos_count=4)
+        category_url = self.basic_url + f'?category={quote_plus(self.parent_cat.name)}'
+        for url in (self.basic_url, category_url): self.client.get(url) # categories' tree and attribute facets are cached again (products have changed)
+        with self.assertNumQueries(self.queries_budget):
+            self.client.get(self.basic_url)
+        with self.assertNumQueries(self.queries_budget + 1): # + category lookup
+            self.client.get(category_url)
+
+    def test_cached_cards(self):
+        """Checks if cached cards get their per-request parts filled in and are re-rendered when a product changes"""
+        edit_url = reverse('edit_product', kwargs={'id': self.product_child.id})
+        self.product_child.stock = 1 # to have an 'add to cart' form
+        self.product_child.save()
+        response = self.client.get(self.basic_url + '?tag=tag6') # cards are cached here
+        self.assertNotContains(response, edit_url) # not a staff user
+        self.assertNotContains(response, '&tag=tag6">tag6</a>') # an active tag isn't a link
+        self.assertContains(response, '?tag=tag6&tag=tag5">tag5</a>')
+        self.assertContains(response, f'name="next" value="{self.basic_url}?tag=tag6"')
+        self.assertRegex(response.content.decode(), r'name="csrfmiddlewaretoken" value="\w{64}"') # tokens are masked differently on every call
+        self.client.force_login(self.test_user_staff)
+        response = self.client.get(self.basic_url)
+        self.assertContains(response, edit_url)
+        self.assertContains(response, '?&tag=tag6">tag6</a>')
+        self.product_child.description = 'A new description'
+        self.product_child.save()
+        self.assertContains(self.client.get(self.basic_url), 'A new description')
+
+    def test_anonymous_page_cache(self):
+        """Checks if pages are cached for anonymous users only and are invalidated by their dependency tags"""
+        self.client.logout()
+        product_url = reverse('product_details', kwargs={'id': self.product_child.id})
+        url = self.basic_url + '?tag=tag2&tag=tag1'
+        for page_url in (url, product_url): self.client.get(page_url) # pages are cached here
+        with self.assertNumQueries(0):
+            response = self.client.get(self.basic_url + '?tag=tag1&tag=tag2') # the same normalized query string
+            self.client.get(product_url)
+        self.assertContains(response, self.product_parent.name)
+        # case: a product is saved
+        self.product_child.description = 'A new description'
+        self.product_child.save()
+        self.assertContains(self.client.get(product_url), 'A new description')
+        self.assertContains(self.client.get(self.basic_url), 'A new description')
+        # case: a category is saved
+        self.parent_cat.name = 'Renamed parent cat'
+        self.parent_cat.save()
+        self.assertContains(self.client.get(url), 'Renamed parent cat')
+        # case: logged in users get live pages
+        self.client.force_login(self.test_user)
+        self.assertContains(self.client.get(url), self.test_user.username)
+
+    def test_conditional_get(self):
+        """Checks if anonymous pages are answered with 304 while their dependency tags' versions are the same"""
+        self.client.logout()
+        product_url = reverse('product_details', kwargs={'id': self.product_child.id})
+        self.client.get(product_url) # sets the CSRF cookie, which is a part of the ETag
+        response = self.client.get(product_url)
+        etag, last_modified = response['ETag'], response['Last-Modified']
+        self.assertIn('no-cache', response['Cache-Control'])
+        self.assertIn('private', response['Cache-Control'])
+        self.assertIn('Cookie', response['Vary'])
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(product_url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+            self.assertEqual(self.client.get(product_url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+        self.assertEqual(self.client.get(self.basic_url, HTTP_IF_NONE_MATCH=etag).status_code, 200) # another page
+        # case: the product is saved
+        self.product_child.description = 'A new description'
+        self.product_child.save()
+        response = self.client.get(product_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, 'A new description')
+        self.assertNotEqual(response['ETag'], etag)
+        # case: related products are rebuilt
+        call_command('rebuild_related_products', stdout=StringIO())
+        response = self.client.get(product_url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertContains(response, 'Related products')
+        self.assertContains(response, self.product_sub_parent.name)
+        # case: a related product is repriced
+        etag = response['ETag']
+        self.product_sub_parent.selling_price = decimal.Decimal('123.45')
+        self.product_sub_parent.save()
+        response = self.client.get(product_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertContains(response, '$ 123.45')
+        self.assertNotEqual(response['ETag'], etag)
+        # case: JSON records may be kept by a reverse proxy
+        self.assertIn('public', self.client.get(reverse('products_api')).headers['Cache-Control'])
+        # case: logged in users' pages have no validators
+        self.client.force_login(self.test_user)
+        response = self.client.get(product_url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('ETag', response)
+        self.assertIn('private', response['Cache-Control'])
+
+    def test_keyset_pagination(self):
+        """Checks if keyset pages follow the offset pages' ordering without gaps and duplicates, and keep the filters"""
+        for product in create_rnd_products_with_photos(20, category=self.child_cat, photos_count=0):
+            product.discount_percent = random.randint(0, 2) # lots of ties, so the 'id' tie-breaker is needed
+            product.save()
+        expected_products = list(Product.objects.filter(is_active=True).order_by('-discount_percent', '-stock', 'id'))
+        url, products = self.basic_url + '?after=', []
+        while True:
+            response = self.client.get(url)
+            self.assertEqual(len(response.context['products']), min(9, len(expected_products) - len(products)))
+            products += response.context['products']
+            if not response.context['page_obj'].has_next(): break
+            url = self.basic_url + f"?after={response.context['page_obj'].next_cursor}"
+        self.assertEqual(products, expected_products)
+        # case: filters are kept in the next page link
+        response = self.client.get(self.basic_url + f'?category={quote_plus(self.parent_cat.name)}&after=')
+        self.assertContains(response, f"category={quote_plus(self.parent_cat.name)}&amp;after={response.context['page_obj'].next_cursor}")
+        # case: invalid cursors, values are checked against the sort mode's fields
+        self.assertEqual(self.client.get(self.basic_url + '?after=not-a-cursor').status_code, 404)
+        for sort_mode, values in (('discount', [[1], 2, 3]), ('discount', [1, None, 3]), ('price', ['abc', 1]),
+                                  ('newest', ['yesterday', 1]), ('stock', [10 ** 30, 1]), ('stock', [{}, 1])):
+            for url in (self.basic_url, reverse('products_api')):
+                self.assertEqual(self.client.get(url + f'?sort={sort_mode}&after={encode_cursor(values)}').status_code, 404, (url, sort_mode, values))
+        # case: sort keys within the same millisecond (cursors keep microseconds)
+        created = timezone.now()
+        for i, product in enumerate(expected_products):
+            Product.objects.filter(id=product.id).update(created=created + datetime.timedelta(microseconds=i * 10))
+        expected_products = list(Product.objects.filter(is_active=True).order_by('-created', '-id'))
+        url, products = self.basic_url + '?sort=newest&after=', []
+        while url:
+            response = self.client.get(url)
+            products += response.context['products']
+            url = self.basic_url + f"?sort=newest&after={response.context['page_obj'].next_cursor}" if response.context['page_obj'].has_next() else None
+        self.assertEqual(products, expected_products)
+
+    def test_products_api(self):
+        """Checks if the JSON API pages follow the catalogue's ordering and filters, and if fields are selectable"""
+        for product in create_rnd_products_with_photos(20, category=self.child_cat, photos_count=0):
+            product.discount_percent = random.randint(0, 2)
+            product.save()
+        api_url = reverse('products_api')
+        expected_products = list(Product.objects.filter(is_active=True).order_by('-discount_percent', '-stock', 'id'))
+        url, ids = api_url + '?sort=discount', []
+        while url:
+            data = self.client.get(url).json()
+            ids += [record['id'] for record in data['results']]
+            url = data['next']
+        self.assertEqual(ids, [product.id for product in expected_products])
+        # case: the catalogue page continues with the API's second page
+        response = self.client.get(self.basic_url)
+        self.assertEqual([record['id'] for record in self.client.get(response.context['api_next_url']).json()['results']],
+                         [product.id for product in expected_products[9:18]])
+        # case: filters and fields
+        data = self.client.get(api_url + f'?category={quote_plus(self.sub_parent_cat.name)}&tag=tag5&fields=id,end_user_price,no_such_field').json()
+        self.assertEqual(data, {'results': [{'id': self.product_sub_parent.id, 'end_user_price': '2.00'},
+                                            {'id': self.product_child.id, 'end_user_price': '3.00'}],
+                                'next': None})
+        # case: cards' html is the catalogue page's one
+        record = self.client.get(api_url + f'?category={quote_plus(self.parent_cat.name)}&tag=tag1&fields=id,html').json()['results'][0]
+        self.assertIn(self.product_parent.name, record['html'])
+        self.assertNotIn(api_url, record['html'])
+        self.assertNotIn('fields=', record['html'])
+        self.assertEqual(self.client.get(api_url + '?after=not-a-cursor').status_code, 404)
+
+    def test_sort_param(self):
+        """Checks if every sort mode orders products as expected, keyset pages included, and is read from an index"""
+        for product in create_rnd_products_with_photos(12, photos_count=0):
+            product.selling_price, product.discount_percent, product.stock = random.randint(1, 3), random.randint(0, 2), random.randint(0, 2)
+            product.save()
+        for sort_mode, (label, ordering) in ProductsView.sort_modes.items():
+            expected_products = list(Product.objects.filter(is_active=True).order_by(*ordering))
+            self.assertEqual(list(self.client.get(self.basic_url + f'?sort={sort_mode}').context['products']), expected_products[:9])
+            response = self.client.get(self.basic_url + f'?sort={sort_mode}&after=')
+            self.assertEqual(list(response.context['products']), expected_products[:9])
+            response = self.client.get(self.basic_url + f"?sort={sort_mode}&after={response.context['page_obj'].next_cursor}")
+            self.assertEqual(list(response.context['products']), expected_products[9:])
+        self.assertEqual(self.client.get(self.basic_url + '?sort=no_such_mode').context['sort_mode'], ProductsView.default_sort_mode)
+        # case: query plans
+        if connection.vendor == 'sqlite':
+            for sort_mode, plans in get_catalogue_plans().items():
+                for page, plan in plans:
+                    self.assertTrue(is_index_plan(plan), f'{sort_mode}, {page}: {plan}')
+
     def test_tags_get_params(self):
         """Checks if tags filter works properly"""
         get_params = '?'
@@ -943,6 +1348,101 @@ class ProductsViewTest(TestPermissionsGETMixin, TestCase):
             self.assertQuerysetEqual(response.context['products'],
                                         expected_queryset.filter(tags__name__in=expected_tags).distinct())
 
+    def test_tags_and_not_get_params(self):
+        """Checks if 'tag_all' (AND) and 'tag_not' (NOT) tag filters work properly, alone and combined with 'tag' (OR) ones"""
+        cases = {'?tag_all=tag3&tag_all=tag5': [self.product_sub_parent, self.product_child],
+                 '?tag_all=tag1&tag_all=tag6': [],
+                 '?tag_not=tag1': [self.product_sub_parent, self.product_child],
+                 '?tag=tag1&tag=tag6&tag_not=tag2': [self.product_child],
+                 '?tag=tag2&tag_all=tag5&tag_not=tag6': [self.product_sub_parent],
+                 '?tag_all=no_such_tag': [],}
+        for get_params, expected_products in cases.items():
+            response = self.client.get(self.basic_url + get_params)
+            self.assertQuerysetEqual(response.context['products'], expected_products, ordered=False)
+
+    def test_search_param(self):
+        """Checks if the search index is kept in sync with products and their tags, and search results are ordered by relevance"""
+        search_url = self.basic_url + '?q='
+        product = Product.objects.create(name='Rare thing', description='A thing with <b>rare</b> stuff', attributes={'color': 'crimson'}, selling_price=1)
+        self.product_child.description = 'It is rare'
+        self.product_child.save()
+        self.assertQuerysetEqual(self.client.get(search_url + 'rare').context['products'], [product, self.product_child]) # name matches weigh more
+        self.assertQuerysetEqual(self.client.get(search_url + 'crim').context['products'], [product]) # attributes' values and prefixes
+        self.assertQuerysetEqual(self.client.get(search_url + 'tag6 rare').context['products'], [self.product_child]) # tags, all the words are required
+        self.assertFalse(self.client.get(search_url + 'rare" OR "tag1').context['products']) # FTS5 syntax is quoted
+        # case: tags change
+        product.tags.add('tag6')
+        self.assertQuerysetEqual(self.client.get(search_url + 'tag6 rare').context['products'], [product, self.product_child])
+        Tag.objects.get(name='tag6').delete()
+        self.assertFalse(self.client.get(search_url + 'tag6').context['products'])
+        # case: inactive and deleted products
+        self.product_child.is_active = False
+        self.product_child.save()
+        product.delete()
+        self.assertFalse(self.client.get(search_url + 'rare').context['products'])
+
+    def test_pages_past_estimated_count(self):
+        """Checks if search results are reachable past an estimated count: the pages go on while there are results"""
+        for product in create_rnd_products_with_photos(20, category=self.child_cat, photos_count=0):
+            product.name = f'Plenty {product.name}'
+            product.save()
+        with patch('glyke_back.views.CATALOGUE_COUNT_THRESHOLD', 5):
+            url, products = self.basic_url + '?q=plenty&page=1', []
+            while url:
+                page = self.client.get(url).context['page_obj']
+                self.assertTrue(page.paginator.is_count_estimated)
+                products += page.object_list
+                url = self.basic_url + f'?q=plenty&page={page.next_page_number()}' if page.has_next() else None
+            self.assertEqual(len(products), 20)
+            self.assertEqual(self.client.get(self.basic_url + '?q=plenty&page=4').status_code, 404)
+
+    def test_search_view(self):
+        """Checks if the search endpoint returns escaped and highlighted results"""
+        product = Product.objects.create(name='Rare thing', description='A thing with <b>rare</b> stuff', selling_price=1)
+        response = self.client.get(reverse('search') + '?q=rare')
+        self.assertEqual(response.json()['results'], [{'id': product.id,
+                                                       'name': '<mark>Rare</mark> thing',
+                                                       'snippet': 'A thing with &lt;b&gt;<mark>rare</mark>&lt;/b&gt; stuff',
+                                                       'url': reverse('product_details', kwargs={'id': product.id})}])
+        self.assertEqual(self.client.get(reverse('search') + '?q=').json()['results'], [])
+
+    def test_attribute_params(self):
+        """Checks if attribute filters and facets' counts work properly and follow products' attributes changes"""
+        for product, attributes in ((self.product_parent, {'color': 'Blue', 'size': 'L'}),
+                                    (self.product_sub_parent, {'color': 'blue ', 'size': 'M'}),
+                                    (self.product_child, {'Color': 'Red', 'size': 'L'})):
+            product.attributes = attributes
+            product.save()
+        cases = {'?attr=Color:BLUE': [self.product_parent, self.product_sub_parent], # case and whitespace insensitive
+                 '?attr=color:blue&attr=color:red': [self.product_parent, self.product_sub_parent, self.product_child], # OR within an attribute
+                 '?attr=color:blue&attr=size:l': [self.product_parent], # AND between attributes
+                 '?attr=color:green': [],
+                 '?attr=no_separator': [self.product_parent, self.product_sub_parent, self.product_child],}
+        for get_params, expected_products in cases.items():
+            response = self.client.get(self.basic_url + get_params)
+            self.assertQuerysetEqual(response.context['products'], expected_products, ordered=False)
+        # case: facets of a category, selected values
+        response = self.client.get(self.basic_url + f'?category={quote_plus(self.sub_parent_cat.name)}&attr=size:l')
+        facets = {attribute: {facet['value']: (facet['count'], facet['selected']) for facet in values} for attribute, values in response.context['attribute_facets'].items()}
+        self.assertDictEqual(facets, {'color': {'blue': (1, False), 'red': (1, False)}, 'size': {'l': (1, True), 'm': (1, False)}})
+        # case: attributes change
+        self.product_child.attributes = {'color': 'Blue'}
+        self.product_child.save()
+        self.assertQuerysetEqual(self.client.get(self.basic_url + '?attr=size:l').context['products'], [self.product_parent])
+        self.assertEqual(response.context['attribute_facets']['color'][0]['param'], 'attr=color%3Ablue')
+
+    def test_tags_index_invalidation(self):
+        """Checks if the cached tag index is updated when products' tags change"""
+        url = self.basic_url + '?tag_all=tag1&tag_all=tag5'
+        self.assertFalse(self.client.get(url).context['products']) # the index is cached here
+        self.product_child.tags.add('tag1')
+        self.assertQuerysetEqual(self.client.get(url).context['products'], [self.product_child])
+        self.product_child.tags.remove('tag5')
+        self.assertFalse(self.client.get(url).context['products'])
+        Tag.objects.filter(name='tag1').update(name='tag1_renamed') # no signals, so the index is stale
+        Tag.objects.get(name='tag1_renamed').save()
+        self.assertTrue(self.client.get(self.basic_url + '?tag=tag1_renamed').context['products'])
+
 class ProfileViewTest(TestPermissionsGETMixin, TestCase):
     """Tests ProfileView
     To test permissions 'cls.setUpTestPermissionsUsers()' must be set in setUpTestData, e.g. cls.setUpTestPermissionsUsers(expected_permissions_status_codes=[404,404,200,200])"""